@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Action dispatch registry for the Tuya API endpoints.
+
+Tuya devices select the API they call with the ``a`` request parameter, for
+example ``s.gw.token.get`` or ``tuya.device.upgrade.get``. The registry maps
+exact action names to handler callables with a single dict lookup.
+
+Firmware versions differ in the exact names they use (``s.gw.dev.pk.active``,
+``tuya.device.active``, ...), so unknown names go through an ordered list of
+precompiled fallback patterns. The first pattern that matches wins, which
+keeps the priority of the original substring checks. Fallback results are
+memoized, so each unknown name is matched only once.
+
+Extra actions can be registered from plugin modules. A plugin is a module
+that defines ``register_actions(registry)``:
+
+    # my_actions.py
+    def answer_ota_check(handler, request):
+        handler.reply({"ota": False}, request.encrypted)
+
+    def register_actions(registry):
+        registry.register(answer_ota_check, "tuya.device.ota.check")
+
+Example:
+    >>> registry = ActionRegistry()
+    >>> registry.register(answer_token, "s.gw.token.get")
+    >>> registry.register_fallback(r"\\.active", answer_active)
+    >>> registry.resolve("tuya.device.active") is answer_active
+    True
+"""
+
+import importlib
+import re
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Pattern, Tuple
+
+# Upper bound for memoized fallback lookups, so arbitrary action names sent by
+# misbehaving clients cannot grow the memo without limit
+FALLBACK_MEMO_SIZE = 1024
+
+
+class ActionRequest(NamedTuple):
+    """
+    Parameters of a Tuya API request passed to action handlers.
+
+    Attributes:
+            action: Value of the 'a' parameter, e.g. "s.gw.token.get"
+            encrypted: Whether the device uses the encrypted protocol (et=1)
+            gw_id: Gateway ID of the device ("0" if not sent)
+    """
+
+    action: str
+    encrypted: bool
+    gw_id: str
+
+
+# Handlers are called with the request handler instance and the request
+ActionHandler = Callable[[Any, ActionRequest], None]
+
+
+class ActionRegistry:
+    """
+    Maps Tuya action names to handler callables.
+
+    Attributes:
+            default: Handler used when neither an exact name nor a fallback matches
+    """
+
+    def __init__(self, default: Optional[ActionHandler] = None) -> None:
+        """
+        Create an empty registry.
+
+        Args:
+                default: Handler for actions nothing else matches
+        """
+        self.default = default
+        self._exact: Dict[str, ActionHandler] = {}
+        self._fallbacks: List[Tuple[Pattern[str], ActionHandler]] = []
+        self._memo: Dict[str, Optional[ActionHandler]] = {}
+
+    def __contains__(self, action: object) -> bool:
+        """Return whether an exact handler is registered for the action."""
+        return action in self._exact
+
+    def actions(self) -> List[str]:
+        """Return all exactly registered action names, sorted."""
+        return sorted(self._exact)
+
+    def register(self, handler: ActionHandler, *actions: str) -> ActionHandler:
+        """
+        Register a handler for one or more exact action names.
+
+        Args:
+                handler: Callable taking (request_handler, ActionRequest)
+                actions: Action names, e.g. "s.gw.upgrade.get"
+
+        Returns:
+                The handler, so this can be used from a decorator
+        """
+        for action in actions:
+            self._exact[action] = handler
+        return handler
+
+    def route(self, *actions: str) -> Callable[[ActionHandler], ActionHandler]:
+        """
+        Decorator form of register().
+
+        Args:
+                actions: Action names handled by the decorated function
+        """
+        return lambda handler: self.register(handler, *actions)
+
+    def register_fallback(self, pattern: str, handler: ActionHandler) -> None:
+        """
+        Register a handler for unknown actions matching a regular expression.
+
+        Fallbacks are tried in registration order; the first match wins.
+
+        Args:
+                pattern: Regular expression searched for in the action name
+                handler: Callable taking (request_handler, ActionRequest)
+        """
+        self._fallbacks.append((re.compile(pattern), handler))
+        self._memo.clear()
+
+    def resolve(self, action: str) -> Optional[ActionHandler]:
+        """
+        Find the handler for an action name.
+
+        Args:
+                action: Value of the 'a' parameter
+
+        Returns:
+                The exact handler, the first matching fallback, or the default
+        """
+        handler = self._exact.get(action)
+        if handler is not None:
+            return handler
+        if action in self._memo:
+            return self._memo[action]
+        handler = self.default
+        for pattern, fallback in self._fallbacks:
+            if pattern.search(action):
+                handler = fallback
+                break
+        if len(self._memo) < FALLBACK_MEMO_SIZE:
+            self._memo[action] = handler
+        return handler
+
+    def dispatch(self, request_handler: Any, request: ActionRequest) -> bool:
+        """
+        Call the handler registered for a request.
+
+        Args:
+                request_handler: The tornado RequestHandler serving the request
+                request: Parsed request parameters
+
+        Returns:
+                False if no handler (not even a default) was found
+        """
+        handler = self.resolve(request.action)
+        if handler is None:
+            return False
+        handler(request_handler, request)
+        return True
+
+    def load_plugins(self, module_names: Iterable[str]) -> None:
+        """
+        Import plugin modules and let them register their actions.
+
+        Args:
+                module_names: Importable module names defining register_actions()
+
+        Raises:
+                ImportError: If a plugin cannot be imported
+                AttributeError: If a plugin has no register_actions() function
+        """
+        for name in module_names:
+            module = importlib.import_module(name)
+            module.register_actions(self)
+        self._memo.clear()
+
+
+__all__ = ["ActionHandler", "ActionRegistry", "ActionRequest"]
@@ -18,6 +18,7 @@ padding bytes equal the padding length.
 
 Functions:
 ---------
+- ecb_cipher(): Create an AES-ECB cipher (imports Cryptodome on first use)
 - pad(): Apply PKCS#7 padding to a string
 - unpad(): Remove PKCS#7 padding from a string
 - encrypt(): Encrypt a message using AES-ECB with PKCS#7 padding
@@ -27,9 +28,25 @@ Created by VTRUST for tuya-convert.
 Copyright (c) 2018 VTRUST. All rights reserved.
 """
 
-from typing import Union
+from typing import Any, Union
 
-from Cryptodome.Cipher import AES
+
+def ecb_cipher(key: bytes) -> Any:
+    """
+    Create an AES-ECB cipher for a key.
+
+    Cryptodome is imported on first use rather than with this module, so
+    command-line tools that never encrypt (e.g. for --help) start faster.
+
+    Args:
+        key: AES key
+
+    Returns:
+        A Cryptodome ECB cipher object
+    """
+    from Cryptodome.Cipher import AES
+
+    return AES.new(key, AES.MODE_ECB)
 
 
 def pad(data: str) -> str:
@@ -121,7 +138,7 @@ def encrypt(message: str, key: bytes) -> bytes:
 
     padded_message = pad(message)
     plaintext_bytes = padded_message.encode("utf-8")
-    cipher = AES.new(key, AES.MODE_ECB)
+    cipher = ecb_cipher(key)
     encrypted: bytes = cipher.encrypt(plaintext_bytes)
     return encrypted
 
@@ -159,7 +176,7 @@ def decrypt(encrypted_message: bytes, key: bytes) -> str:
     if len(encrypted_message) % 16 != 0:
         raise ValueError("Encrypted message length must be multiple of 16 bytes")
 
-    cipher = AES.new(key, AES.MODE_ECB)
+    cipher = ecb_cipher(key)
     decrypted_bytes = cipher.decrypt(encrypted_message)
     decrypted_str = decrypted_bytes.decode("utf-8")
     return unpad(decrypted_str)
@@ -167,4 +184,4 @@ def decrypt(encrypted_message: bytes, key: bytes) -> str:
 
 # For backward compatibility with existing lambda-based implementations,
 # provide the same interface
-__all__ = ["pad", "unpad", "encrypt", "decrypt"]
+__all__ = ["ecb_cipher", "pad", "unpad", "encrypt", "decrypt"]
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Streaming monitor for the protocol 15 MQTT traffic of devices being flashed.
+
+Subscribes to smart/device/# on the local broker and writes every frame it
+sees as one JSON object per line (JSONL): the upgrade triggers published to
+smart/device/in/<gwId> as well as whatever devices report on
+smart/device/out/<gwId>.
+
+Both frame formats of mq_pub_15 are decoded:
+
+    - 2.1: "2.1" + 16 hex digits of MD5 signature + base64(AES(message))
+    - 2.2: "2.2" + CRC32 + 8 digit timestamp + AES(message)
+
+The signature or CRC of every frame is verified before it is decrypted with
+the local key of its device. Local keys come from a key file with the same
+"gwId [localKey]" lines as mq_pub_15 -f, and default to the key the fake
+registration server hands out.
+
+Devices publish in bursts when a whole rack is activated at once, so paho's
+network thread only queues raw frames. A decoder thread drains the queue in
+batches, reuses one cipher per local key and writes each batch with a single
+write; frames arriving while the queue is full are dropped and counted
+rather than stalling the MQTT connection.
+
+Example:
+    $ ./device_monitor.py --keys rack.txt --output /tmp/devices.jsonl
+    {"t": 1700000000.12, "topic": "smart/device/in/4351...", "gwId": "4351...",
+     "protocol": "2.1", "valid": true, "message": {"data": {...}, "protocol": 15, ...}}
+"""
+
+import argparse
+import base64
+import binascii
+import json
+import queue
+import signal
+import sys
+import threading
+import time
+from hashlib import md5
+from typing import IO, Any, Dict, Iterable, List, NamedTuple, Optional
+
+from crypto_utils import ecb_cipher
+from mq_pub_15 import (
+    CRC_BYTE_SIZE,
+    DEFAULT_BROKER,
+    DEFAULT_LOCAL_KEY,
+    MQTT_KEEPALIVE,
+    MQTT_PORT,
+    PROTOCOL_VERSION_21,
+    PROTOCOL_VERSION_22,
+    SIGNATURE_LENGTH,
+    SIGNATURE_START_OFFSET,
+    create_mqtt_client,
+    read_batch,
+)
+
+# Topic filter covering the traffic to and from every device
+MONITOR_TOPIC = "smart/device/#"
+
+# Frame layout after the 3 byte protocol version
+VERSION_LENGTH = 3
+TIMESTAMP_LENGTH = 8
+SIGNATURE_END = VERSION_LENGTH + SIGNATURE_LENGTH
+CRC_END = VERSION_LENGTH + CRC_BYTE_SIZE
+
+# Queue and batching limits of the decoder thread
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 256
+
+
+class Frame(NamedTuple):
+    """
+    A raw MQTT message waiting to be decoded.
+
+    Attributes:
+            received: Arrival time (seconds since the epoch)
+            topic: MQTT topic
+            payload: MQTT payload
+    """
+
+    received: float
+    topic: str
+    payload: bytes
+
+
+class KeyCache:
+    """
+    Local keys of the monitored devices, with one AES cipher per key.
+
+    ECB ciphers keep no state between calls, so every frame encrypted with
+    the same key is decrypted by the same cipher object.
+
+    Attributes:
+            default: Key of devices without an entry
+            keys: Local key by gwId
+    """
+
+    def __init__(self, default: str = DEFAULT_LOCAL_KEY) -> None:
+        """
+        Create an empty cache.
+
+        Args:
+                default: Key of devices without an entry
+        """
+        self.default = default
+        self.keys: Dict[str, str] = {}
+        self._ciphers: Dict[str, Any] = {}
+        self._suffixes: Dict[str, bytes] = {}
+
+    def load(self, lines: Iterable[str]) -> int:
+        """
+        Add the keys of "gwId [localKey]" lines (see mq_pub_15.read_batch()).
+
+        Returns:
+                The number of keys added
+
+        Raises:
+                ValueError: If a line is invalid
+        """
+        triggers = read_batch(lines, self.default)
+        self.keys.update((trigger.gw_id, trigger.local_key) for trigger in triggers)
+        return len(triggers)
+
+    def key(self, gw_id: str) -> str:
+        """Return the local key of a device."""
+        return self.keys.get(gw_id, self.default)
+
+    def cipher(self, key: str) -> Any:
+        """
+        Return the cached ECB cipher of a local key.
+
+        Raises:
+                ValueError: If the key is not 16 bytes long
+        """
+        cipher = self._ciphers.get(key)
+        if cipher is None:
+            if len(key.encode()) != 16:
+                raise ValueError("local key must be exactly 16 bytes")
+            cipher = self._ciphers[key] = ecb_cipher(key.encode())
+        return cipher
+
+    def signature_suffix(self, key: str) -> bytes:
+        """Return the part of the 2.1 signature input that follows the data."""
+        suffix = self._suffixes.get(key)
+        if suffix is None:
+            suffix = b"||pv=" + PROTOCOL_VERSION_21.encode() + b"||" + key.encode()
+            self._suffixes[key] = suffix
+        return suffix
+
+
+def _decrypt(cipher: Any, data: bytes) -> Any:
+    """
+    Decrypt and unpad a message, returning its JSON value or its text.
+
+    Raises:
+            ValueError: If the data is not a padded AES message
+    """
+    if not data or len(data) % 16:
+        raise ValueError("encrypted data is not a multiple of 16 bytes")
+    clear = cipher.decrypt(data)
+    padding = clear[-1]
+    if not 1 <= padding <= 16 or clear[-padding:] != bytes((padding,)) * padding:
+        raise ValueError("bad padding, wrong local key?")
+    text = clear[:-padding].decode("utf-8")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def decode_frame(frame: Frame, keys: KeyCache) -> Dict[str, Any]:
+    """
+    Verify and decrypt one frame.
+
+    Args:
+            frame: The raw MQTT message
+            keys: Local keys of the devices
+
+    Returns:
+            A JSON-serializable record with "t", "topic", "gwId", "protocol"
+            and "valid" (signature or CRC matched). Frames that decrypt get
+            "message", 2.2 frames their "timestamp"; failures set "error".
+            Payloads in neither format are kept as "raw" text.
+    """
+    payload = frame.payload
+    gw_id = frame.topic.rsplit("/", 1)[-1]
+    record: Dict[str, Any] = {"t": frame.received, "topic": frame.topic, "gwId": gw_id}
+    version = payload[:VERSION_LENGTH]
+    key = keys.key(gw_id)
+    try:
+        if version == b"2.1":
+            record.update(protocol=PROTOCOL_VERSION_21, valid=False)
+            signature = payload[VERSION_LENGTH:SIGNATURE_END]
+            data = payload[SIGNATURE_END:]
+            digest = md5(b"data=")
+            digest.update(data)
+            digest.update(keys.signature_suffix(key))
+            expected = digest.hexdigest()[SIGNATURE_START_OFFSET:][:SIGNATURE_LENGTH]
+            if signature != expected.encode():
+                record["error"] = "signature mismatch"
+                return record
+            record["valid"] = True
+            record["message"] = _decrypt(keys.cipher(key), base64.b64decode(data, validate=True))
+        elif version == b"2.2":
+            record.update(protocol=PROTOCOL_VERSION_22, valid=False)
+            crc = payload[VERSION_LENGTH:CRC_END]
+            body = payload[CRC_END:]
+            if binascii.crc32(body).to_bytes(CRC_BYTE_SIZE, "big") != crc:
+                record["error"] = "CRC mismatch"
+                return record
+            record["valid"] = True
+            record["timestamp"] = body[:TIMESTAMP_LENGTH].decode("ascii", "replace")
+            record["message"] = _decrypt(keys.cipher(key), body[TIMESTAMP_LENGTH:])
+        else:
+            record.update(protocol=None, valid=False, raw=payload.decode("utf-8", "replace"))
+    except (ValueError, UnicodeDecodeError, binascii.Error) as e:
+        record["error"] = str(e)
+    return record
+
+
+class DeviceMonitor:
+    """
+    Subscribes to device traffic and writes decoded frames as JSONL.
+
+    Attributes:
+            keys: Local keys of the devices
+            received: Frames received from the broker
+            written: Records written
+            invalid: Frames that failed verification or decryption
+            dropped: Frames dropped because the decoder fell behind
+    """
+
+    def __init__(
+        self,
+        output: IO[str],
+        keys: Optional[KeyCache] = None,
+        broker: str = DEFAULT_BROKER,
+        port: int = MQTT_PORT,
+        topic: str = MONITOR_TOPIC,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        """
+        Create a monitor; call start() to subscribe.
+
+        Args:
+                output: Stream the JSONL records are written to
+                keys: Local keys of the devices, the default key for all if None
+                broker: MQTT broker address
+                port: MQTT broker port
+                topic: Topic filter to subscribe to
+                queue_size: Maximum number of frames waiting for the decoder
+                batch_size: Maximum number of frames decoded and written at once
+        """
+        self.output = output
+        self.keys = keys if keys is not None else KeyCache()
+        self.broker = broker
+        self.port = port
+        self.topic = topic
+        self.batch_size = batch_size
+        self.received = 0
+        self.written = 0
+        self.invalid = 0
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Frame]]" = queue.Queue(queue_size)
+        self._client: Any = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the decoder thread and connect to the broker."""
+        self._thread = threading.Thread(target=self._run, name="device-monitor", daemon=True)
+        self._thread.start()
+        client = create_mqtt_client()
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        client.connect_async(self.broker, self.port, MQTT_KEEPALIVE)
+        client.loop_start()
+        self._client = client
+
+    def stop(self) -> None:
+        """Disconnect, then decode and write the frames still queued."""
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def feed(self, frame: Frame) -> bool:
+        """
+        Queue a frame for the decoder without blocking.
+
+        Returns:
+                False if the queue was full and the frame was dropped
+        """
+        self.received += 1
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def process(self, frames: List[Frame]) -> None:
+        """Decode a batch of frames and write their records with one write."""
+        records = [decode_frame(frame, self.keys) for frame in frames]
+        self.invalid += sum(1 for record in records if "error" in record)
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        self.output.write(lines)
+        self.output.flush()
+        self.written += len(records)
+
+    def _on_connect(self, client: Any, *args: Any) -> None:
+        # paho network thread; (re)subscribe after every connect
+        client.subscribe(self.topic, qos=1)
+
+    def _on_message(self, client: Any, userdata: Any, message: Any) -> None:
+        self.feed(Frame(time.time(), message.topic, bytes(message.payload)))
+
+    def _run(self) -> None:
+        """Decoder thread: drain the queue in batches until stop()."""
+        running = True
+        while running:
+            batch: List[Frame] = []
+            frame = self._queue.get()
+            while frame is not None:
+                batch.append(frame)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    frame = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            running = frame is not None
+            if batch:
+                self.process(batch)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point; runs until SIGINT or SIGTERM.
+
+    Returns:
+            Exit code, 0 on success
+    """
+    parser = argparse.ArgumentParser(description="Decode the MQTT traffic of Tuya devices")
+    parser.add_argument("--broker", default=DEFAULT_BROKER, help="MQTT broker address")
+    parser.add_argument("--port", type=int, default=MQTT_PORT, help="MQTT broker port")
+    parser.add_argument("--topic", default=MONITOR_TOPIC, help="topic filter")
+    parser.add_argument("--keys", metavar="FILE", help='"gwId [localKey]" lines')
+    parser.add_argument("--local-key", default=DEFAULT_LOCAL_KEY, help="key of unlisted devices")
+    parser.add_argument("--output", metavar="FILE", help="append JSONL here instead of stdout")
+    args = parser.parse_args(argv)
+
+    keys = KeyCache(args.local_key)
+    if args.keys:
+        try:
+            with open(args.keys) as f:
+                keys.load(f)
+        except (OSError, ValueError) as e:
+            print("cannot load keys: %s" % e, file=sys.stderr)
+            return 1
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    monitor = DeviceMonitor(output, keys, args.broker, args.port, args.topic)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    monitor.start()
+    try:
+        stopped.wait()
+    finally:
+        monitor.stop()
+        if output is not sys.stdout:
+            output.close()
+    print(
+        "%d frames, %d written, %d invalid, %d dropped"
+        % (monitor.received, monitor.written, monitor.invalid, monitor.dropped),
+        file=sys.stderr,
+    )
+    return 0
+
+
+__all__ = ["DeviceMonitor", "Frame", "KeyCache", "MONITOR_TOPIC", "decode_frame"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,765 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Virtual Tuya device fleet for end-to-end load tests of the flashing services.
+
+Every virtual device walks through the same flow a real device takes while it
+is being flashed:
+
+    1. token     s.gw.token.get
+    2. active    s.gw.dev.pk.active (plain or encrypted protocol)
+    3. trigger   wait for the protocol 15 upgrade trigger on the MQTT topic
+                 smart/device/in/<gwId> and decode it
+    4. upgrade   s.gw.upgrade.get
+    5. download  fetch the firmware from the returned URL and verify its
+                 MD5 (protocol 2.1) or HMAC (protocol 2.2)
+
+API calls go to fake-registration-server.py directly, or through the TLS-PSK
+frontend (psk-frontend.py) when a PSK port is given. Hundreds of devices run
+concurrently on one asyncio loop, and the latency of every stage is reported
+as percentiles, so the whole chain can be benchmarked without radios.
+
+Typical Usage:
+    $ ./fake-registration-server.py --addr=127.0.0.1 --port=8080 --logLevel=warning &
+    $ mosquitto -p 1883 &
+    $ ./device_simulator.py --port 8080 --devices 200 --concurrency 50 --json report.json
+
+Example:
+    >>> config = SimulatorConfig(http_port=8080, wait_for_trigger=False)
+    >>> report = asyncio.run(run_fleet(config, devices=10, concurrency=5))
+    >>> report.to_dict()["stages"]["token"]["count"]
+    10
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import contextlib
+import hashlib
+import io
+import json
+import math
+import random
+import ssl
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from crypto_utils import decrypt, encrypt
+from Cryptodome.Cipher import AES
+from firmware_catalog import firmware_hmac
+from mq_pub_15 import (
+    DEFAULT_BROKER,
+    DEFAULT_LOCAL_KEY,
+    DEVICE_IN_TOPIC,
+    MQTT_KEEPALIVE,
+    MQTT_PORT,
+    PROTOCOL_NUMBER,
+    PROTOCOL_VERSION_21,
+    create_mqtt_client,
+    iot_dec,
+)
+
+# Flow stages, in order
+STAGES = ("token", "active", "trigger", "upgrade", "download")
+
+DEFAULT_SEC_KEY = "0000000000000000"
+
+# TLS-PSK identity sent by the virtual devices (see gen_psk() in psk-frontend.py)
+PSK_IDENTITY_PREFIX = b"BAohbmd6aG91IFR1"
+PSK_CIPHERS = "PSK-AES128-CBC-SHA256"
+
+# Retries of a firmware download answered with 503 and Retry-After
+DOWNLOAD_RETRIES = 3
+
+# Layout of protocol 2.2 MQTT messages: version, CRC32, 8 digit timestamp, data
+PROTOCOL_22_HEADER_LENGTH = 3 + 4 + 8
+
+
+class SimulatorConfig(NamedTuple):
+    """
+    Where the simulated devices connect to and how they behave.
+
+    Attributes:
+            host: Address of the fake registration server and PSK frontend
+            http_port: Plain HTTP port of the fake registration server
+            psk_port: TLS-PSK frontend port for API calls, 0 for plain HTTP
+            broker: MQTT broker address
+            mqtt_port: MQTT broker port
+            sec_key: secKey the server uses for encrypted API replies
+            local_key: localKey the upgrade triggers are encrypted with
+            wait_for_trigger: Whether devices wait for the MQTT upgrade trigger
+            trigger_timeout: Seconds to wait for the trigger
+            request_timeout: Seconds to wait for an HTTP response
+            loopback_sources: Give every device its own 127.x.y.z source address,
+                so per-IP limits of the server apply per device (Linux only)
+    """
+
+    host: str = "127.0.0.1"
+    http_port: int = 80
+    psk_port: int = 0
+    broker: str = DEFAULT_BROKER
+    mqtt_port: int = MQTT_PORT
+    sec_key: str = DEFAULT_SEC_KEY
+    local_key: str = DEFAULT_LOCAL_KEY
+    wait_for_trigger: bool = True
+    trigger_timeout: float = 30.0
+    request_timeout: float = 10.0
+    loopback_sources: bool = False
+
+
+class HttpResponse(NamedTuple):
+    """Status, lower-cased headers and body of an HTTP response."""
+
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+class StageError(Exception):
+    """
+    A device could not complete a stage of the flow.
+
+    Attributes:
+            stage: Name of the failed stage
+            reason: Short description of the failure
+    """
+
+    def __init__(self, stage: str, reason: str) -> None:
+        super().__init__("%s: %s" % (stage, reason))
+        self.stage = stage
+        self.reason = reason
+
+
+async def http_request(
+    host: str,
+    port: int,
+    method: str,
+    target: str,
+    body: bytes = b"",
+    ssl_context: Optional[ssl.SSLContext] = None,
+    timeout: float = 10.0,
+    source_address: Optional[str] = None,
+) -> HttpResponse:
+    """
+    Send one HTTP/1.1 request on a new connection and read the whole response.
+
+    Args:
+            host: Server address
+            port: Server port
+            method: HTTP method, e.g. "POST"
+            target: Request target, e.g. "/gw.json?a=s.gw.token.get"
+            body: Request body
+            ssl_context: Context for TLS (e.g. TLS-PSK), None for plain HTTP
+            timeout: Seconds allowed for the whole exchange
+            source_address: Local address to connect from, None for any
+
+    Returns:
+            The parsed response
+
+    Raises:
+            OSError: If the connection fails
+            asyncio.TimeoutError: If the server does not answer in time
+            ValueError: If the response is malformed or truncated
+    """
+
+    async def exchange() -> bytes:
+        reader, writer = await asyncio.open_connection(
+            host,
+            port,
+            ssl=ssl_context,
+            server_hostname="" if ssl_context else None,
+            local_addr=(source_address, 0) if source_address else None,
+        )
+        try:
+            head = (
+                "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n"
+                "Content-Type: application/x-www-form-urlencoded\r\nConnection: close\r\n\r\n"
+                % (method, target, host, len(body))
+            )
+            writer.write(head.encode() + body)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    raw = await asyncio.wait_for(exchange(), timeout)
+    head, separator, content = raw.partition(b"\r\n\r\n")
+    if not separator:
+        raise ValueError("incomplete HTTP response")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "content-length" in headers and len(content) != int(headers["content-length"]):
+        raise ValueError(
+            "truncated body (%d of %s bytes)" % (len(content), headers["content-length"])
+        )
+    return HttpResponse(status, headers, content)
+
+
+def device_psk(identity: bytes, hint: bytes) -> bytes:
+    """
+    Derive the TLS-PSK key the way Tuya firmware does (device side of gen_psk()).
+
+    Args:
+            identity: PSK identity including the leading encoding byte
+            hint: PSK identity hint sent by the server
+
+    Returns:
+            The 32 byte pre-shared key
+    """
+    identity = identity[1:]
+    key = hashlib.md5(hint[-16:]).digest()
+    iv = hashlib.md5(identity).digest()
+    psk: bytes = AES.new(key, AES.MODE_CBC, iv).encrypt(identity[:32])
+    return psk
+
+
+def psk_client_context(gw_id: str) -> ssl.SSLContext:
+    """
+    Create a TLS-PSK client context with a device-specific identity.
+
+    Args:
+            gw_id: Gateway ID the identity is derived from
+
+    Returns:
+            An SSLPSKContext that authenticates like a Tuya device
+    """
+    from sslpsk3 import SSLPSKContext
+
+    identity = b"\x01" + PSK_IDENTITY_PREFIX + hashlib.md5(gw_id.encode()).hexdigest()[:16].encode()
+    context = SSLPSKContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(PSK_CIPHERS)
+    context.set_psk_client_callback(
+        lambda hint: (identity.decode(), device_psk(identity, (hint or "").encode()))
+    )
+    return context  # type: ignore[no-any-return]
+
+
+def decode_trigger(payload: bytes, local_key: str) -> Dict[str, Any]:
+    """
+    Decode a protocol 15 upgrade trigger received on smart/device/in/<gwId>.
+
+    Args:
+            payload: MQTT message payload as published by mq_pub_15/iot_enc()
+            local_key: Local key the message was encrypted with
+
+    Returns:
+            The decrypted JSON message
+
+    Raises:
+            ValueError: If the message cannot be decrypted or is not a trigger
+    """
+    if payload.startswith(PROTOCOL_VERSION_21.encode()):
+        # iot_dec() prints the clear text; keep hundreds of devices quiet
+        with contextlib.redirect_stdout(io.StringIO()):
+            clear = iot_dec(payload.decode(), local_key)
+    else:
+        header, data = payload[:PROTOCOL_22_HEADER_LENGTH], payload[PROTOCOL_22_HEADER_LENGTH:]
+        crc = binascii.crc32(payload[7:]).to_bytes(4, byteorder="big")
+        if header[3:7] != crc:
+            raise ValueError("CRC mismatch")
+        clear = decrypt(data, local_key.encode())
+    message: Dict[str, Any] = json.loads(clear)
+    if message.get("protocol") != PROTOCOL_NUMBER:
+        raise ValueError("not a protocol %d message" % PROTOCOL_NUMBER)
+    return message
+
+
+class TriggerListener:
+    """
+    One MQTT subscription delivering upgrade triggers to waiting devices.
+
+    A single paho client subscribes to smart/device/in/+ and resolves the
+    future of the device the message is addressed to.
+    """
+
+    def __init__(self, broker: str, port: int = MQTT_PORT) -> None:
+        """
+        Create a listener; call start() before devices wait for triggers.
+
+        Args:
+                broker: MQTT broker address
+                port: MQTT broker port
+        """
+        self.broker = broker
+        self.port = port
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Any = None
+        self._waiting: Dict[str, "asyncio.Future[bytes]"] = {}
+        self._subscribed: Optional[asyncio.Event] = None
+
+    async def start(self, timeout: float = 10.0) -> None:
+        """
+        Connect, subscribe and wait until the subscription is active.
+
+        Raises:
+                asyncio.TimeoutError: If the broker does not confirm in time
+        """
+        self._loop = asyncio.get_running_loop()
+        self._subscribed = asyncio.Event()
+        client = create_mqtt_client()
+        client.on_connect = self._on_connect
+        client.on_subscribe = self._on_subscribe
+        client.on_message = self._on_message
+        client.connect_async(self.broker, self.port, MQTT_KEEPALIVE)
+        client.loop_start()
+        self._client = client
+        await asyncio.wait_for(self._subscribed.wait(), timeout)
+
+    def stop(self) -> None:
+        """Disconnect from the broker."""
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+
+    def expect(self, gw_id: str) -> "asyncio.Future[bytes]":
+        """
+        Return a future resolved with the next trigger payload for a device.
+
+        Args:
+                gw_id: Gateway ID of the waiting device
+        """
+        assert self._loop is not None, "start() the listener first"
+        future: "asyncio.Future[bytes]" = self._loop.create_future()
+        self._waiting[gw_id] = future
+        return future
+
+    def _on_connect(self, client: Any, *args: Any) -> None:
+        # paho network thread; signatures differ between paho 1.x and 2.x
+        client.subscribe(DEVICE_IN_TOPIC % "+", qos=1)
+
+    def _on_subscribe(self, client: Any, *args: Any) -> None:
+        assert self._loop is not None and self._subscribed is not None
+        self._loop.call_soon_threadsafe(self._subscribed.set)
+
+    def _on_message(self, client: Any, userdata: Any, message: Any) -> None:
+        assert self._loop is not None
+        gw_id = message.topic.rsplit("/", 1)[-1]
+        self._loop.call_soon_threadsafe(self._deliver, gw_id, bytes(message.payload))
+
+    def _deliver(self, gw_id: str, payload: bytes) -> None:
+        future = self._waiting.pop(gw_id, None)
+        if future is not None and not future.done():
+            future.set_result(payload)
+
+
+class VirtualDevice:
+    """
+    A simulated Tuya device walking through the flashing flow.
+
+    Attributes:
+            gw_id: Gateway ID of the device
+            encrypted: Whether the device uses protocol 2.2 (et=1)
+            durations: Seconds spent in each completed stage
+    """
+
+    def __init__(
+        self,
+        gw_id: str,
+        encrypted: bool,
+        config: SimulatorConfig,
+        triggers: Optional[TriggerListener] = None,
+        source_address: Optional[str] = None,
+    ) -> None:
+        """
+        Create a device.
+
+        Args:
+                gw_id: Gateway ID of the device
+                encrypted: Whether the device uses protocol 2.2 (et=1)
+                config: Where to connect to
+                triggers: Shared MQTT listener, required if config.wait_for_trigger
+                source_address: Local address the device connects from
+        """
+        self.gw_id = gw_id
+        self.encrypted = encrypted
+        self.config = config
+        self.triggers = triggers
+        self.source_address = source_address
+        self.durations: Dict[str, float] = {}
+        self._ssl_context = psk_client_context(gw_id) if config.psk_port else None
+
+    async def api(self, stage: str, action: str) -> Any:
+        """
+        Call a Tuya API action and return the (decrypted) result.
+
+        Args:
+                stage: Stage name used in errors
+                action: Value of the 'a' parameter
+
+        Raises:
+                StageError: If the request fails or the reply is not a success
+        """
+        config = self.config
+        now = int(time.time())
+        target = "/gw.json?a=%s&gwId=%s&et=%d&t=%d&v=4.4" % (
+            action,
+            self.gw_id,
+            self.encrypted,
+            now,
+        )
+        payload = json.dumps({"gwId": self.gw_id, "t": now})
+        body = b"data=" + binascii.hexlify(encrypt(payload, config.sec_key.encode()))
+        port = config.psk_port or config.http_port
+        try:
+            response = await http_request(
+                config.host,
+                port,
+                "POST",
+                target,
+                body,
+                self._ssl_context,
+                config.request_timeout,
+                self.source_address,
+            )
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            raise StageError(stage, "%s: %s" % (type(e).__name__, e))
+        if response.status != 200:
+            raise StageError(stage, "HTTP %d" % response.status)
+        try:
+            answer = json.loads(response.body)
+            if "sign" in answer:
+                # Encrypted reply: result is base64(AES(json answer))
+                clear = decrypt(base64.b64decode(answer["result"]), config.sec_key.encode())
+                answer = json.loads(clear)
+        except (ValueError, KeyError) as e:
+            raise StageError(stage, "bad reply: %s" % e)
+        if not answer.get("success"):
+            raise StageError(stage, "unsuccessful reply")
+        return answer.get("result")
+
+    async def run(self) -> Dict[str, float]:
+        """
+        Walk through the whole flow.
+
+        Returns:
+                Seconds spent in each stage
+
+        Raises:
+                StageError: At the first stage that fails
+        """
+        clock = time.perf_counter
+
+        started = clock()
+        await self.api("token", "s.gw.token.get")
+        self.durations["token"] = clock() - started
+
+        trigger = None
+        if self.config.wait_for_trigger:
+            assert self.triggers is not None
+            trigger = self.triggers.expect(self.gw_id)
+
+        started = clock()
+        result = await self.api("active", "s.gw.dev.pk.active")
+        if not isinstance(result, dict) or "schema" not in result:
+            raise StageError("active", "no schema in reply")
+        self.durations["active"] = clock() - started
+
+        if trigger is not None:
+            started = clock()
+            try:
+                payload = await asyncio.wait_for(trigger, self.config.trigger_timeout)
+                message = decode_trigger(payload, self.config.local_key)
+            except asyncio.TimeoutError:
+                raise StageError("trigger", "no trigger within %ss" % self.config.trigger_timeout)
+            except (ValueError, UnicodeDecodeError) as e:
+                raise StageError("trigger", "undecodable trigger: %s" % e)
+            if message.get("data", {}).get("gwId") != self.gw_id:
+                raise StageError("trigger", "trigger for another device")
+            self.durations["trigger"] = clock() - started
+
+        started = clock()
+        upgrade = await self.api("upgrade", "s.gw.upgrade.get")
+        if not isinstance(upgrade, dict) or not (upgrade.get("pskUrl") or upgrade.get("url")):
+            raise StageError("upgrade", "no firmware URL in reply")
+        url = upgrade.get("pskUrl") or upgrade["url"]
+        self.durations["upgrade"] = clock() - started
+
+        started = clock()
+        await self.download(url, upgrade)
+        self.durations["download"] = clock() - started
+        return self.durations
+
+    async def download(self, url: str, upgrade: Dict[str, Any]) -> None:
+        """
+        Download the firmware and verify it against the upgrade reply.
+
+        The URL names the server's public address; the download goes to the
+        configured host and HTTP port instead, keeping only the path. Like a
+        device, the download is retried when the server asks for it with 503
+        and Retry-After (per-IP download cap).
+
+        Raises:
+                StageError: If the download fails or the firmware does not verify
+        """
+        path = urlsplit(url).path
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                response = await http_request(
+                    self.config.host,
+                    self.config.http_port,
+                    "GET",
+                    path,
+                    timeout=self.config.request_timeout,
+                    source_address=self.source_address,
+                )
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                raise StageError("download", "%s: %s" % (type(e).__name__, e))
+            retry_after = response.headers.get("retry-after", "")
+            if response.status != 503 or not retry_after.isdigit():
+                break
+            if attempt < DOWNLOAD_RETRIES:
+                await asyncio.sleep(int(retry_after))
+        if response.status != 200:
+            raise StageError("download", "HTTP %d" % response.status)
+        firmware = response.body
+        size = upgrade.get("size", upgrade.get("fileSize"))
+        if size is not None and int(size) != len(firmware):
+            raise StageError("download", "size %d, expected %s" % (len(firmware), size))
+        if "md5" in upgrade and hashlib.md5(firmware).hexdigest() != upgrade["md5"]:
+            raise StageError("download", "MD5 mismatch")
+        if "hmac" in upgrade:
+            sha256 = hashlib.sha256(firmware).hexdigest().upper()
+            if firmware_hmac(sha256, self.config.sec_key) != upgrade["hmac"]:
+                raise StageError("download", "HMAC mismatch")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Return the nearest-rank percentile of a list of values.
+
+    Args:
+            values: Samples (need not be sorted)
+            fraction: Percentile as a fraction, e.g. 0.99
+
+    Returns:
+            The percentile, or 0.0 for an empty list
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+class FleetReport:
+    """
+    Latencies and failures of a fleet run.
+
+    Attributes:
+            devices: Number of simulated devices
+            completed: Number of devices that finished every stage
+            elapsed: Wall clock seconds of the whole run
+            durations: Seconds per stage, one sample per device that passed it
+            failures: Failure count per (stage, reason)
+    """
+
+    def __init__(self, devices: int) -> None:
+        """Create an empty report for a fleet of the given size."""
+        self.devices = devices
+        self.completed = 0
+        self.elapsed = 0.0
+        self.durations: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        self.failures: "Counter[tuple]" = Counter()
+
+    def add(self, durations: Dict[str, float], error: Optional[StageError]) -> None:
+        """Record the outcome of one device."""
+        for stage, seconds in durations.items():
+            self.durations[stage].append(seconds)
+        if error is None:
+            self.completed += 1
+        else:
+            self.failures[(error.stage, error.reason)] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the report as a JSON-serializable dict (latencies in ms)."""
+        stages = {}
+        for stage, values in self.durations.items():
+            stages[stage] = {
+                "count": len(values),
+                "failed": sum(n for (failed, _), n in self.failures.items() if failed == stage),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p90_ms": round(percentile(values, 0.90) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                "max_ms": round(max(values, default=0.0) * 1000, 3),
+            }
+        return {
+            "devices": self.devices,
+            "completed": self.completed,
+            "elapsed_s": round(self.elapsed, 3),
+            "devices_per_s": round(self.completed / self.elapsed, 3) if self.elapsed else 0.0,
+            "stages": stages,
+            "failures": [
+                {"stage": stage, "reason": reason, "count": count}
+                for (stage, reason), count in self.failures.most_common()
+            ],
+        }
+
+    def format(self) -> str:
+        """Return a human-readable summary table."""
+        data = self.to_dict()
+        lines = [
+            "%d/%d devices completed in %.1fs (%.1f devices/s)"
+            % (data["completed"], data["devices"], data["elapsed_s"], data["devices_per_s"]),
+            "%-9s %6s %6s %10s %10s %10s %10s"
+            % ("stage", "ok", "failed", "p50 ms", "p90 ms", "p99 ms", "max ms"),
+        ]
+        for stage, stats in data["stages"].items():
+            lines.append(
+                "%-9s %6d %6d %10.1f %10.1f %10.1f %10.1f"
+                % (
+                    stage,
+                    stats["count"],
+                    stats["failed"],
+                    stats["p50_ms"],
+                    stats["p90_ms"],
+                    stats["p99_ms"],
+                    stats["max_ms"],
+                )
+            )
+        for failure in data["failures"]:
+            lines.append("failed %(count)d x %(stage)s: %(reason)s" % failure)
+        return "\n".join(lines)
+
+
+async def run_fleet(
+    config: SimulatorConfig,
+    devices: int,
+    concurrency: int = 100,
+    encrypted_ratio: float = 0.5,
+    seed: Optional[int] = None,
+) -> FleetReport:
+    """
+    Run a fleet of virtual devices and collect their stage latencies.
+
+    Args:
+            config: Where the devices connect to
+            devices: Number of devices to simulate
+            concurrency: Maximum number of devices in flight at once
+            encrypted_ratio: Fraction of devices using protocol 2.2
+            seed: Random seed for reproducible gwIds and protocol mix
+
+    Returns:
+            The collected report
+    """
+    rng = random.Random(seed)
+    run_id = rng.randrange(100000)
+    report = FleetReport(devices)
+    triggers = None
+    if config.wait_for_trigger:
+        triggers = TriggerListener(config.broker, config.mqtt_port)
+        await triggers.start()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def simulate(index: int) -> None:
+        gw_id = "sim%05d%012d" % (run_id, index)
+        source = None
+        if config.loopback_sources:
+            host = index + 1
+            source = "127.%d.%d.%d" % (host >> 16 & 0xFF, host >> 8 & 0xFF, host & 0xFF)
+        device = VirtualDevice(gw_id, rng.random() < encrypted_ratio, config, triggers, source)
+        async with semaphore:
+            try:
+                await device.run()
+                report.add(device.durations, None)
+            except StageError as e:
+                report.add(device.durations, e)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(simulate(index) for index in range(devices)))
+    finally:
+        report.elapsed = time.perf_counter() - started
+        if triggers is not None:
+            triggers.stop()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point.
+
+    Args:
+            argv: Arguments without the program name (default: sys.argv[1:])
+
+    Returns:
+            0 if every device completed the flow, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(description="Simulate a fleet of Tuya devices being flashed")
+    parser.add_argument("--host", default="127.0.0.1", help="server address")
+    parser.add_argument("--port", type=int, default=80, help="fake registration server port")
+    parser.add_argument("--psk-port", type=int, default=0, help="TLS-PSK frontend port (0: off)")
+    parser.add_argument("--broker", default=DEFAULT_BROKER, help="MQTT broker address")
+    parser.add_argument("--mqtt-port", type=int, default=MQTT_PORT, help="MQTT broker port")
+    parser.add_argument("--sec-key", default=DEFAULT_SEC_KEY, help="server secKey")
+    parser.add_argument("--local-key", default=DEFAULT_LOCAL_KEY, help="trigger localKey")
+    parser.add_argument("--devices", type=int, default=100, help="number of devices")
+    parser.add_argument("--concurrency", type=int, default=100, help="devices in flight")
+    parser.add_argument(
+        "--encrypted-ratio", type=float, default=0.5, help="fraction of protocol 2.2 devices"
+    )
+    parser.add_argument("--no-trigger", action="store_true", help="skip the MQTT trigger stage")
+    parser.add_argument("--trigger-timeout", type=float, default=30.0, help="seconds")
+    parser.add_argument("--timeout", type=float, default=10.0, help="HTTP timeout in seconds")
+    parser.add_argument(
+        "--loopback-sources",
+        action="store_true",
+        help="connect every device from its own 127.x.y.z address (Linux)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    config = SimulatorConfig(
+        host=args.host,
+        http_port=args.port,
+        psk_port=args.psk_port,
+        broker=args.broker,
+        mqtt_port=args.mqtt_port,
+        sec_key=args.sec_key,
+        local_key=args.local_key,
+        wait_for_trigger=not args.no_trigger,
+        trigger_timeout=args.trigger_timeout,
+        request_timeout=args.timeout,
+        loopback_sources=args.loopback_sources,
+    )
+    try:
+        report = asyncio.run(
+            run_fleet(config, args.devices, args.concurrency, args.encrypted_ratio, args.seed)
+        )
+    except (OSError, asyncio.TimeoutError) as e:
+        print("Could not reach the MQTT broker: %s" % (e or "timeout"), file=sys.stderr)
+        return 1
+    print(report.format())
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report.to_dict(), file, indent=2)
+    return 0 if report.completed == report.devices else 1
+
+
+__all__ = [
+    "FleetReport",
+    "SimulatorConfig",
+    "StageError",
+    "TriggerListener",
+    "VirtualDevice",
+    "decode_trigger",
+    "http_request",
+    "percentile",
+    "run_fleet",
+]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
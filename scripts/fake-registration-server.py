@@ -33,7 +33,7 @@ Protocol Flow Diagram:
         │◀─────────────────────────────────────│
         │  {schema, secKey, localKey, ...}    │
         │                                      │
-        │  [mq_pub_15.py triggered]           │
+        │  [upgrade trigger via MQTT]         │
         │                                      │
         │  s.gw.upgrade.get (2.2) or          │
         │  s.gw.upgrade (2.1)                 │
@@ -121,9 +121,14 @@ Created by nano on 2018-11-22.
 Copyright (c) 2018 VTRUST. All rights reserved.
 """
 
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 
+import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
 import tornado.locks
+import tornado.netutil
+import tornado.process
 import tornado.web
 from tornado.options import define, options, parse_command_line
 
@@ -131,11 +136,19 @@ define("port", default=80, help="run on the given port", type=int)
 define("addr", default="10.42.42.1", help="run on the given ip", type=str)
 define("debug", default=True, help="run in debug mode")
 define("secKey", default="0000000000000000", help="key used for encrypted communication")
+define("plugins", default="", help="comma-separated modules registering extra actions")
+define("maxSessions", default=4096, help="maximum number of device sessions kept", type=int)
+define("sessionTTL", default=3600, help="seconds before an idle device session expires", type=int)
+define("sessionSnapshot", default="", help="file to persist device sessions in (disabled if empty)")
+define("logLevel", default="debug", help="console/log verbosity: debug, info, warning or error")
+define("logFile", default="", help="JSONL file for structured request logs (disabled if empty)")
+define("logMaxBytes", default=10 * 1024 * 1024, help="size at which logFile is rotated", type=int)
+define("workers", default=1, help="number of server processes (0: one per CPU core)", type=int)
+define("sessionDb", default="", help="SQLite file for device sessions shared between workers")
 
 import os
 import signal
 import subprocess
-import threading
 from types import FrameType
 
 
@@ -148,19 +161,44 @@ def exit_cleanly(signum: int, frame: Optional[FrameType]) -> None:
             frame: Current stack frame at the time of signal
     """
     print("Received SIGINT, exiting...")
+    # Triggers cancelled here must not block activations after a restart
+    for gw_id in upgrade_scheduler.pending():
+        release_upgrade_claim(gw_id, None)
+    JSONHandler.sessions.save()
+    upgrade_scheduler.close()
+    event_log.close()
     exit(0)
 
 
-signal.signal(signal.SIGINT, exit_cleanly)
-
+import asyncio
 import binascii
 import hashlib
-import hmac
 import json
 from base64 import b64encode
 
 # Import shared cryptographic utilities
+from action_registry import ActionRegistry, ActionRequest
 from crypto_utils import decrypt, encrypt
+from firmware_catalog import (
+    INDEX_FILE_NAME,
+    FirmwareCatalog,
+    FirmwareImage,
+    firmware_hmac,
+    hash_file,
+)
+from response_cache import ResponseCache
+from server_metrics import MetricsRegistry, WorkerSnapshots
+from session_store import (
+    UPGRADE_OFFERED,
+    UPGRADE_REPORTED,
+    UPGRADE_SCHEDULED,
+    UPGRADE_TRIGGERED,
+    DeviceSession,
+    SessionStore,
+    SqliteSessionStore,
+)
+from structured_log import DEBUG, INFO, WARNING, StructuredLog, parse_level
+from upgrade_scheduler import UpgradeScheduler
 
 
 def jsonstr(j: Union[Dict, list, Any]) -> str:
@@ -190,13 +228,78 @@ def file_as_bytes(file_name: str) -> bytes:
         return file.read()
 
 
+# Directory holding the firmware images and the image offered as upgrade
+FIRMWARE_DIR = "../files/"
+UPGRADE_IMAGE = "upgrade.bin"
+
+# Digest index of the firmware catalog; kept next to the logs, outside the
+# served files directory, which may also be read-only
+FIRMWARE_INDEX = INDEX_FILE_NAME
+
+# How often the firmware directory is checked for changed images
+FIRMWARE_WATCH_INTERVAL_MS = 2000
+
+# Concurrent file downloads allowed per client IP; further requests get 503
+MAX_DOWNLOADS_PER_IP = 2
+DOWNLOAD_RETRY_AFTER = 5  # seconds, sent in the Retry-After header of the 503
+
+# Digest index of every image in FIRMWARE_DIR, created in main()
+firmware_catalog: Optional[FirmwareCatalog] = None
+
 # Global variables storing firmware file metadata
-# These are calculated once at startup and used for upgrade responses
+# These are kept in sync with the catalog entry of UPGRADE_IMAGE and used for upgrade responses
 file_md5: str = ""  # MD5 hash of the firmware file
 file_sha256: str = ""  # SHA256 hash of the firmware file
 file_hmac: str = ""  # HMAC signature of the SHA256 hash
 file_len: str = ""  # Size of the firmware file in bytes
 
+# Pre-rendered reply templates, invalidated whenever the firmware file is rehashed
+response_cache = ResponseCache()
+
+# Request logging; records are written by a background thread so a slow
+# console or disk never blocks the IOLoop
+event_log = StructuredLog()
+
+
+def release_upgrade_claim(gw_id: str, status: Optional[str] = UPGRADE_TRIGGERED) -> None:
+    """
+    Release the scheduled upgrade trigger of a device, so a later activation
+    may schedule a new one.
+
+    Args:
+            gw_id: Gateway ID of the device
+            status: New upgrade status (default: the trigger was sent)
+    """
+
+    def release(session: DeviceSession) -> None:
+        if session.upgrade_status == UPGRADE_SCHEDULED:
+            session.upgrade_status = status
+
+    JSONHandler.sessions.update(gw_id, release)
+
+
+# Publishes the MQTT upgrade trigger some seconds after a device was activated
+upgrade_scheduler = UpgradeScheduler(log=event_log, on_fired=release_upgrade_claim)
+
+# Instrumentation served on /metrics; recorded values are plain dict updates
+metrics = MetricsRegistry()
+request_counter = metrics.counter("tuya_requests_total", "API requests by action", ("action",))
+request_latency = metrics.histogram(
+    "tuya_request_duration_seconds",
+    "Time spent per request phase (decrypt, handler, reply) by action",
+    ("phase", "action"),
+)
+decrypt_failures = metrics.counter(
+    "tuya_decrypt_failures_total", "Request payloads that could not be decrypted"
+)
+firmware_bytes = metrics.counter("tuya_firmware_bytes_total", "Firmware bytes sent with sendfile")
+firmware_downloads = metrics.counter(
+    "tuya_firmware_downloads_total", "Completed firmware downloads (including ranges)"
+)
+
+# With --workers, the snapshot files through which /metrics covers all workers
+worker_metrics: Optional[WorkerSnapshots] = None
+
 
 def get_file_stats(file_name: str) -> None:
     """
@@ -211,21 +314,102 @@ def get_file_stats(file_name: str) -> None:
 
     Side Effects:
             Updates global variables: file_md5, file_sha256, file_hmac, file_len
+            Invalidates the reply template cache
     """
     global file_md5
     global file_sha256
     global file_hmac
     global file_len
-    file = file_as_bytes(file_name)
-    file_md5 = hashlib.md5(file).hexdigest()
-    file_sha256 = hashlib.sha256(file).hexdigest().upper()
-    file_hmac = (
-        hmac.HMAC(options.secKey.encode(), file_sha256.encode(), "sha256").hexdigest().upper()
-    )
+    digests = hash_file(file_name)
+    file_md5 = digests.md5
+    file_sha256 = digests.sha256
+    file_hmac = firmware_hmac(file_sha256, options.secKey)
     file_len = str(os.path.getsize(file_name))
+    response_cache.invalidate()
+
+
+def use_firmware_image(image: FirmwareImage) -> None:
+    """
+    Offer a catalog image as the upgrade firmware.
+
+    Copies the precomputed digests of the image into the global firmware
+    metadata without reading the file again.
+
+    Args:
+            image: Catalog entry of the image to offer
+
+    Side Effects:
+            Updates global variables: file_md5, file_sha256, file_hmac, file_len
+            Invalidates the reply template cache
+    """
+    global file_md5
+    global file_sha256
+    global file_hmac
+    global file_len
+    file_md5 = image.md5
+    file_sha256 = image.sha256
+    file_hmac = image.hmac
+    file_len = str(image.size)
+    response_cache.invalidate()
+
 
+async def refresh_firmware_catalog() -> None:
+    """Poll the firmware directory for changed images (PeriodicCallback target)."""
+    if firmware_catalog is not None:
+        await firmware_catalog.poll()
 
-from time import time
+
+def log_firmware_error(message: str) -> None:
+    """Report a firmware catalog error through the structured log."""
+    event_log.warning("firmware", message)
+
+
+def on_firmware_change(name: str, image: Optional[FirmwareImage]) -> None:
+    """
+    Catalog listener that follows changes of the upgrade image.
+
+    Args:
+            name: File name of the added, changed or removed image
+            image: New catalog entry, or None if the image was removed
+    """
+    if name != UPGRADE_IMAGE:
+        return
+    if image is None:
+        print("WARNING: firmware image %s was removed" % name)
+        return
+    print("Firmware image %s changed, md5 %s" % (name, image.md5))
+    use_firmware_image(image)
+
+
+def current_image(abspath: str) -> Optional[FirmwareImage]:
+    """
+    Return the catalog entry of a file if it is an indexed, unchanged image.
+
+    The catalog is only polled every FIRMWARE_WATCH_INTERVAL_MS, so the entry
+    is checked against the file's current size and mtime before its digests
+    are trusted.
+
+    Args:
+            abspath: Absolute path of the requested file
+
+    Returns:
+            The catalog entry, or None if the file is not (or no longer) indexed
+    """
+    if firmware_catalog is None:
+        return None
+    image = firmware_catalog.get(os.path.basename(abspath))
+    if image is None or os.path.abspath(image.path) != abspath:
+        return None
+    try:
+        stat = os.stat(abspath)
+    except OSError:
+        return None
+    if stat.st_size != image.size or stat.st_mtime_ns != image.mtime_ns:
+        return None
+    return image
+
+
+from time import perf_counter, time
 
 
 def timestamp() -> int:
@@ -244,8 +428,36 @@ class FilesHandler(tornado.web.StaticFileHandler):
 
     This handler serves files from the ../files/ directory and automatically serves
     index.html when the URL path is empty or ends with a slash.
+
+    Firmware images known to the catalog are sent with os.sendfile() instead of
+    being copied through Python in chunks. Tornado still handles the request
+    headers, so Range requests (resuming downloads), If-None-Match and HEAD
+    behave as for any static file. The ETag of an image is its catalog MD5,
+    which saves hashing the file on every request.
+
+    Attributes:
+            downloads: Number of running downloads per client IP
+            sendfile_image: Catalog entry of the image being sent with sendfile
+            sendfile_range: (start, end) of the body Tornado asked for, if sendfile is used
     """
 
+    downloads: Dict[str, int] = {}
+    sendfile_image: Optional[FirmwareImage] = None
+    sendfile_range: Optional[Tuple[Optional[int], Optional[int]]] = None
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        """
+        Refuse hidden files (e.g. a catalog index or partial uploads) with 404.
+
+        Args:
+                root: Files directory
+                absolute_path: Requested file
+        """
+        relative = os.path.relpath(absolute_path, root)
+        if any(part.startswith(".") and part != "." for part in relative.split(os.sep)):
+            raise tornado.web.HTTPError(404)
+        return super().validate_absolute_path(root, absolute_path)
+
     def parse_url_path(self, url_path: str) -> str:
         """
         Parse and modify the URL path to add index.html for directory requests.
@@ -260,6 +472,111 @@ class FilesHandler(tornado.web.StaticFileHandler):
             url_path = url_path + str("index.html")
         return url_path
 
+    @classmethod
+    def get_content_version(cls, abspath: str) -> str:
+        """
+        Return the ETag version of a file, from the catalog if it is an image.
+
+        Args:
+                abspath: Absolute path of the file
+        """
+        image = current_image(abspath)
+        if image is not None:
+            return image.md5
+        return tornado.web.StaticFileHandler.get_content_version(abspath)
+
+    def get_content(  # type: ignore[override]
+        self, abspath: str, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Any:
+        """
+        Return the body of a file, or nothing if it will be sent with sendfile.
+
+        Args:
+                abspath: Absolute path of the file
+                start: First byte to send (None for the beginning)
+                end: Byte after the last one to send (None for the end)
+        """
+        if self.sendfile_image is not None:
+            self.sendfile_range = (start, end)
+            return []
+        return tornado.web.StaticFileHandler.get_content(abspath, start, end)
+
+    async def get(self, path: str, include_body: bool = True) -> None:
+        """
+        Serve a file, limiting concurrent downloads per client IP.
+
+        Args:
+                path: Requested path below the files directory
+                include_body: False for HEAD requests
+        """
+        client = str(self.request.remote_ip)
+        running = self.downloads.get(client, 0)
+        if running >= MAX_DOWNLOADS_PER_IP:
+            self.set_status(503)
+            self.set_header("Retry-After", str(DOWNLOAD_RETRY_AFTER))
+            return
+        self.downloads[client] = running + 1
+        try:
+            abspath = self.get_absolute_path(self.root, self.parse_url_path(path))
+            image = current_image(abspath) if include_body else None
+            if image is not None:
+                # The connection is handed over to sendfile and closed afterwards
+                self.sendfile_image = image
+                self.set_header("Connection", "close")
+            await super().get(path, include_body)
+            if image is not None and self.sendfile_range is not None:
+                await self.send_image(image.path, *self.sendfile_range)
+        finally:
+            running = self.downloads[client] - 1
+            if running:
+                self.downloads[client] = running
+            else:
+                del self.downloads[client]
+
+    async def send_image(self, path: str, start: Optional[int], end: Optional[int]) -> None:
+        """
+        Send the headers, then the body of an image with os.sendfile().
+
+        Args:
+                path: Image file
+                start: First byte to send (None for the beginning)
+                end: Byte after the last one to send (None for the end)
+        """
+        try:
+            file = open(path, "rb")
+        except OSError:
+            # Removed since the catalog check; nothing has been sent yet
+            self.send_error(404)
+            return
+        with file:
+            offset = start or 0
+            count = (end if end is not None else os.fstat(file.fileno()).st_size) - offset
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+            stream = self.detach()
+            # Take the socket away from the IOStream, asyncio waits for writability itself
+            stream.io_loop.remove_handler(stream.fileno())
+            try:
+                sent = await asyncio.get_running_loop().sock_sendfile(
+                    stream.socket, file, offset, count
+                )
+                firmware_bytes.inc((), sent)
+                firmware_downloads.inc()
+                event_log.log(
+                    INFO,
+                    "download",
+                    "sent %s bytes %d-%d" % (path, offset, offset + sent - 1),
+                    path=path,
+                    offset=offset,
+                    sent=sent,
+                )
+            except OSError as e:
+                event_log.log(WARNING, "download", f"Download of {path} aborted: {e}", path=path)
+            finally:
+                stream.close()
+
 
 class MainHandler(tornado.web.RequestHandler):
     """
@@ -275,6 +592,22 @@ class MainHandler(tornado.web.RequestHandler):
         self.write("You are connected to vtrust-flash")
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Handler exposing the server metrics for Prometheus, or as JSON with ?format=json.
+    """
+
+    def get(self) -> None:
+        """Write all metrics in the Prometheus text format or as a JSON snapshot."""
+        registry = metrics if worker_metrics is None else worker_metrics.merged(metrics)
+        if self.get_argument("format", "") == "json":
+            self.set_header("Content-Type", "application/json;charset=UTF-8")
+            self.write(jsonstr(registry.snapshot()))
+        else:
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(registry.render())
+
+
 class JSONHandler(tornado.web.RequestHandler):
     """
     Main request handler for Tuya API endpoints.
@@ -284,11 +617,15 @@ class JSONHandler(tornado.web.RequestHandler):
     communication modes.
 
     Attributes:
-            activated_ids: Dictionary tracking which gateway IDs have been activated to
-                          determine schema complexity in responses
+            sessions: Per-device state keyed by gwId, used among other things to
+                      determine schema complexity in responses
+            request_id: Id tagging the log records of the current request
+            reply_seconds: Time spent rendering and writing replies of the current request
     """
 
-    activated_ids: Dict[str, bool] = {}
+    sessions = SessionStore()
+    request_id = 0
+    reply_seconds = 0.0
 
     def get(self) -> None:
         """
@@ -300,7 +637,11 @@ class JSONHandler(tornado.web.RequestHandler):
         self.post()
 
     def reply(
-        self, result: Optional[Union[Dict, bool, Any]] = None, encrypted: bool = False
+        self,
+        result: Optional[Union[Dict, bool, Any]] = None,
+        encrypted: bool = False,
+        template: Optional[str] = None,
+        dynamic: Sequence[str] = (),
     ) -> None:
         """
         Send a JSON response to the device with optional encryption.
@@ -309,31 +650,64 @@ class JSONHandler(tornado.web.RequestHandler):
         signed with MD5. For unencrypted responses (protocol 2.1), the result is
         returned in plain JSON.
 
+        When a template name is given, the reply is rendered from the response
+        cache: the static part of the answer is serialized, encrypted and hashed
+        once, and only the timestamp and the dynamic keys are filled in per request.
+
         Args:
                 result: Response data to send (dict, bool, or None)
                 encrypted: Whether to use encrypted protocol (2.2) or plain (2.1)
+                template: Cache key for answers whose static content never changes
+                dynamic: Top-level result keys that vary per request (template only)
 
         Side Effects:
                 Sends HTTP response with appropriate headers and JSON body
         """
+        started = perf_counter()
         ts = timestamp()
-        if encrypted:
+        if template is not None:
+            answer_json = response_cache.render(
+                template, result, encrypted, options.secKey, ts, dynamic
+            )
+        elif encrypted:
             answer_dict = {"result": result, "t": ts, "success": True}
             answer_json = jsonstr(answer_dict)
             payload = b64encode(encrypt(answer_json, options.secKey.encode())).decode()
             signature = "result=%s||t=%d||%s" % (payload, ts, options.secKey)
             signature = hashlib.md5(signature.encode()).hexdigest()[8:24]
-            answer = {"result": payload, "t": ts, "sign": signature}
+            answer_json = jsonstr({"result": payload, "t": ts, "sign": signature})
         else:
-            answer = {"t": ts, "e": False, "success": True}
+            answer: Dict[str, Any] = {"t": ts, "e": False, "success": True}
             if result:
                 answer["result"] = result
-        answer_json = jsonstr(answer)
+            answer_json = jsonstr(answer)
+        self.send_answer(answer_json)
+        self.reply_seconds += perf_counter() - started
+
+    def send_answer(self, answer_json: str) -> None:
+        """
+        Write a rendered JSON reply with the headers Tuya devices expect.
+
+        Args:
+                answer_json: Complete JSON reply body
+        """
         self.set_header("Content-Type", "application/json;charset=UTF-8")
         self.set_header("Content-Length", str(len(answer_json)))
         self.set_header("Content-Language", "zh-CN")
         self.write(answer_json)
-        print("reply", answer_json)
+        self.log_event(INFO, "reply", "reply " + answer_json)
+
+    def log_event(self, level: int, event: str, message: str, **fields: Any) -> None:
+        """
+        Queue a log record tagged with the id of the current request.
+
+        Args:
+                level: Verbosity level, e.g. INFO
+                event: Short machine-readable event name
+                message: Human-readable text echoed to the console
+                fields: Additional data for the JSONL log
+        """
+        event_log.log(level, event, message, self.request_id, **fields)
 
     def post(self) -> None:
         """
@@ -348,8 +722,8 @@ class JSONHandler(tornado.web.RequestHandler):
         - Dynamic configuration (.config.get)
 
         The method extracts request parameters, attempts to decrypt the payload if
-        encrypted, and routes to the appropriate response handler based on the 'a'
-        (action) parameter.
+        encrypted, and dispatches to the answer_* method registered for the 'a'
+        (action) parameter in action_registry.
 
         Request Parameters:
                 a: API action/endpoint being called
@@ -357,8 +731,8 @@ class JSONHandler(tornado.web.RequestHandler):
                 gwId: Gateway device ID
 
         Side Effects:
-                - Prints request details and payload to console
-                - Triggers firmware upgrade via mq_pub_15.py after activation
+                - Logs request details and payload (console and optional JSONL file)
+                - Schedules the MQTT firmware upgrade trigger after activation
                 - Kills smartconfig process after token retrieval
         """
         uri = str(self.request.uri)
@@ -366,142 +740,336 @@ class JSONHandler(tornado.web.RequestHandler):
         encrypted = str(self.get_argument("et", 0)) == "1"
         gwId = str(self.get_argument("gwId", 0))
         payload = self.request.body[5:]
-        answer: Optional[Union[Dict, bool]] = None
-        print()
-        print(self.request.method, uri)
-        print(self.request.headers)
+        self.request_id = event_log.new_request_id()
+        self.reply_seconds = 0.0
+        request_counter.inc((a,))
+        self.log_event(
+            INFO,
+            "request",
+            "\n%s %s" % (self.request.method, uri),
+            method=self.request.method,
+            uri=uri,
+            action=a,
+            gwId=gwId,
+            encrypted=encrypted,
+        )
+        if event_log.is_enabled(DEBUG):
+            headers = self.request.headers
+            self.log_event(DEBUG, "headers", str(headers), headers=dict(headers))
         if payload:
             try:
+                started = perf_counter()
                 decrypted_payload = decrypt(binascii.unhexlify(payload), options.secKey.encode())
+                request_latency.observe(("decrypt", a), perf_counter() - started)
                 if decrypted_payload[0] != "{":
                     raise ValueError("payload is not JSON")
-                print("payload", decrypted_payload)
+                self.log_event(
+                    DEBUG, "payload", "payload " + decrypted_payload, payload=decrypted_payload
+                )
             except (binascii.Error, ValueError, UnicodeDecodeError) as e:
                 # Failed to decrypt or decode payload - log error and display raw payload
-                print(f"Failed to decrypt payload: {e}")
-                print("payload", payload.decode())
+                raw_payload = payload.decode()
+                decrypt_failures.inc()
+                self.log_event(WARNING, "decrypt_failed", f"Failed to decrypt payload: {e}")
+                self.log_event(DEBUG, "payload", "payload " + raw_payload, payload=raw_payload)
 
         if gwId == "0":
-            print(
-                "WARNING: it appears this device does not use an ESP82xx and therefore cannot install ESP based firmware"
+            self.log_event(
+                WARNING,
+                "non_esp",
+                "WARNING: it appears this device does not use an ESP82xx and therefore cannot install ESP based firmware",
             )
 
-        # Activation endpoints
-        if a == "s.gw.token.get":
-            print("Answer s.gw.token.get")
-            answer = {
-                "gwApiUrl": "http://" + options.addr + "/gw.json",
-                "stdTimeZone": "-05:00",
-                "mqttRanges": "",
-                "timeZone": "-05:00",
-                "httpsPSKUrl": "https://" + options.addr + "/gw.json",
-                "mediaMqttUrl": options.addr,
-                "gwMqttUrl": options.addr,
-                "dstIntervals": [],
-            }
-            if encrypted:
-                answer["mqttsUrl"] = options.addr
-                answer["mqttsPSKUrl"] = options.addr
-                answer["mediaMqttsUrl"] = options.addr
-                answer["aispeech"] = options.addr
-            self.reply(answer)
-            # Kill smartconfig process using subprocess (safer than os.system)
-            subprocess.run(["pkill", "-f", "smartconfig/main.py"], check=False)
-
-        elif ".active" in a:
-            print("Answer s.gw.dev.pk.active")
+        self.sessions.touch(gwId, a, encrypted, self.get_argument("v", None))
+        started = perf_counter()
+        action_registry.dispatch(self, ActionRequest(a, encrypted, gwId))
+        elapsed = perf_counter() - started
+        # Handler time excludes the reply, which is recorded on its own
+        request_latency.observe(("handler", a), elapsed - self.reply_seconds)
+        if self.reply_seconds:
+            request_latency.observe(("reply", a), self.reply_seconds)
+
+    def set_upgrade_status(self, request: ActionRequest, status: str) -> None:
+        """
+        Record the upgrade progress of the requesting device.
+
+        Args:
+                request: Parsed request parameters
+                status: One of the session_store UPGRADE_* values
+        """
+
+        def record(session: DeviceSession) -> None:
+            session.upgrade_status = status
+
+        self.sessions.update(request.gw_id, record)
+
+    # Activation endpoints
+
+    def answer_token_get(self, request: ActionRequest) -> None:
+        """Answer s.gw.token.get with the fake cloud URLs and stop smartconfig."""
+        self.log_event(INFO, "answer", "Answer s.gw.token.get")
+        answer = {
+            "gwApiUrl": "http://" + options.addr + "/gw.json",
+            "stdTimeZone": "-05:00",
+            "mqttRanges": "",
+            "timeZone": "-05:00",
+            "httpsPSKUrl": "https://" + options.addr + "/gw.json",
+            "mediaMqttUrl": options.addr,
+            "gwMqttUrl": options.addr,
+            "dstIntervals": [],
+        }
+        if request.encrypted:
+            answer["mqttsUrl"] = options.addr
+            answer["mqttsPSKUrl"] = options.addr
+            answer["mediaMqttsUrl"] = options.addr
+            answer["aispeech"] = options.addr
+        self.reply(answer, template="s.gw.token.get:%d" % request.encrypted)
+        # Kill smartconfig process using subprocess (safer than os.system)
+        subprocess.run(["pkill", "-f", "smartconfig/main.py"], check=False)
+
+    def answer_active(self, request: ActionRequest) -> None:
+        """Answer *.active with a device schema and schedule the upgrade trigger."""
+        gwId = request.gw_id
+        self.log_event(INFO, "answer", "Answer s.gw.dev.pk.active")
+
+        def claim(session: DeviceSession) -> Tuple[int, bool]:
             # first try extended schema, otherwise minimal schema
-            schema_key_count = 1 if gwId in self.activated_ids else 20
-            # record that this gwId has been seen
-            self.activated_ids[gwId] = True
-            schema = jsonstr(
-                [{"mode": "rw", "property": {"type": "bool"}, "id": 1, "type": "obj"}]
-                * schema_key_count
+            schema_key_count = 20 if session.schema_variant is None else 1
+            session.schema_variant = schema_key_count
+            # Only the worker moving the device to UPGRADE_SCHEDULED sends a trigger
+            if session.upgrade_status == UPGRADE_SCHEDULED:
+                return schema_key_count, False
+            session.upgrade_status = UPGRADE_SCHEDULED
+            return schema_key_count, True
+
+        # One transaction, so concurrent workers see each other's claims
+        schema_key_count, claimed = self.sessions.update(gwId, claim)
+        schema = jsonstr(
+            [{"mode": "rw", "property": {"type": "bool"}, "id": 1, "type": "obj"}]
+            * schema_key_count
+        )
+        answer = {
+            "schema": schema,
+            "uid": "00000000000000000000",
+            "devEtag": "0000000000",
+            "secKey": options.secKey,
+            "schemaId": "0000000000",
+            "localKey": "0000000000000000",
+        }
+        self.reply(answer, template="s.gw.dev.pk.active:%d" % schema_key_count)
+        protocol = "2.2" if request.encrypted else "2.1"
+        # One pending trigger per device, fired from the IOLoop of the claiming
+        # worker; release_upgrade_claim() allows a new one once it was sent
+        if claimed and upgrade_scheduler.schedule(gwId, protocol):
+            self.log_event(
+                INFO,
+                "upgrade_scheduled",
+                "TRIGGER UPGRADE IN %d SECONDS" % upgrade_scheduler.delay,
+                delay=upgrade_scheduler.delay,
             )
-            answer = {
-                "schema": schema,
-                "uid": "00000000000000000000",
-                "devEtag": "0000000000",
-                "secKey": options.secKey,
-                "schemaId": "0000000000",
-                "localKey": "0000000000000000",
-            }
-            self.reply(answer)
-            print("TRIGGER UPGRADE IN 10 SECONDS")
-            protocol = "2.2" if encrypted else "2.1"
-
-            # Use threading and subprocess for safe background execution
-            # This prevents shell injection attacks via gwId parameter
-            def trigger_upgrade():
-                import time
-
-                time.sleep(10)
-                subprocess.run(["./mq_pub_15.py", "-i", gwId, "-p", protocol], check=False)
-
-            upgrade_thread = threading.Thread(target=trigger_upgrade, daemon=True)
-            upgrade_thread.start()
-
-        # Upgrade endpoints
-        elif ".updatestatus" in a:
-            print("Answer s.gw.upgrade.updatestatus")
-            self.reply(None, encrypted)
-
-        elif (".upgrade" in a) and encrypted:
-            print("Answer s.gw.upgrade.get")
-            answer = {
-                "auto": 3,
-                "size": file_len,
-                "type": 0,
-                "pskUrl": "http://" + options.addr + "/files/upgrade.bin",
-                "hmac": file_hmac,
-                "version": "9.0.0",
-            }
-            self.reply(answer, encrypted)
-
-        elif ".device.upgrade" in a:
-            print("Answer tuya.device.upgrade.get")
-            answer = {
-                "auto": True,
-                "type": 0,
-                "size": file_len,
-                "version": "9.0.0",
-                "url": "http://" + options.addr + "/files/upgrade.bin",
-                "md5": file_md5,
-            }
-            self.reply(answer, encrypted)
-
-        elif ".upgrade" in a:
-            print("Answer s.gw.upgrade")
-            answer = {
-                "auto": 3,
-                "fileSize": file_len,
-                "etag": "0000000000",
-                "version": "9.0.0",
-                "url": "http://" + options.addr + "/files/upgrade.bin",
-                "md5": file_md5,
-            }
-            self.reply(answer, encrypted)
-
-        # Misc endpoints
-        elif ".log" in a:
-            print("Answer atop.online.debug.log")
-            answer = True
-            self.reply(answer, encrypted)
-
-        elif ".timer" in a:
-            print("Answer s.gw.dev.timer.count")
-            answer = {"devId": gwId, "count": 0, "lastFetchTime": 0}
-            self.reply(answer, encrypted)
-
-        elif ".config.get" in a:
-            print("Answer tuya.device.dynamic.config.get")
-            answer = {"validTime": 1800, "time": timestamp(), "config": {}}
-            self.reply(answer, encrypted)
-
-        # Catchall
-        else:
-            print("Answer generic ({})".format(a))
-            self.reply(None, encrypted)
+
+    # Upgrade endpoints
+
+    def answer_upgrade_status(self, request: ActionRequest) -> None:
+        """Answer s.gw.upgrade.updatestatus."""
+        self.log_event(INFO, "answer", "Answer s.gw.upgrade.updatestatus")
+        self.set_upgrade_status(request, UPGRADE_REPORTED)
+        self.reply(None, request.encrypted, template="s.gw.upgrade.updatestatus")
+
+    def answer_encrypted_upgrade(self, request: ActionRequest) -> None:
+        """Answer any *.upgrade action of an encrypted (protocol 2.2) device."""
+        self.log_event(INFO, "answer", "Answer s.gw.upgrade.get")
+        self.set_upgrade_status(request, UPGRADE_OFFERED)
+        answer = {
+            "auto": 3,
+            "size": file_len,
+            "type": 0,
+            "pskUrl": "http://" + options.addr + "/files/upgrade.bin",
+            "hmac": file_hmac,
+            "version": "9.0.0",
+        }
+        self.reply(answer, request.encrypted, template="s.gw.upgrade.get")
+
+    def answer_device_upgrade(self, request: ActionRequest) -> None:
+        """Answer tuya.device.upgrade.get with the upgrade URL and MD5."""
+        if request.encrypted:
+            self.answer_encrypted_upgrade(request)
+            return
+        self.log_event(INFO, "answer", "Answer tuya.device.upgrade.get")
+        self.set_upgrade_status(request, UPGRADE_OFFERED)
+        answer = {
+            "auto": True,
+            "type": 0,
+            "size": file_len,
+            "version": "9.0.0",
+            "url": "http://" + options.addr + "/files/upgrade.bin",
+            "md5": file_md5,
+        }
+        self.reply(answer, request.encrypted, template="tuya.device.upgrade.get")
+
+    def answer_gw_upgrade(self, request: ActionRequest) -> None:
+        """Answer s.gw.upgrade / s.gw.upgrade.get with the upgrade URL and MD5."""
+        if request.encrypted:
+            self.answer_encrypted_upgrade(request)
+            return
+        self.log_event(INFO, "answer", "Answer s.gw.upgrade")
+        self.set_upgrade_status(request, UPGRADE_OFFERED)
+        answer = {
+            "auto": 3,
+            "fileSize": file_len,
+            "etag": "0000000000",
+            "version": "9.0.0",
+            "url": "http://" + options.addr + "/files/upgrade.bin",
+            "md5": file_md5,
+        }
+        self.reply(answer, request.encrypted, template="s.gw.upgrade")
+
+    # Misc endpoints
+
+    def answer_log(self, request: ActionRequest) -> None:
+        """Answer atop.online.debug.log."""
+        self.log_event(INFO, "answer", "Answer atop.online.debug.log")
+        self.reply(True, request.encrypted, template="atop.online.debug.log")
+
+    def answer_timer(self, request: ActionRequest) -> None:
+        """Answer s.gw.dev.timer.count with an empty timer list."""
+        self.log_event(INFO, "answer", "Answer s.gw.dev.timer.count")
+        answer = {"devId": request.gw_id, "count": 0, "lastFetchTime": 0}
+        self.reply(answer, request.encrypted, template="s.gw.dev.timer.count", dynamic=("devId",))
+
+    def answer_config_get(self, request: ActionRequest) -> None:
+        """Answer tuya.device.dynamic.config.get with an empty configuration."""
+        self.log_event(INFO, "answer", "Answer tuya.device.dynamic.config.get")
+        answer = {"validTime": 1800, "time": timestamp(), "config": {}}
+        self.reply(
+            answer,
+            request.encrypted,
+            template="tuya.device.dynamic.config.get",
+            dynamic=("time",),
+        )
+
+    # Catchall
+
+    def answer_generic(self, request: ActionRequest) -> None:
+        """Answer any unknown action with an empty success reply."""
+        self.log_event(INFO, "answer", "Answer generic ({})".format(request.action))
+        self.reply(None, request.encrypted, template="generic")
+
+
+# Routing of the 'a' parameter to JSONHandler methods. Exact names are found
+# with one dict lookup; the fallbacks keep the priority of the historical
+# substring checks for action names not listed here.
+action_registry = ActionRegistry(default=JSONHandler.answer_generic)
+action_registry.register(JSONHandler.answer_token_get, "s.gw.token.get")
+action_registry.register(JSONHandler.answer_active, "s.gw.dev.pk.active", "tuya.device.active")
+action_registry.register(JSONHandler.answer_upgrade_status, "s.gw.upgrade.updatestatus")
+action_registry.register(JSONHandler.answer_gw_upgrade, "s.gw.upgrade.get", "s.gw.upgrade")
+action_registry.register(JSONHandler.answer_device_upgrade, "tuya.device.upgrade.get")
+action_registry.register(JSONHandler.answer_log, "atop.online.debug.log")
+action_registry.register(JSONHandler.answer_timer, "s.gw.dev.timer.count")
+action_registry.register(JSONHandler.answer_config_get, "tuya.device.dynamic.config.get")
+action_registry.register_fallback(r"\.active", JSONHandler.answer_active)
+action_registry.register_fallback(r"\.updatestatus", JSONHandler.answer_upgrade_status)
+action_registry.register_fallback(r"\.device\.upgrade", JSONHandler.answer_device_upgrade)
+action_registry.register_fallback(r"\.upgrade", JSONHandler.answer_gw_upgrade)
+action_registry.register_fallback(r"\.log", JSONHandler.answer_log)
+action_registry.register_fallback(r"\.timer", JSONHandler.answer_timer)
+action_registry.register_fallback(r"\.config\.get", JSONHandler.answer_config_get)
+
+# Interval for expiring idle device sessions and writing the session snapshot
+SESSION_MAINTENANCE_INTERVAL_MS = 30000
+
+
+def maintain_sessions() -> None:
+    """Expire idle device sessions and snapshot the rest (PeriodicCallback target)."""
+    JSONHandler.sessions.evict_expired()
+    JSONHandler.sessions.save()
+
+
+def session_counts() -> Dict[Tuple[str, ...], float]:
+    """Count the device sessions per upgrade status (metrics collect function)."""
+    counts: Dict[Tuple[str, ...], float] = {}
+    for session in JSONHandler.sessions:
+        key = (session.upgrade_status or "none",)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+metrics.gauge("tuya_sessions", "Device sessions by upgrade status", ("status",), session_counts)
+metrics.counter(
+    "tuya_sessions_evicted_total",
+    "Sessions dropped because the store was full",
+    collect=lambda: {(): JSONHandler.sessions.evicted},
+)
+metrics.counter(
+    "tuya_sessions_expired_total",
+    "Sessions dropped after sessionTTL seconds without requests",
+    collect=lambda: {(): JSONHandler.sessions.expired},
+)
+metrics.counter(
+    "tuya_upgrade_triggers_fired_total",
+    "MQTT upgrade triggers published",
+    collect=lambda: {(): upgrade_scheduler.fired},
+)
+metrics.gauge(
+    "tuya_upgrade_triggers_pending",
+    "Upgrade triggers waiting to be published",
+    collect=lambda: {(): len(upgrade_scheduler.pending())},
+)
+
+
+# Milliseconds between the metrics snapshots every worker writes for the others
+METRICS_SNAPSHOT_INTERVAL_MS = 5000
+
+
+def publish_worker_metrics() -> None:
+    """Write the metrics of this worker for the other workers (PeriodicCallback target)."""
+    if worker_metrics is not None:
+        worker_metrics.publish(metrics)
+
+
+def create_private_directory() -> str:
+    """
+    Create a state directory private to this run of the server.
+
+    The directory is removed when the server exits, so the session database
+    (and with it the schema variant handed out on .active) and the worker
+    metrics never carry over to the next run or to another server on the
+    same host. Call this before forking, so all workers share it.
+
+    Returns:
+            Path of the new directory
+    """
+    import atexit
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="fake-registration-")
+    owner = os.getpid()
+
+    def remove() -> None:
+        # Forked workers inherit the handler; only the supervising process cleans up
+        if os.getpid() == owner:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    atexit.register(remove)
+    return directory
+
+
+def create_session_store(db_path: Optional[str]) -> SessionStore:
+    """
+    Create the device session store configured on the command line.
+
+    Args:
+            db_path: SQLite file shared by the workers, or None
+
+    Returns:
+            A SQLite-backed store if a database is given, otherwise an
+            in-memory store with the optional --sessionSnapshot
+    """
+    if db_path:
+        return SqliteSessionStore(db_path, options.maxSessions, options.sessionTTL)
+    return SessionStore(options.maxSessions, options.sessionTTL, options.sessionSnapshot or None)
 
 
 def main() -> None:
@@ -510,32 +1078,98 @@ def main() -> None:
 
     This function:
     1. Parses command-line options (port, address, debug mode, secKey)
-    2. Calculates firmware file hashes for upgrade responses
+    2. Indexes the firmware images and watches them for changes, and restores
+       the device sessions from the snapshot if one is configured
     3. Configures Tornado web application with routes:
        - / : Connection confirmation
        - /gw.json, /d.json : API endpoints
+       - /metrics : Prometheus metrics (JSON with ?format=json)
        - /files/* : Static firmware file serving
        - /* : Catch-all redirect to root
-    4. Starts the HTTP server on the specified address and port
-    5. Enters the Tornado event loop
+    4. Binds the server socket on the specified address and port and, with
+       --workers, forks worker processes that all accept on that socket
+    5. Enters the Tornado event loop (in every worker)
+
+    Firmware images are indexed before forking, so the files are hashed once.
+    Everything using the IOLoop, threads or database connections is set up
+    after forking, in each worker.
 
     Command-line Options:
             --port: Server port (default: 80)
             --addr: Server IP address (default: 10.42.42.1)
             --debug: Enable debug mode (default: True)
             --secKey: AES encryption key for protocol 2.2 (default: "0000000000000000")
+            --plugins: Comma-separated modules defining register_actions(registry)
+            --maxSessions: Maximum number of device sessions kept (default: 4096)
+            --sessionTTL: Seconds before an idle device session expires (default: 3600)
+            --sessionSnapshot: File to persist device sessions in (default: disabled)
+            --logLevel: Verbosity: debug, info, warning or error (default: debug)
+            --logFile: JSONL file for structured request logs (default: disabled)
+            --logMaxBytes: Size at which logFile is rotated (default: 10 MiB)
+            --workers: Number of server processes, 0 for one per CPU core (default: 1)
+            --sessionDb: SQLite file shared by the workers for device sessions, kept
+                         across runs (default: in memory; with --workers other than 1
+                         a temporary file removed on exit)
 
     Raises:
             OSError: If the server cannot bind to the specified port (e.g., EADDRINUSE)
     """
+    global firmware_catalog, worker_metrics
     parse_command_line()
-    get_file_stats("../files/upgrade.bin")
+    # Installed here rather than at import, so importing the module has no side effects
+    signal.signal(signal.SIGINT, exit_cleanly)
+    event_log.level = parse_level(options.logLevel)
+    event_log.path = options.logFile or None
+    event_log.max_bytes = options.logMaxBytes
+    action_registry.load_plugins(name for name in options.plugins.split(",") if name)
+    firmware_catalog = FirmwareCatalog(
+        FIRMWARE_DIR, options.secKey, FIRMWARE_INDEX, log=log_firmware_error
+    )
+    firmware_catalog.add_listener(on_firmware_change)
+    firmware_catalog.load()
+    image = firmware_catalog.get(UPGRADE_IMAGE)
+    if image is None:
+        # Not indexable (e.g. missing) - fail the same way as a direct read would
+        get_file_stats(os.path.join(FIRMWARE_DIR, UPGRADE_IMAGE))
+    else:
+        use_firmware_image(image)
+    worker_mode = options.workers != 1
+    try:
+        sockets = tornado.netutil.bind_sockets(options.port, options.addr)
+    except OSError as err:
+        print("Could not start server on port " + str(options.port))
+        if err.errno == 98:  # EADDRINUSE
+            print("Close the process on this port and try again")
+        else:
+            print(err)
+        return
+    db_path = options.sessionDb or None
+    if worker_mode:
+        state_dir = create_private_directory()
+        if db_path is None:
+            db_path = os.path.join(state_dir, "sessions.db")
+        # The parent only supervises (and restarts) the workers from here on
+        task_id = tornado.process.fork_processes(options.workers)
+        if event_log.path:
+            root, ext = os.path.splitext(event_log.path)
+            event_log.path = "%s-%d%s" % (root, task_id, ext)
+        # Session counts come from the shared database, so every worker has them all
+        worker_metrics = WorkerSnapshots(state_dir, task_id, shared=("tuya_sessions",))
+        tornado.ioloop.PeriodicCallback(
+            publish_worker_metrics, METRICS_SNAPSHOT_INTERVAL_MS
+        ).start()
+    tornado.ioloop.PeriodicCallback(refresh_firmware_catalog, FIRMWARE_WATCH_INTERVAL_MS).start()
+    JSONHandler.sessions = create_session_store(db_path)
+    if JSONHandler.sessions.load():
+        print("Restored %d device sessions" % len(JSONHandler.sessions))
+    tornado.ioloop.PeriodicCallback(maintain_sessions, SESSION_MAINTENANCE_INTERVAL_MS).start()
     app = tornado.web.Application(
         [
             (r"/", MainHandler),
             (r"/gw.json", JSONHandler),
             (r"/d.json", JSONHandler),
-            ("/files/(.*)", FilesHandler, {"path": str("../files/")}),
+            (r"/metrics", MetricsHandler),
+            ("/files/(.*)", FilesHandler, {"path": FIRMWARE_DIR}),
             (
                 r".*",
                 tornado.web.RedirectHandler,
@@ -545,17 +1179,13 @@ def main() -> None:
         # template_path=os.path.join(os.path.dirname(__file__), "templates"),
         # static_path=os.path.join(os.path.dirname(__file__), "templates"),
         debug=options.debug,
+        # Autoreload restarts the process and cannot work with forked workers
+        autoreload=options.debug and not worker_mode,
     )
-    try:
-        app.listen(options.port, options.addr)
-        print("Listening on " + options.addr + ":" + str(options.port))
-        tornado.ioloop.IOLoop.current().start()
-    except OSError as err:
-        print("Could not start server on port " + str(options.port))
-        if err.errno == 98:  # EADDRINUSE
-            print("Close the process on this port and try again")
-        else:
-            print(err)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    print("Listening on " + options.addr + ":" + str(options.port))
+    tornado.ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Firmware image catalog for the fake registration server.
+
+Indexes every firmware image in a directory (``files/`` in tuya-convert) and
+keeps its MD5, SHA256 and HMAC digests available for O(1) lookup, so upgrade
+replies and file downloads never have to reread an image.
+
+How It Works:
+    1. On load(), a sidecar JSON index is read (by default from the image
+       directory; servers pass a location outside the served tree)
+    2. Every image is stat()ed; entries whose (size, mtime) still match the
+       index are reused as-is, all others are rehashed
+    3. Hashing streams over an mmap of the file, so images are never copied
+       into Python memory as a whole
+    4. The updated index is written back atomically
+    5. refresh() repeats the stat pass; listeners are notified about added,
+       changed and removed images
+    6. poll() is the event loop variant of refresh(): it hashes in the
+       IOLoop's executor, and only images whose (size, mtime) did not change
+       since the previous poll, so an image that is still being copied in is
+       not hashed at every step
+
+Only images that changed are hashed, so startup cost stays flat as the image
+directory grows.
+
+HMAC:
+    The upgrade endpoint of protocol 2.2 expects
+    HMAC-SHA256(secKey, SHA256-hex-uppercase). It is derived from the stored
+    SHA256 when an entry is loaded, so the index itself does not depend on
+    the secret key.
+
+Example:
+    >>> catalog = FirmwareCatalog("../files/", "0000000000000000")
+    >>> catalog.load()
+    >>> image = catalog.get("upgrade.bin")
+    >>> image.md5, image.size
+    ('3b1f...', 505867)
+"""
+
+import hashlib
+import hmac
+import json
+import mmap
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import tornado.ioloop
+
+# Name of the sidecar index file stored next to the images
+INDEX_FILE_NAME = ".firmware-index.json"
+
+# Bytes fed to the hash functions per update() call
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Version of the on-disk index format
+INDEX_VERSION = 1
+
+
+class FileDigests(NamedTuple):
+    """MD5 and SHA256 digests of a file, as used in Tuya upgrade replies."""
+
+    md5: str  # lowercase hex
+    sha256: str  # uppercase hex
+
+
+class FirmwareImage(NamedTuple):
+    """
+    A firmware image known to the catalog.
+
+    Attributes:
+            name: File name relative to the catalog directory
+            path: Full path of the image
+            size: Size in bytes
+            mtime_ns: Modification time in nanoseconds when hashed
+            md5: MD5 digest, lowercase hex
+            sha256: SHA256 digest, uppercase hex
+            hmac: HMAC-SHA256 of the SHA256 hex with the secret key, uppercase hex
+    """
+
+    name: str
+    path: str
+    size: int
+    mtime_ns: int
+    md5: str
+    sha256: str
+    hmac: str
+
+
+# Listener signature: (name, image or None if removed)
+CatalogListener = Callable[[str, Optional[FirmwareImage]], None]
+
+# Error reporting signature: (message)
+CatalogLog = Callable[[str], None]
+
+
+def hash_file(path: str) -> FileDigests:
+    """
+    Compute MD5 and SHA256 of a file in a single streaming pass.
+
+    The file is mmap()ed and fed to both hash functions in chunks, so it is
+    never copied into Python memory as a whole.
+
+    Args:
+            path: File to hash
+
+    Returns:
+            FileDigests with lowercase MD5 and uppercase SHA256 hex digests
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size:  # empty files cannot be mapped
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        with view[offset : offset + HASH_CHUNK_SIZE] as chunk:
+                            md5.update(chunk)
+                            sha256.update(chunk)
+    return FileDigests(md5.hexdigest(), sha256.hexdigest().upper())
+
+
+def firmware_hmac(sha256: str, sec_key: str) -> str:
+    """
+    Compute the HMAC Tuya devices use to verify an upgrade image.
+
+    Args:
+            sha256: Uppercase SHA256 hex digest of the image
+            sec_key: Secret key used for encrypted communication
+
+    Returns:
+            Uppercase HMAC-SHA256 hex digest
+    """
+    return hmac.HMAC(sec_key.encode(), sha256.encode(), "sha256").hexdigest().upper()
+
+
+class FirmwareCatalog:
+    """
+    Digest index of all firmware images in a directory.
+
+    Attributes:
+            directory: Directory holding the images
+            index_path: Path of the sidecar index file
+            hashed: Number of images hashed since the catalog was created
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sec_key: str,
+        index_path: Optional[str] = None,
+        log: CatalogLog = print,
+    ) -> None:
+        """
+        Create an empty catalog; call load() to populate it.
+
+        Args:
+                directory: Directory holding the images
+                sec_key: Secret key used to derive the HMAC of each image
+                index_path: Sidecar index location (default: inside directory)
+                log: Called with a message when an image or the index cannot
+                     be read or written
+        """
+        self.directory = directory
+        self.index_path = index_path or os.path.join(directory, INDEX_FILE_NAME)
+        self._sec_key = sec_key
+        self._log = log
+        self._images: Dict[str, FirmwareImage] = {}
+        self._listeners: List[CatalogListener] = []
+        # (size, mtime_ns) of changed images at the previous poll()
+        self._unsettled: Dict[str, Tuple[int, int]] = {}
+        self.hashed = 0
+
+    def __len__(self) -> int:
+        """Return the number of indexed images."""
+        return len(self._images)
+
+    def __contains__(self, name: object) -> bool:
+        """Return whether an image with this name is indexed."""
+        return name in self._images
+
+    def get(self, name: str) -> Optional[FirmwareImage]:
+        """
+        Look up an image by file name.
+
+        Args:
+                name: File name relative to the catalog directory
+
+        Returns:
+                The indexed image, or None if unknown
+        """
+        return self._images.get(name)
+
+    def images(self) -> List[FirmwareImage]:
+        """Return all indexed images sorted by name."""
+        return [self._images[name] for name in sorted(self._images)]
+
+    def add_listener(self, listener: CatalogListener) -> None:
+        """
+        Register a callback for added, changed and removed images.
+
+        Args:
+                listener: Called with (name, image), image is None on removal
+        """
+        self._listeners.append(listener)
+
+    def load(self) -> None:
+        """Read the sidecar index and bring it up to date with the directory."""
+        self._images = self._read_index()
+        self.refresh()
+
+    def refresh(self) -> List[str]:
+        """
+        Rehash images whose size or mtime changed and drop removed ones.
+
+        Hashes synchronously; use poll() from the event loop.
+
+        Returns:
+                Names of images that were added, changed or removed
+        """
+        hashed = []
+        seen = set()
+        for name, stat in self._scan():
+            seen.add(name)
+            image = self._images.get(name)
+            if image is not None and (image.size, image.mtime_ns) == stat:
+                continue
+            try:
+                hashed.append(self._hash(name, *stat))
+            except OSError as e:
+                # Image disappeared or is unreadable - try again on next refresh
+                self._log(f"Could not hash firmware image {name}: {e}")
+        return self._update(hashed, seen)
+
+    async def poll(self) -> List[str]:
+        """
+        Refresh from the IOLoop without blocking it.
+
+        Meant to be polled periodically, e.g. from a Tornado PeriodicCallback.
+        A changed image is hashed once two consecutive polls see the same
+        size and mtime, i.e. once it is no longer being written; hashing runs
+        in the IOLoop's default executor so requests are served meanwhile.
+
+        Returns:
+                Names of images that were added, changed or removed
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        settled = []
+        seen = set()
+        for name, stat in self._scan():
+            seen.add(name)
+            image = self._images.get(name)
+            if image is not None and (image.size, image.mtime_ns) == stat:
+                self._unsettled.pop(name, None)
+            elif self._unsettled.get(name) == stat:
+                settled.append((name, stat))
+            else:
+                self._unsettled[name] = stat
+        for name in set(self._unsettled) - seen:
+            del self._unsettled[name]
+
+        hashed = []
+        for name, (size, mtime_ns) in settled:
+            try:
+                hashed.append(await io_loop.run_in_executor(None, self._hash, name, size, mtime_ns))
+            except OSError as e:
+                self._log(f"Could not hash firmware image {name}: {e}")
+                continue
+            del self._unsettled[name]
+        return self._update(hashed, seen)
+
+    def _update(self, hashed: Iterable[FirmwareImage], seen: Set[str]) -> List[str]:
+        """Store newly hashed images, drop unseen ones and notify the listeners."""
+        changed: List[Tuple[str, Optional[FirmwareImage]]] = []
+        for new in hashed:
+            self._images[new.name] = new
+            changed.append((new.name, new))
+
+        for name in set(self._images) - seen:
+            del self._images[name]
+            changed.append((name, None))
+
+        if changed:
+            self._write_index()
+            for name, image in changed:
+                for listener in self._listeners:
+                    listener(name, image)
+        return [name for name, _ in changed]
+
+    def _scan(self) -> Iterator[Tuple[str, Tuple[int, int]]]:
+        """Yield (name, (size, mtime_ns)) for every visible regular file."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield entry.name, (stat.st_size, stat.st_mtime_ns)
+
+    def _hash(self, name: str, size: int, mtime_ns: int) -> FirmwareImage:
+        """Hash one image and build its catalog entry."""
+        path = os.path.join(self.directory, name)
+        digests = hash_file(path)
+        self.hashed += 1
+        return self._entry(name, size, mtime_ns, digests.md5, digests.sha256)
+
+    def _entry(self, name: str, size: int, mtime_ns: int, md5: str, sha256: str) -> FirmwareImage:
+        """Build a catalog entry, deriving the HMAC from the SHA256."""
+        return FirmwareImage(
+            name=name,
+            path=os.path.join(self.directory, name),
+            size=size,
+            mtime_ns=mtime_ns,
+            md5=md5,
+            sha256=sha256,
+            hmac=firmware_hmac(sha256, self._sec_key),
+        )
+
+    def _read_index(self) -> Dict[str, FirmwareImage]:
+        """Load entries from the sidecar index, ignoring a missing or bad file."""
+        try:
+            with open(self.index_path, "r") as file:
+                data = json.load(file)
+            if data.get("version") != INDEX_VERSION:
+                return {}
+            return {
+                name: self._entry(name, e["size"], e["mtime_ns"], e["md5"], e["sha256"])
+                for name, e in data["images"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def _write_index(self) -> None:
+        """Atomically write the sidecar index; failures are logged and ignored."""
+        data = {
+            "version": INDEX_VERSION,
+            "images": {
+                image.name: {
+                    "size": image.size,
+                    "mtime_ns": image.mtime_ns,
+                    "md5": image.md5,
+                    "sha256": image.sha256,
+                }
+                for image in self.images()
+            },
+        }
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(data, file, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # Read-only media: the catalog still works, it just rehashes on restart
+            self._log(f"Could not write firmware index {self.index_path}: {e}")
+
+
+__all__ = [
+    "FileDigests",
+    "FirmwareCatalog",
+    "FirmwareImage",
+    "firmware_hmac",
+    "hash_file",
+]
@@ -25,6 +25,24 @@ Typical Usage:
     Specify custom MQTT broker:
         $ ./mq_pub_15.py -i 43511212112233445566 -b 192.168.1.100
 
+    Trigger a batch of devices over one broker connection, one
+    "gwId [localKey [protocol]]" per line:
+        $ ./mq_pub_15.py -f rack.txt
+
+Persistent Publisher:
+    TriggerPublisher keeps one paho client connected and publishes triggers
+    queued from any thread with QoS 1. Every trigger is tracked until the
+    broker acknowledges it; triggers without a PUBACK within the ack timeout
+    are published again with exponential backoff, up to a retry limit.
+
+Daemon Mode:
+    With -d the publisher stays resident and takes one JSON request per line,
+    {"gwId": ..., "localKey": ..., "protocol": ..., "id": ...}, on stdin or
+    on the Unix socket given with -s. Every request is answered in order with
+    one JSON line holding its outcome and timing, so callers skip the process
+    start, the imports and the broker connection per trigger:
+        $ ./mq_pub_15.py -d -s /run/tuya-convert/mq_pub.sock
+
 Example:
     >>> from mq_pub_15 import iot_enc, iot_dec
     >>> message = '{"data":{"gwId":"test123"},"protocol":15,"s":1523715,"t":1234567890}'
@@ -39,27 +57,45 @@ Note:
 Created by nano on 2018-11-22.
 Copyright (c) 2018 VTRUST. All rights reserved.
 """
+
 import base64
 import binascii
+import contextlib
 import getopt
+import json
+import os
+import queue
+import signal
+import socketserver
 import sys
+import threading
 import time
+from collections import deque
 from hashlib import md5
-from typing import List, Optional
-
-import paho.mqtt.publish as publish
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 help_message = """USAGE:
 	"-i"/"--deviceID"
+	"-f"/"--batch" FILE with one "gwId [localKey [protocol]]" per line ("-": stdin)
+	"-d"/"--daemon" serve JSON line requests on stdin, or on "-s"/"--socket" PATH
 	"-l"/"--localKey" [default=0000000000000000]
 	"-b"/"--broker" [default=127.0.0.1]
 	"-p"/"--protocol" [default=2.1]
 iot:	
-%s -i 43511212112233445566 -l a1b2c3d4e5f67788""" % (
-    sys.argv[0].split("/")[-1]
-)
+%s -i 43511212112233445566 -l a1b2c3d4e5f67788""" % (sys.argv[0].split("/")[-1])
 
-from crypto_utils import decrypt, encrypt
+from crypto_utils import decrypt, ecb_cipher, encrypt, pad
 
 # Protocol constants
 PROTOCOL_VERSION_21 = "2.1"
@@ -81,6 +117,8 @@ CRC_BYTE_SIZE = 4
 
 # Validation constants
 MIN_KEY_LENGTH = 10
+# Bytes of an AES-128 local key, required by iot_enc_batch()
+LOCAL_KEY_LENGTH = 16
 MIN_DEVICE_ID_LENGTH = 10
 
 # Exit codes
@@ -90,6 +128,22 @@ EXIT_ERROR = 2
 # Tuya IoT constants
 TUYA_SEQUENCE_NUMBER = 1523715  # Appears to be a fixed sequence number for protocol 15
 
+# MQTT topic devices subscribe to for commands
+DEVICE_IN_TOPIC = "smart/device/in/%s"
+
+# MQTT settings of persistent publisher connections
+MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60
+TRIGGER_QOS = 1
+
+# Seconds TriggerPublisher waits for the PUBACK of a trigger, how often it
+# publishes a trigger again, and the backoff before doing so (doubled per
+# attempt, up to the maximum)
+ACK_TIMEOUT = 5.0
+PUBLISH_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 8.0
+
 
 def iot_dec(message: str, local_key: str) -> str:
     """Decrypt IoT message from base64-encoded format.
@@ -192,6 +246,720 @@ def iot_enc(message: str, local_key: str, protocol: str) -> bytes:
     return messge_enc
 
 
+def iot_enc_batch(
+    messages: Sequence[str], local_keys: Sequence[str], protocols: Sequence[str]
+) -> List[bytes]:
+    """Encrypt many IoT messages, producing the same frames as iot_enc().
+
+    Messages are grouped by local key and each group is encrypted with one
+    AES call into a preallocated buffer; ECB encrypts every block on its own,
+    so the frames are sliced out of it afterwards. Signatures and checksums
+    are computed incrementally instead of over concatenated copies, and
+    nothing is printed. Protocol 2.2 frames of one batch share a timestamp.
+
+    Args:
+        messages: Plaintext messages
+        local_keys: Local key of each message
+        protocols: Protocol version of each message, "2.1" or "2.2"
+
+    Returns:
+        The encrypted frames, in the order of messages
+
+    Raises:
+        ValueError: If the sequences differ in length or a key is not 16 bytes
+
+    Example:
+        >>> frames = iot_enc_batch(["{}", "[]"], ["0000000000000000"] * 2, ["2.1", "2.2"])
+        >>> frames[0] == iot_enc("{}", "0000000000000000", "2.1")
+        True
+    """
+    if not len(messages) == len(local_keys) == len(protocols):
+        raise ValueError("messages, local_keys and protocols differ in length")
+    groups: Dict[str, List[int]] = {}
+    for index, local_key in enumerate(local_keys):
+        groups.setdefault(local_key, []).append(index)
+    timestamp = b"%08d" % ((int(time.time() * TIMESTAMP_MULTIPLIER) % TIMESTAMP_MODULO))
+    timestamp_crc = binascii.crc32(timestamp)
+    frames: List[bytes] = [b""] * len(messages)
+    for local_key, indices in groups.items():
+        key = local_key.encode()
+        if len(key) != LOCAL_KEY_LENGTH:
+            raise ValueError("AES key must be exactly 16 bytes")
+        plaintexts = [pad(messages[i]).encode("utf-8") for i in indices]
+        encrypted = bytearray(sum(len(plaintext) for plaintext in plaintexts))
+        ecb_cipher(key).encrypt(b"".join(plaintexts), output=encrypted)
+        view = memoryview(encrypted)
+        start = 0
+        for i, plaintext in zip(indices, plaintexts):
+            end = start + len(plaintext)
+            ciphertext = view[start:end]
+            start = end
+            protocol = protocols[i].encode()
+            if protocols[i] == PROTOCOL_VERSION_21:
+                data = base64.b64encode(ciphertext)
+                digest = md5(b"data=")
+                digest.update(data)
+                digest.update(b"||pv=" + protocol + b"||" + key)
+                signature = digest.hexdigest()[SIGNATURE_START_OFFSET:][:SIGNATURE_LENGTH]
+                frames[i] = b"".join((protocol, signature.encode(), data))
+            else:
+                crc = binascii.crc32(ciphertext, timestamp_crc).to_bytes(CRC_BYTE_SIZE, "big")
+                frames[i] = b"".join((protocol, crc, timestamp, ciphertext))
+    return frames
+
+
+def build_message(device_id: str, protocol: str, now: Optional[float] = None) -> str:
+    """Build the protocol 15 upgrade trigger message for a device.
+
+    Protocol 2.1 devices expect the sequence number and timestamp as JSON
+    numbers, protocol 2.2 devices expect them as strings.
+
+    Args:
+        device_id: Gateway/device ID (gwId) of the target device.
+        protocol: Protocol version string, either "2.1" or "2.2".
+        now: Timestamp to embed in the message. Defaults to the current time.
+
+    Returns:
+        The plaintext JSON message, ready to be encrypted with iot_enc().
+
+    Example:
+        >>> build_message("43511212112233445566", "2.1", now=1234567890)
+        '{"data":{"gwId":"43511212112233445566"},"protocol":15,"s":1523715,"t":1234567890}'
+    """
+    if now is None:
+        now = time.time()
+    if protocol == PROTOCOL_VERSION_21:
+        template = '{"data":{"gwId":"%s"},"protocol":%d,"s":%d,"t":%d}'
+    else:
+        template = '{"data":{"gwId":"%s"},"protocol":%d,"s":"%d","t":"%d"}'
+    return template % (device_id, PROTOCOL_NUMBER, TUYA_SEQUENCE_NUMBER, now)
+
+
+def create_mqtt_client() -> Any:
+    """Create a paho MQTT client compatible with paho-mqtt 1.x and 2.x.
+
+    Returns:
+        A new, unconnected paho Client
+    """
+    import paho.mqtt.client as mqtt
+
+    callback_api = getattr(mqtt, "CallbackAPIVersion", None)
+    if callback_api is not None:
+        return mqtt.Client(callback_api.VERSION2)
+    return mqtt.Client()
+
+
+class Trigger(NamedTuple):
+    """The upgrade trigger of one device.
+
+    Attributes:
+        gw_id: Gateway/device ID (gwId) of the device
+        local_key: Local key the message is encrypted with
+        protocol: Protocol version, "2.1" or "2.2"
+    """
+
+    gw_id: str
+    local_key: str = DEFAULT_LOCAL_KEY
+    protocol: str = DEFAULT_PROTOCOL
+
+
+class PendingTrigger:
+    """A trigger queued in a TriggerPublisher, and its outcome.
+
+    Attributes:
+        trigger: The trigger
+        topic: MQTT topic it is published to
+        payload: Encrypted message
+        attempts: Number of times it was published
+        acked: Whether the broker acknowledged it
+        error: Why it failed, None while pending or once acknowledged
+        queued: time.monotonic() when it was queued
+        finished: time.monotonic() when it was acknowledged or failed
+        done: Set once it was acknowledged or failed
+    """
+
+    __slots__ = (
+        "trigger",
+        "topic",
+        "payload",
+        "attempts",
+        "acked",
+        "error",
+        "queued",
+        "finished",
+        "done",
+        "info",
+        "deadline",
+        "retry_at",
+    )
+
+    def __init__(self, trigger: Trigger, payload: bytes) -> None:
+        """Create a trigger waiting to be published.
+
+        Args:
+            trigger: The trigger
+            payload: Its encrypted message
+        """
+        self.trigger = trigger
+        self.topic = DEVICE_IN_TOPIC % trigger.gw_id
+        self.payload = payload
+        self.attempts = 0
+        self.acked = False
+        self.error: Optional[str] = None
+        self.queued = time.monotonic()
+        self.finished: Optional[float] = None
+        self.done = threading.Event()
+        # paho MQTTMessageInfo of the last attempt, None until (re)published
+        self.info: Optional[Any] = None
+        self.deadline = 0.0
+        self.retry_at = 0.0
+
+    def latency(self) -> Optional[float]:
+        """Return the seconds from queueing to the outcome, None while pending."""
+        if self.finished is None:
+            return None
+        return self.finished - self.queued
+
+
+class TriggerPublisher:
+    """Publishes upgrade triggers over one persistent MQTT connection.
+
+    The paho client connects on the first trigger and reconnects in its own
+    network thread. A worker thread takes queued triggers, publishes them
+    with QoS 1 and watches for their PUBACKs; paho's on_publish callback only
+    wakes the worker, so no lock is held while paho holds its own. Triggers
+    are held back while the client is disconnected. A trigger that is not
+    published and acknowledged within ack_timeout is published again after a
+    backoff that doubles per attempt, and fails after retries republishes.
+
+    Attributes:
+        broker: MQTT broker address
+        port: MQTT broker port
+        ack_timeout: Seconds to wait for the PUBACK of an attempt
+        retries: Republishes before a trigger fails
+        backoff: Seconds before the first republish
+        published: Publish attempts made
+        acked: Triggers acknowledged by the broker
+        failed: Triggers that failed
+
+    Example:
+        >>> publisher = TriggerPublisher("127.0.0.1")
+        >>> pending = publisher.publish_batch([Trigger("43511212112233445566")])
+        >>> publisher.wait(pending, timeout=10)
+        True
+        >>> publisher.close()
+    """
+
+    def __init__(
+        self,
+        broker: str = DEFAULT_BROKER,
+        port: int = MQTT_PORT,
+        ack_timeout: float = ACK_TIMEOUT,
+        retries: int = PUBLISH_RETRIES,
+        backoff: float = RETRY_BACKOFF,
+    ) -> None:
+        """Create a publisher; no connection is made until the first trigger.
+
+        Args:
+            broker: MQTT broker address
+            port: MQTT broker port
+            ack_timeout: Seconds to wait for the PUBACK of an attempt
+            retries: Republishes before a trigger fails
+            backoff: Seconds before the first republish
+        """
+        self.broker = broker
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self._queue: Deque[PendingTrigger] = deque()
+        self._active: List[PendingTrigger] = []
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._client: Optional[Any] = None
+        self._thread: Optional[threading.Thread] = None
+        self._connected = False
+        self._closed = False
+
+    def publish(
+        self, gw_id: str, local_key: str = DEFAULT_LOCAL_KEY, protocol: str = DEFAULT_PROTOCOL
+    ) -> PendingTrigger:
+        """Queue the upgrade trigger of one device (see publish_batch())."""
+        return self.publish_batch([Trigger(gw_id, local_key, protocol)])[0]
+
+    def publish_batch(self, triggers: Iterable[Trigger]) -> List[PendingTrigger]:
+        """Queue upgrade triggers; they are published in order by the worker thread.
+
+        Args:
+            triggers: Triggers, e.g. of every device on a rack
+
+        Returns:
+            One PendingTrigger per trigger, to wait for with wait()
+
+        Raises:
+            ValueError: If the publisher is closed or a local key is not 16 bytes
+        """
+        triggers = list(triggers)
+        payloads = iot_enc_batch(
+            [build_message(trigger.gw_id, trigger.protocol) for trigger in triggers],
+            [trigger.local_key for trigger in triggers],
+            [trigger.protocol for trigger in triggers],
+        )
+        pending = [PendingTrigger(*item) for item in zip(triggers, payloads)]
+        with self._lock:
+            if self._closed:
+                raise ValueError("publisher is closed")
+            if self._thread is None:
+                self._start()
+            self._queue.extend(pending)
+        self._wakeup.set()
+        return pending
+
+    @staticmethod
+    def wait(pending: Iterable[PendingTrigger], timeout: Optional[float] = None) -> bool:
+        """Wait until triggers are acknowledged or failed.
+
+        Args:
+            pending: Triggers returned by publish_batch()
+            timeout: Seconds to wait in total, None for no limit
+
+        Returns:
+            True if all of them were acknowledged in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for trigger in pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not trigger.done.wait(remaining) or not trigger.acked:
+                return False
+        return True
+
+    def close(self) -> None:
+        """Stop publishing, fail the triggers still pending and disconnect."""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._active.extend(self._queue)
+        self._queue.clear()
+        for trigger in self._active:
+            self._finish(trigger, "publisher closed")
+        self._active = []
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+
+    def _start(self) -> None:
+        """Connect the MQTT client and start the worker thread."""
+        client = create_mqtt_client()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.connect_async(self.broker, self.port, MQTT_KEEPALIVE)
+        client.loop_start()
+        self._client = client
+        self._thread = threading.Thread(target=self._run, name="trigger-publisher", daemon=True)
+        self._thread.start()
+
+    def _on_connect(self, client: Any, userdata: Any, flags: Any, rc: Any, *args: Any) -> None:
+        """Start publishing once the broker accepted the connection (paho callback)."""
+        self._connected = rc == 0
+        self._wakeup.set()
+
+    def _on_disconnect(self, client: Any, userdata: Any, *args: Any) -> None:
+        """Hold back triggers until paho reconnected (paho callback)."""
+        self._connected = False
+        self._wakeup.set()
+
+    def _on_publish(self, client: Any, userdata: Any, mid: int, *args: Any) -> None:
+        """Wake the worker when the broker acknowledged a message (paho callback)."""
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        """Publish queued triggers and track their acknowledgements (worker thread)."""
+        while not self._closed:
+            self._wakeup.clear()
+            timeout = self._step(time.monotonic())
+            self._wakeup.wait(timeout)
+
+    def _step(self, now: float) -> Optional[float]:
+        """Publish due triggers and settle acknowledged and timed out ones.
+
+        Returns:
+            Seconds until the next deadline, None if nothing is pending
+        """
+        while self._queue:
+            trigger = self._queue.popleft()
+            trigger.deadline = now + self.ack_timeout
+            self._active.append(trigger)
+        active = []
+        wake = None
+        for trigger in self._active:
+            if trigger.info is None and trigger.retry_at <= now:
+                if self._connected:
+                    if not self._send(trigger, now):
+                        continue
+                elif now >= trigger.deadline:
+                    # An attempt without a connection is lost as well
+                    trigger.attempts += 1
+                    if not self._retry(trigger, now, "not connected"):
+                        continue
+            elif trigger.info is not None:
+                if trigger.info.is_published():
+                    self._finish(trigger, None)
+                    continue
+                if now >= trigger.deadline and not self._retry(trigger, now, "no PUBACK"):
+                    continue
+            if trigger.info is None and trigger.retry_at > now:
+                due = trigger.retry_at
+            else:
+                due = trigger.deadline
+            wake = due if wake is None else min(wake, due)
+            active.append(trigger)
+        self._active = active
+        return None if wake is None else max(0.0, wake - now)
+
+    def _send(self, trigger: PendingTrigger, now: float) -> bool:
+        """Publish one attempt of a trigger.
+
+        Returns:
+            False if the trigger failed for good (and was finished)
+        """
+        import paho.mqtt.client as mqtt
+
+        assert self._client is not None
+        try:
+            info = self._client.publish(trigger.topic, trigger.payload, qos=TRIGGER_QOS)
+        except (OSError, ValueError) as e:
+            self._finish(trigger, str(e))
+            return False
+        self.published += 1
+        trigger.attempts += 1
+        # Errors (e.g. a full queue or a connection lost meanwhile) count as a
+        # lost attempt; paho may still deliver such a message on reconnect,
+        # which the devices tolerate like any QoS 1 duplicate
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return self._retry(trigger, now, mqtt.error_string(info.rc))
+        trigger.info = info
+        trigger.deadline = now + self.ack_timeout
+        return True
+
+    def _retry(self, trigger: PendingTrigger, now: float, reason: str) -> bool:
+        """Schedule the next attempt of a trigger after a backoff.
+
+        Returns:
+            False if it ran out of retries and failed with reason
+        """
+        trigger.info = None
+        if trigger.attempts > self.retries:
+            self._finish(trigger, "%s after %d attempts" % (reason, trigger.attempts))
+            return False
+        delay = self.backoff * 2 ** (trigger.attempts - 1)
+        trigger.retry_at = now + min(delay, MAX_RETRY_BACKOFF)
+        trigger.deadline = trigger.retry_at + self.ack_timeout
+        return True
+
+    def _finish(self, trigger: PendingTrigger, error: Optional[str]) -> None:
+        """Record the outcome of a trigger and wake its waiters."""
+        trigger.acked = error is None
+        trigger.error = error
+        trigger.finished = time.monotonic()
+        trigger.info = None
+        if error is None:
+            self.acked += 1
+        else:
+            self.failed += 1
+        trigger.done.set()
+
+
+def read_batch(
+    lines: Iterable[str], local_key: str = DEFAULT_LOCAL_KEY, protocol: str = DEFAULT_PROTOCOL
+) -> List[Trigger]:
+    """Parse "gwId [localKey [protocol]]" lines; blank lines and # comments are skipped.
+
+    Args:
+        lines: Lines of a batch file
+        local_key: Local key of lines without one
+        protocol: Protocol of lines without one
+
+    Returns:
+        The triggers, in file order
+
+    Raises:
+        ValueError: If a line has more than three fields, a too short gwId, a
+            local key that is not 16 bytes, or a protocol other than 2.1 and 2.2
+    """
+    triggers = []
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) > 3:
+            raise ValueError("invalid batch line: %s" % line.strip())
+        trigger = Trigger(*fields)
+        if len(fields) < 2:
+            trigger = trigger._replace(local_key=local_key)
+        if len(fields) < 3:
+            trigger = trigger._replace(protocol=protocol)
+        if len(trigger.gw_id) < MIN_DEVICE_ID_LENGTH:
+            raise ValueError("invalid batch line: %s" % line.strip())
+        if len(trigger.local_key.encode()) != LOCAL_KEY_LENGTH:
+            raise ValueError("local key is not 16 bytes in batch line: %s" % line.strip())
+        if trigger.protocol not in (PROTOCOL_VERSION_21, PROTOCOL_VERSION_22):
+            raise ValueError("invalid protocol in batch line: %s" % line.strip())
+        triggers.append(trigger)
+    return triggers
+
+
+def publish_batch(broker: str, triggers: List[Trigger]) -> int:
+    """Publish triggers over one connection and print the outcome of each.
+
+    Returns:
+        EXIT_SUCCESS if the broker acknowledged every trigger, EXIT_ERROR otherwise
+    """
+    publisher = TriggerPublisher(broker)
+    try:
+        pending = publisher.publish_batch(triggers)
+        publisher.wait(pending)
+    finally:
+        publisher.close()
+    for trigger in pending:
+        latency = (trigger.latency() or 0.0) * 1000
+        if trigger.acked:
+            print(
+                "%s: acknowledged in %.1f ms (%d attempts)"
+                % (trigger.trigger.gw_id, latency, trigger.attempts)
+            )
+        else:
+            print("%s: failed after %.1f ms: %s" % (trigger.trigger.gw_id, latency, trigger.error))
+    return EXIT_SUCCESS if publisher.failed == 0 else EXIT_ERROR
+
+
+def parse_request(
+    line: str, local_key: str = DEFAULT_LOCAL_KEY, protocol: str = DEFAULT_PROTOCOL
+) -> Tuple[Any, Trigger]:
+    """Parse a daemon request line.
+
+    Args:
+        line: JSON object with "gwId" and optional "localKey", "protocol" and "id"
+        local_key: Local key of requests without one
+        protocol: Protocol of requests without one
+
+    Returns:
+        The "id" of the request (None if it has none) and its trigger
+
+    Raises:
+        ValueError: If the line is not a valid request
+    """
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("request is not an object")
+    trigger = Trigger(
+        str(request.get("gwId", "")),
+        str(request.get("localKey", local_key)),
+        str(request.get("protocol", protocol)),
+    )
+    if len(trigger.gw_id) < MIN_DEVICE_ID_LENGTH:
+        raise ValueError("invalid gwId")
+    if len(trigger.local_key.encode()) != LOCAL_KEY_LENGTH:
+        raise ValueError("invalid localKey")
+    if trigger.protocol not in (PROTOCOL_VERSION_21, PROTOCOL_VERSION_22):
+        raise ValueError("invalid protocol")
+    return request.get("id"), trigger
+
+
+def serve_requests(
+    publisher: TriggerPublisher,
+    lines: Iterable[str],
+    write: Callable[[str], None],
+    local_key: str = DEFAULT_LOCAL_KEY,
+    protocol: str = DEFAULT_PROTOCOL,
+) -> int:
+    """Publish the trigger of each request line and write one result line per request.
+
+    Requests are dispatched as soon as they are read; a writer thread waits
+    for their outcomes and answers them in request order, so a caller can
+    pipeline requests. A result holds "id", "gwId", "ok", "attempts",
+    "dispatch_ms" (parsing, encryption and queueing) and "ack_ms" (queueing
+    to PUBACK or failure), plus "error" if the trigger failed.
+
+    Args:
+        publisher: Publisher the triggers are queued in
+        lines: Request lines; serving ends when they are exhausted
+        write: Writes one result line
+        local_key: Local key of requests without one
+        protocol: Protocol of requests without one
+
+    Returns:
+        The number of requests served
+    """
+    results: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+
+    def reply() -> None:
+        broken = False
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            pending = result.pop("pending", None)
+            if pending is not None:
+                pending.done.wait()
+                result.update(
+                    ok=pending.acked,
+                    attempts=pending.attempts,
+                    ack_ms=round((pending.latency() or 0.0) * 1000, 3),
+                )
+                if pending.error is not None:
+                    result["error"] = pending.error
+            if not broken:
+                try:
+                    write(json.dumps(result) + "\n")
+                except OSError:
+                    # The caller went away; keep draining its pending triggers
+                    broken = True
+
+    writer = threading.Thread(target=reply, name="trigger-replies", daemon=True)
+    writer.start()
+    served = 0
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            served += 1
+            start = time.perf_counter()
+            try:
+                request_id, trigger = parse_request(line, local_key, protocol)
+            except ValueError as e:
+                results.put({"id": None, "ok": False, "error": "invalid request: %s" % e})
+                continue
+            try:
+                pending = publisher.publish_batch([trigger])[0]
+            except ValueError as e:
+                results.put({"id": request_id, "gwId": trigger.gw_id, "ok": False, "error": str(e)})
+                continue
+            dispatch = round((time.perf_counter() - start) * 1000, 3)
+            results.put(
+                {
+                    "id": request_id,
+                    "gwId": trigger.gw_id,
+                    "dispatch_ms": dispatch,
+                    "pending": pending,
+                }
+            )
+    finally:
+        results.put(None)
+        writer.join()
+    return served
+
+
+class TriggerRequestHandler(socketserver.StreamRequestHandler):
+    """Serves the requests of one daemon socket connection."""
+
+    server: "TriggerServer"
+
+    def handle(self) -> None:
+        """Answer request lines until the client closes the connection."""
+
+        def write(line: str) -> None:
+            self.wfile.write(line.encode())
+            self.wfile.flush()
+
+        lines = (line.decode("utf-8", "replace") for line in self.rfile)
+        serve_requests(
+            self.server.publisher, lines, write, self.server.local_key, self.server.protocol
+        )
+
+
+class TriggerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server sharing one TriggerPublisher between its connections.
+
+    Attributes:
+        path: Path of the socket
+        publisher: Publisher all connections queue their triggers in
+        local_key: Local key of requests without one
+        protocol: Protocol of requests without one
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        path: str,
+        publisher: TriggerPublisher,
+        local_key: str = DEFAULT_LOCAL_KEY,
+        protocol: str = DEFAULT_PROTOCOL,
+    ) -> None:
+        """Listen on a Unix socket, replacing a stale socket file left at path.
+
+        Args:
+            path: Path of the socket
+            publisher: Publisher all connections queue their triggers in
+            local_key: Local key of requests without one
+            protocol: Protocol of requests without one
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.path = path
+        self.publisher = publisher
+        self.local_key = local_key
+        self.protocol = protocol
+        super().__init__(path, TriggerRequestHandler)
+
+    def server_close(self) -> None:
+        """Stop listening and remove the socket file."""
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+def run_daemon(broker: str, path: Optional[str], local_key: str, protocol: str) -> int:
+    """Serve trigger requests on a Unix socket, or on stdin/stdout without one.
+
+    The stdin daemon ends at end of input, the socket daemon on SIGTERM or
+    SIGINT. Debug output goes to stderr so that stdout only carries results.
+
+    Returns:
+        EXIT_SUCCESS, or EXIT_ERROR if the socket cannot be created
+    """
+    publisher = TriggerPublisher(broker)
+    out = sys.stdout
+
+    def write(line: str) -> None:
+        out.write(line)
+        out.flush()
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if path is None:
+                serve_requests(publisher, sys.stdin, write, local_key, protocol)
+                return EXIT_SUCCESS
+            try:
+                server = TriggerServer(path, publisher, local_key, protocol)
+            except OSError as e:
+                print(f"Error: cannot listen on {path}: {e}", file=sys.stderr)
+                return EXIT_ERROR
+
+            def stop(signum: int, frame: Any) -> None:
+                # shutdown() waits for serve_forever(), which runs in this thread
+                threading.Thread(target=server.shutdown).start()
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            print("serving trigger requests on %s" % path)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+    finally:
+        publisher.close()
+    return EXIT_SUCCESS
+
+
 class Usage(Exception):
     """Exception raised for command-line usage errors.
 
@@ -237,6 +1005,12 @@ def main(argv: Optional[List[str]] = None) -> int:
         -l, --localKey: Local encryption key (default: "0000000000000000")
         -b, --broker: MQTT broker address (default: "127.0.0.1")
         -p, --protocol: Protocol version, "2.1" or "2.2" (default: "2.1")
+        -f, --batch: File of "gwId [localKey [protocol]]" lines ("-" for stdin)
+            to trigger over one connection instead of a single device; -l and
+            -p give the defaults of its lines
+        -d, --daemon: Stay resident and serve JSON line trigger requests on
+            stdin (see serve_requests()); -l and -p give their defaults
+        -s, --socket: Serve daemon requests on this Unix socket instead
         -h, --help: Display help message
 
     Args:
@@ -267,12 +1041,26 @@ def main(argv: Optional[List[str]] = None) -> int:
     localKey = DEFAULT_LOCAL_KEY
     deviceID = ""
     protocol = DEFAULT_PROTOCOL
+    batch = None
+    daemon = False
+    socket_path = None
     if argv is None:
         argv = sys.argv
     try:  # getopt
         try:
             opts, args = getopt.getopt(
-                argv[1:], "hl:i:vb:p:", ["help", "localKey=", "deviceID=", "broker=", "protocol="]
+                argv[1:],
+                "hl:i:vb:p:f:ds:",
+                [
+                    "help",
+                    "localKey=",
+                    "deviceID=",
+                    "broker=",
+                    "protocol=",
+                    "batch=",
+                    "daemon",
+                    "socket=",
+                ],
             )
         except getopt.GetoptError as err:
             # Invalid command-line arguments
@@ -293,9 +1081,29 @@ def main(argv: Optional[List[str]] = None) -> int:
                 broker = value
             if option in ("-p", "--protocol"):
                 protocol = value
+            if option in ("-f", "--batch"):
+                batch = value
+            if option in ("-d", "--daemon"):
+                daemon = True
+            if option in ("-s", "--socket"):
+                socket_path = value
 
         if len(localKey) < MIN_KEY_LENGTH:
             raise Usage(help_message)
+        if daemon:
+            return run_daemon(broker, socket_path, localKey, protocol)
+        if batch is not None:
+            try:
+                if batch == "-":
+                    triggers = read_batch(sys.stdin, localKey, protocol)
+                else:
+                    with open(batch) as f:
+                        triggers = read_batch(f, localKey, protocol)
+                # ValueError (e.g. an unusable key) is raised before anything is published
+                return publish_batch(broker, triggers)
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return EXIT_ERROR
         if len(deviceID) < MIN_DEVICE_ID_LENGTH:
             raise Usage(help_message)
     except Usage:
@@ -304,24 +1112,13 @@ def main(argv: Optional[List[str]] = None) -> int:
         print(help_message)
         return EXIT_ERROR
 
-    if protocol == PROTOCOL_VERSION_21:
-        message = '{"data":{"gwId":"%s"},"protocol":%d,"s":%d,"t":%d}' % (
-            deviceID,
-            PROTOCOL_NUMBER,
-            TUYA_SEQUENCE_NUMBER,
-            time.time(),
-        )
-    else:
-        message = '{"data":{"gwId":"%s"},"protocol":%d,"s":"%d","t":"%d"}' % (
-            deviceID,
-            PROTOCOL_NUMBER,
-            TUYA_SEQUENCE_NUMBER,
-            time.time(),
-        )
+    import paho.mqtt.publish as publish
+
+    message = build_message(deviceID, protocol)
     print("encoding", message, "using protocol", protocol)
     m1 = iot_enc(message, localKey, protocol)
 
-    publish.single("smart/device/in/%s" % (deviceID), m1, hostname=broker)
+    publish.single(DEVICE_IN_TOPIC % (deviceID), m1, hostname=broker)
     return EXIT_SUCCESS
 
 
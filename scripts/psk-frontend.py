@@ -43,6 +43,21 @@ Typical Usage:
     The proxy binds to 10.42.42.1 (gateway) and listens on ports 443 and 8886.
     Devices connecting via TLS-PSK are automatically decrypted and proxied.
 
+    Spread the TLS work over several cores with worker processes:
+        $ sudo ./psk-frontend.py --workers 4
+
+    Every worker binds the listeners with SO_REUSEPORT, so the kernel
+    distributes new connections between them. A supervisor restarts
+    workers that exit and prints the summed statistics of all workers.
+
+    Serve several access points, or extra ports, from one process:
+        $ sudo ./psk-frontend.py --gateway 10.42.42.1 --gateway 10.42.43.1 \\
+              --map 10.42.42.1:8883=10.42.42.1:1883
+
+    With --config, the mapping table is read from a file and re-read on
+    SIGHUP. New listeners are started and removed ones closed while the
+    sessions in progress keep running.
+
 Example:
     >>> from psk_frontend import gen_psk
     >>> identity = b'\\x00' + b'BAohbmd6aG91IFR1' + b'...'  # Device identity
@@ -58,14 +73,27 @@ Security Note:
 Created by VTRUST team for tuya-convert project.
 """
 
-import select
+import argparse
+import errno
+import heapq
+import itertools
+import json
+import math
+import os
+import selectors
+import signal
 import socket
 import ssl
+import sys
+import time
 from binascii import hexlify
+from collections import OrderedDict, deque
+from functools import partial
 from hashlib import md5
-from typing import List, Tuple
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
 
 from Cryptodome.Cipher import AES
+from server_metrics import GAUGE, MetricsRegistry
 from sslpsk3 import SSLPSKContext
 
 # Network constants
@@ -84,11 +112,62 @@ MD5_KEY_LENGTH = 16
 AES_BLOCK_SIZE = 32
 
 # Socket constants
-SOCKET_LISTEN_BACKLOG = 1
-SOCKET_BUFFER_SIZE = 4096
-
-
-def listener(host: str, port: int) -> socket.socket:
+SOCKET_LISTEN_BACKLOG = 128
+# Seconds a listener stops accepting after accept() failed, e.g. with EMFILE
+ACCEPT_RETRY_DELAY = 0.1
+# Bytes buffered per direction of a session (default of PskFrontend buffer_size)
+SOCKET_BUFFER_SIZE = 16384
+
+# Derived PSKs kept for reconnecting devices
+PSK_CACHE_SIZE = 1024
+
+# Warm backend connections kept for the HTTP mapping, and the seconds to wait
+# before connecting again when the backend refused
+BACKEND_POOL_SIZE = 8
+BACKEND_RETRY_DELAY = 1.0
+
+# Seconds a device may take to complete the TLS-PSK handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+# Seconds a session may pass without forwarding a byte before it is closed
+# (devices that reboot mid-flash leave half-open connections), by listening
+# port, and the granularity of the idle check
+IDLE_TIMEOUTS = {HTTPS_PORT: 120.0, MQTT_ALT_PORT: 300.0}
+DEFAULT_IDLE_TIMEOUT = 300.0
+IDLE_CHECK_INTERVAL = 1.0
+
+# Seconds between handshake statistics lines in main()
+STATS_INTERVAL = 60.0
+
+# Seconds between statistics reports of a worker to the supervisor, and the
+# minimum seconds between two starts of the same worker
+WORKER_REPORT_INTERVAL = 5.0
+WORKER_RESTART_DELAY = 1.0
+
+# Handshake duration buckets in seconds, from 1 ms to the timeout
+HANDSHAKE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Handshake outcomes and durations of all listeners, by listening port
+metrics = MetricsRegistry()
+handshake_results = metrics.counter(
+    "psk_handshakes_total", "TLS-PSK handshakes by result", ("port", "result")
+)
+handshake_durations = metrics.histogram(
+    "psk_handshake_duration_seconds",
+    "Duration of successful TLS-PSK handshakes",
+    ("port",),
+    HANDSHAKE_BUCKETS,
+)
+backend_connections = metrics.counter(
+    "psk_backend_connections_total",
+    "Backend connections handed out by pools: hit (warm), miss (connected on demand), "
+    "stale (closed by the backend while idle)",
+    ("backend", "result"),
+)
+active_sessions = metrics.gauge("psk_sessions", "Forwarding sessions", ("port",))
+
+
+def listener(host: str, port: int, reuse_port: bool = False) -> socket.socket:
     """Create a TCP listening socket on the specified host and port.
 
     Creates a server socket that listens for incoming connections. The socket
@@ -100,6 +179,9 @@ def listener(host: str, port: int) -> socket.socket:
             or a specific IP like "10.42.42.1" for the gateway.
         port: The TCP port number to listen on (e.g., 443 for HTTPS,
             8886 for MQTT-TLS).
+        reuse_port: Set SO_REUSEPORT, so that several worker processes can
+            bind the same address and the kernel balances connections
+            between them.
 
     Returns:
         A listening socket object ready to accept client connections.
@@ -112,6 +194,8 @@ def listener(host: str, port: int) -> socket.socket:
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((host, port))
     sock.listen(SOCKET_LISTEN_BACKLOG)
     return sock
@@ -146,6 +230,629 @@ def client(host: str, port: int) -> socket.socket:
     return sock
 
 
+class Reactor:
+    """Readiness event loop shared by all listeners and sessions of the proxy.
+
+    Wraps a selectors.DefaultSelector (epoll on Linux, kqueue on BSD/macOS),
+    so the number of sockets is not limited by select()'s FD_SETSIZE and the
+    cost of a wait does not grow with the number of idle sessions. Every
+    registered socket carries its callback, so dispatching an event is a
+    single lookup.
+
+    Timers (call_later) are kept in a heap; the wait for socket events ends
+    when the earliest timer is due.
+
+    Attributes:
+        selector: The underlying selector
+
+    Example:
+        >>> reactor = Reactor()
+        >>> proxy = PskFrontend("10.42.42.1", 443, "10.42.42.1", 80, reactor)
+        >>> reactor.run()  # Runs until interrupted
+    """
+
+    def __init__(self, selector: Optional[selectors.BaseSelector] = None) -> None:
+        """Create a reactor.
+
+        Args:
+            selector: Selector to use, defaults to the best one for the platform
+        """
+        self.selector = selector or selectors.DefaultSelector()
+        self._timers: List[Tuple[float, int, "Timer"]] = []
+        self._sequence = itertools.count()
+        self._signal_handlers: Dict[int, Callable[[], None]] = {}
+        self._wakeup: Optional[Tuple[socket.socket, socket.socket]] = None
+
+    def add_signal_handler(self, signum: int, callback: Callable[[], None]) -> None:
+        """Call callback() from the event loop when the process receives a signal.
+
+        The Python signal handler only wakes the reactor up (signal.set_wakeup_fd),
+        so the callback never interrupts another callback half-way. Must be
+        called from the main thread.
+
+        Args:
+            signum: Signal number, e.g. signal.SIGHUP
+            callback: Function to call
+        """
+        if self._wakeup is None:
+            self._wakeup = socket.socketpair()
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            signal.set_wakeup_fd(self._wakeup[1].fileno())
+            self.register(self._wakeup[0], self._signals_cb)
+        self._signal_handlers[signum] = callback
+        signal.signal(signum, lambda signum, frame: None)
+
+    def _signals_cb(self, sock: socket.socket, mask: int) -> None:
+        """Run the callbacks of received signals (reactor callback)."""
+        try:
+            received = sock.recv(64)
+        except BlockingIOError:
+            return
+        for signum in received:
+            callback = self._signal_handlers.get(signum)
+            if callback is not None:
+                callback()
+
+    def call_later(self, delay: float, callback: Callable[..., None], *args: Any) -> "Timer":
+        """Call callback(*args) after delay seconds.
+
+        Args:
+            delay: Seconds from now
+            callback: Function to call
+            args: Arguments for the callback
+
+        Returns:
+            A timer that can be cancelled
+        """
+        timer = Timer(callback, args)
+        deadline = time.monotonic() + delay
+        heapq.heappush(self._timers, (deadline, next(self._sequence), timer))
+        return timer
+
+    def _run_timers(self) -> Optional[float]:
+        """Run due timers and return the seconds until the next one (None if none)."""
+        timers = self._timers
+        now = time.monotonic()
+        while timers:
+            deadline, _, timer = timers[0]
+            if timer.cancelled:
+                heapq.heappop(timers)
+            elif deadline <= now:
+                heapq.heappop(timers)
+                timer.callback(*timer.args)
+            else:
+                return deadline - now
+        return None
+
+    def register(
+        self,
+        sock: socket.socket,
+        callback: "ReadyCallback",
+        events: int = selectors.EVENT_READ,
+    ) -> None:
+        """Watch a socket and call callback(sock, mask) when it becomes ready.
+
+        Args:
+            sock: Socket to watch
+            callback: Called with the socket and the ready event mask
+            events: selectors.EVENT_READ and/or selectors.EVENT_WRITE
+        """
+        self.selector.register(sock, events, callback)
+
+    def modify(self, sock: socket.socket, callback: "ReadyCallback", events: int) -> None:
+        """Change the events and callback of a registered socket."""
+        self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock: socket.socket) -> None:
+        """Stop watching a socket; unknown or closed sockets are ignored."""
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout: Optional[float] = None) -> int:
+        """Wait for ready sockets and run their callbacks once.
+
+        Args:
+            timeout: Seconds to wait at most, None to wait indefinitely
+                (or until the next timer is due)
+
+        Returns:
+            Number of socket events handled
+        """
+        next_timer = self._run_timers()
+        if next_timer is not None and (timeout is None or next_timer < timeout):
+            timeout = next_timer
+        events = self.selector.select(timeout)
+        for key, mask in events:
+            key.data(key.fileobj, mask)
+        self._run_timers()
+        return len(events)
+
+    def run(self) -> None:
+        """Handle events until interrupted."""
+        while True:
+            self.poll()
+
+    def close(self) -> None:
+        """Release the selector and restore the default handling of signals."""
+        if self._wakeup is not None:
+            signal.set_wakeup_fd(-1)
+            for signum in self._signal_handlers:
+                signal.signal(signum, signal.SIG_DFL)
+            for sock in self._wakeup:
+                sock.close()
+            self._wakeup = None
+        self.selector.close()
+
+
+# Reactor callbacks are called with the ready socket and the event mask
+ReadyCallback = Callable[[socket.socket, int], None]
+
+
+class Timer:
+    """A pending Reactor.call_later() callback.
+
+    Attributes:
+        callback: Function to call
+        args: Arguments for the callback
+        cancelled: Whether cancel() was called
+    """
+
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback: Callable[..., None], args: Tuple[Any, ...]) -> None:
+        """Create a timer; use Reactor.call_later() instead."""
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Prevent the callback from being called."""
+        self.cancelled = True
+
+
+class Handshake:
+    """A TLS-PSK handshake in progress.
+
+    Attributes:
+        sock: Non-blocking TLS socket of the device
+        started: time.monotonic() when the connection was accepted
+        timer: Timeout of the handshake
+    """
+
+    __slots__ = ("sock", "started", "timer")
+
+    def __init__(self, sock: ssl.SSLSocket, started: float, timer: Timer) -> None:
+        """Track the handshake of a device socket."""
+        self.sock = sock
+        self.started = started
+        self.timer = timer
+
+
+class Pipe:
+    """One direction of a session: bytes read from src, waiting to be sent to dst.
+
+    The bytes are kept in a ring buffer allocated once per pipe; recv_into()
+    writes straight into it and send() reads straight from it, so forwarding
+    does not allocate per chunk. When dst is slower than src the buffer fills
+    up: reading from src is paused at the high watermark and resumed once
+    the buffer has drained to the low watermark, so a fast sender is slowed
+    down to the speed of the receiver instead of growing memory or losing data.
+
+    Attributes:
+        src: Socket the bytes are read from
+        dst: Socket the bytes are written to
+        buffer: Preallocated ring buffer
+        head: Offset of the oldest buffered byte
+        size: Number of buffered bytes
+        high_watermark: Buffered bytes at which reading from src is paused
+        low_watermark: Buffered bytes at which reading from src is resumed
+        paused: Whether reading from src is paused
+        eof: Whether src has closed its side of the connection
+        total: Bytes read from src so far
+    """
+
+    __slots__ = (
+        "src",
+        "dst",
+        "buffer",
+        "view",
+        "head",
+        "size",
+        "high_watermark",
+        "low_watermark",
+        "paused",
+        "eof",
+        "total",
+    )
+
+    def __init__(
+        self,
+        src: socket.socket,
+        dst: socket.socket,
+        buffer_size: int = SOCKET_BUFFER_SIZE,
+        high_watermark: Optional[int] = None,
+        low_watermark: Optional[int] = None,
+    ) -> None:
+        """Create an empty pipe.
+
+        Args:
+            src: Socket the bytes are read from
+            dst: Socket the bytes are written to
+            buffer_size: Size of the ring buffer in bytes
+            high_watermark: Pause reading at this many buffered bytes
+                (default: when the buffer is full)
+            low_watermark: Resume reading at this many buffered bytes
+                (default: a quarter of the buffer)
+        """
+        self.src = src
+        self.dst = dst
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.size = 0
+        self.high_watermark = min(high_watermark or buffer_size, buffer_size)
+        self.low_watermark = buffer_size // 4 if low_watermark is None else low_watermark
+        self.paused = False
+        self.eof = False
+        self.total = 0
+
+    def fill(self) -> None:
+        """Read from src until it would block, reaches EOF or the buffer is full.
+
+        Raises:
+            OSError: If reading fails
+        """
+        capacity = len(self.buffer)
+        while not self.paused and not self.eof:
+            start = (self.head + self.size) % capacity
+            end = start + min(capacity - self.size, capacity - start)
+            try:
+                count = self.src.recv_into(self.view[start:end])
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                # Nothing to read yet, or only part of a TLS record has arrived
+                return
+            if not count:
+                self.eof = True
+                return
+            self.size += count
+            self.total += count
+            if self.size >= self.high_watermark:
+                self.paused = True
+
+    def flush(self) -> None:
+        """Send buffered bytes to dst until it would block or the buffer is empty.
+
+        Raises:
+            OSError: If sending fails (e.g. BrokenPipeError)
+        """
+        capacity = len(self.buffer)
+        while self.size:
+            start = self.head
+            end = start + min(self.size, capacity - start)
+            try:
+                sent = self.dst.send(self.view[start:end])
+            except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                return
+            self.size -= sent
+            self.head = (start + sent) % capacity
+            if sent < end - start:
+                return
+        # Start over at the front, so the next read gets the whole buffer
+        self.head = 0
+
+    def pending(self) -> bool:
+        """Return whether src holds decrypted bytes that no socket event will report."""
+        return isinstance(self.src, ssl.SSLSocket) and self.src.pending() > 0
+
+    def forward(self, readable: bool) -> None:
+        """Move bytes from src to dst, pausing and resuming reads at the watermarks.
+
+        Args:
+            readable: Whether src was reported readable
+
+        Raises:
+            OSError: If reading or sending fails
+        """
+        if readable:
+            self.fill()
+        self.flush()
+        while self.paused and self.size <= self.low_watermark:
+            self.paused = False
+            if not self.pending():
+                # The reactor reports further data once reading is resumed
+                return
+            self.fill()
+            self.flush()
+
+
+class Session:
+    """A device connection and the backend connection it is forwarded to.
+
+    Attributes:
+        client: TLS-PSK socket of the device
+        backend: Plain socket to the local HTTP/MQTT server
+        upstream: Pipe from the device to the backend
+        downstream: Pipe from the backend to the device
+        events: Socket → events it is currently registered for (0: not registered)
+        started: time.monotonic() when forwarding started
+        last_activity: time.monotonic() of the last socket event of the session
+    """
+
+    __slots__ = (
+        "client",
+        "backend",
+        "upstream",
+        "downstream",
+        "events",
+        "started",
+        "last_activity",
+    )
+
+    def __init__(
+        self, client: socket.socket, backend: socket.socket, buffer_size: int = SOCKET_BUFFER_SIZE
+    ) -> None:
+        """Pair a device socket with its backend socket.
+
+        Args:
+            client: TLS-PSK socket of the device
+            backend: Plain socket to the local HTTP/MQTT server
+            buffer_size: Bytes buffered per direction
+        """
+        self.client = client
+        self.backend = backend
+        self.upstream = Pipe(client, backend, buffer_size)
+        self.downstream = Pipe(backend, client, buffer_size)
+        self.events: Dict[socket.socket, int] = {client: 0, backend: 0}
+        self.started = self.last_activity = time.monotonic()
+
+    def pipes(self, sock: socket.socket) -> Tuple[Pipe, Pipe]:
+        """Return the pipes (reading from sock, writing to sock)."""
+        if sock is self.client:
+            return self.upstream, self.downstream
+        return self.downstream, self.upstream
+
+    def wanted_events(self, sock: socket.socket) -> int:
+        """Return the events the reactor must watch on sock."""
+        outgoing, incoming = self.pipes(sock)
+        events = 0
+        if not outgoing.paused and not outgoing.eof:
+            events |= selectors.EVENT_READ
+        if incoming.size:
+            events |= selectors.EVENT_WRITE
+        return events
+
+
+class IdleReaper:
+    """Closes the sessions of a listener that have been idle for too long.
+
+    Sessions are kept in a timer wheel: a ring of slots, one per
+    IDLE_CHECK_INTERVAL, each holding the sessions whose deadline falls into
+    it. Forwarding only updates Session.last_activity and never touches the
+    wheel. When the wheel reaches a slot, its sessions that saw activity in
+    the meantime move on to the slot of their new deadline and the others
+    are expired. A check thus costs one step per session in the slot rather
+    than a pass over all sessions, and a listener needs a single reactor
+    timer, which only runs while it has sessions.
+
+    Attributes:
+        reactor: Event loop running the checks
+        timeout: Seconds without activity after which a session is expired
+        expire: Called with each idle session, after removing it from the wheel
+        interval: Seconds per slot, the granularity of the check
+        slots: The wheel, sessions per slot
+        position: Index of the slot checked last
+        slot_of: Session → index of its slot
+        timer: The next check, None while the wheel is empty
+    """
+
+    def __init__(
+        self,
+        reactor: "Reactor",
+        timeout: float,
+        expire: Callable[[Session], None],
+        interval: float = IDLE_CHECK_INTERVAL,
+    ) -> None:
+        """Create an empty wheel covering timeout.
+
+        Args:
+            reactor: Event loop running the checks
+            timeout: Seconds without activity after which a session is expired
+            expire: Called with each idle session
+            interval: Seconds per slot
+        """
+        self.reactor = reactor
+        self.timeout = timeout
+        self.expire = expire
+        self.interval = interval
+        self.slots: List[Set[Session]] = [set() for _ in range(self.ticks(timeout) + 1)]
+        self.position = 0
+        self.slot_of: Dict[Session, int] = {}
+        self.timer: Optional[Timer] = None
+
+    def ticks(self, delay: float) -> int:
+        """Return the number of slots to advance for a deadline delay seconds ahead."""
+        return max(1, math.ceil(delay / self.interval))
+
+    def add(self, session: Session, delay: Optional[float] = None) -> None:
+        """Put a session into the slot of its deadline (default: a full timeout ahead)."""
+        index = (self.position + self.ticks(self.timeout if delay is None else delay)) % len(
+            self.slots
+        )
+        self.slots[index].add(session)
+        self.slot_of[session] = index
+        if self.timer is None:
+            self.timer = self.reactor.call_later(self.interval, self.check)
+
+    def discard(self, session: Session) -> None:
+        """Remove a session from the wheel, if it is in it."""
+        index = self.slot_of.pop(session, None)
+        if index is not None:
+            self.slots[index].discard(session)
+
+    def check(self) -> None:
+        """Advance by one slot and expire its idle sessions (timer callback)."""
+        self.position = (self.position + 1) % len(self.slots)
+        due = self.slots[self.position]
+        self.slots[self.position] = set()
+        now = time.monotonic()
+        for session in due:
+            del self.slot_of[session]
+            idle = now - session.last_activity
+            if idle >= self.timeout:
+                self.expire(session)
+            else:
+                self.add(session, self.timeout - idle)
+        self.timer = None
+        if self.slot_of:
+            self.timer = self.reactor.call_later(self.interval, self.check)
+
+
+class BackendPool:
+    """Warm connections to one backend server, connected ahead of time.
+
+    Connecting to the backend is then off the critical path of a device
+    request: a session takes an idle connection that is already established
+    and the pool opens a replacement in the background (non-blocking connect
+    on the reactor). The backend keeps the idle connections open as HTTP
+    keep-alive connections.
+
+    The proxy forwards bytes without parsing HTTP, so it cannot tell whether
+    a device left a response half-read; every connection therefore serves
+    one session and is closed with it. Idle connections the backend has
+    closed are detected and dropped when they are taken.
+
+    Attributes:
+        host: Backend host
+        port: Backend port
+        size: Number of idle connections to keep
+        idle: Established, unused connections (oldest first)
+        connecting: File descriptor → connection being established
+        hits: Sessions that got a warm connection
+        misses: Sessions that had to connect on demand (pool empty)
+        stale: Idle connections found closed by the backend
+        retry: Timer of the next fill after a failed connect, if any
+        label: "host:port", used as metric label
+    """
+
+    def __init__(
+        self, host: str, port: int, reactor: "Reactor", size: int = BACKEND_POOL_SIZE
+    ) -> None:
+        """Create an empty pool; call fill() to start connecting.
+
+        Args:
+            host: Backend host
+            port: Backend port
+            reactor: Event loop the connections are established on
+            size: Number of idle connections to keep
+        """
+        self.host = host
+        self.port = port
+        self.reactor = reactor
+        self.size = size
+        self.idle: Deque[socket.socket] = deque()
+        self.connecting: Dict[int, socket.socket] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.retry: Optional[Timer] = None
+        self.label = "%s:%d" % (host, port)
+
+    def fill(self) -> None:
+        """Start connecting until idle and pending connections reach size."""
+        while self.retry is None and len(self.idle) + len(self.connecting) < self.size:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex((self.host, self.port))
+            if err not in (0, errno.EINPROGRESS):
+                sock.close()
+                self.retry_later()
+                return
+            self.connecting[sock.fileno()] = sock
+            self.reactor.register(sock, self.connected_cb, selectors.EVENT_WRITE)
+
+    def retry_later(self) -> None:
+        """Try to fill the pool again after BACKEND_RETRY_DELAY."""
+        if self.retry is None:
+            self.retry = self.reactor.call_later(BACKEND_RETRY_DELAY, self.retry_fill)
+
+    def retry_fill(self) -> None:
+        """Fill the pool after a failed connect (timer callback)."""
+        self.retry = None
+        self.fill()
+
+    def connected_cb(self, sock: socket.socket, mask: int) -> None:
+        """Move a connection to idle once established (reactor callback)."""
+        self.connecting.pop(sock.fileno(), None)
+        self.reactor.unregister(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            sock.close()
+            self.retry_later()
+            return
+        self.idle.append(sock)
+
+    def get(self) -> socket.socket:
+        """Return a connection to the backend, warm if one is available.
+
+        Returns:
+            A connected socket
+
+        Raises:
+            OSError: If no warm connection is available and connecting fails
+        """
+        while self.idle:
+            sock = self.idle.popleft()
+            if self.alive(sock):
+                self.hits += 1
+                backend_connections.inc((self.label, "hit"))
+                self.fill()
+                return sock
+            self.stale += 1
+            backend_connections.inc((self.label, "stale"))
+            sock.close()
+        self.misses += 1
+        backend_connections.inc((self.label, "miss"))
+        self.fill()
+        return client(self.host, self.port)
+
+    @staticmethod
+    def alive(sock: socket.socket) -> bool:
+        """Return whether an idle connection is still open and has nothing to read."""
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        # EOF, or bytes nobody asked for
+        return False
+
+    def close(self) -> None:
+        """Close all idle and pending connections and stop refilling."""
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+        self.size = 0
+        for sock in self.connecting.values():
+            self.reactor.unregister(sock)
+            sock.close()
+        self.connecting.clear()
+        while self.idle:
+            self.idle.popleft().close()
+
+    def summary(self) -> str:
+        """Return one line with the pool statistics."""
+        return "backend pool %s: %d idle, %d hits, %d misses, %d stale" % (
+            self.label,
+            len(self.idle),
+            self.hits,
+            self.misses,
+            self.stale,
+        )
+
+
 def gen_psk(identity: bytes, hint: bytes) -> bytes:
     """Generate pre-shared key from device identity and hint using AES-CBC.
 
@@ -195,6 +902,62 @@ def gen_psk(identity: bytes, hint: bytes) -> bytes:
     return psk
 
 
+class PskCache:
+    """Bounded LRU cache of derived PSKs keyed by (identity, hint).
+
+    Devices that reconnect in a loop (typically to MQTT-TLS) present the same
+    identity every time, so their key is only derived, and logged, once.
+
+    Attributes:
+        maxsize: Maximum number of keys kept; the least recently used is dropped
+        hits: Lookups answered from the cache
+        misses: Lookups that called gen_psk()
+    """
+
+    def __init__(self, maxsize: int = PSK_CACHE_SIZE) -> None:
+        """Create an empty cache holding up to maxsize keys."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[bytes, bytes], bytes]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Return the number of cached keys."""
+        return len(self._entries)
+
+    def get(self, identity: bytes, hint: bytes) -> bytes:
+        """Return the PSK for identity and hint, deriving it on a miss.
+
+        Args:
+            identity: The device identity bytes from the TLS-PSK client hello
+            hint: The PSK hint bytes
+
+        Returns:
+            The 32-byte pre-shared key, as gen_psk() returns it
+        """
+        key = (identity, hint)
+        psk = self._entries.get(key)
+        if psk is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return psk
+        self.misses += 1
+        psk = self._entries[key] = gen_psk(identity, hint)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return psk
+
+
+# PSKs of all listeners; a device uses the same identity on every port
+psk_cache = PskCache()
+metrics.counter(
+    "psk_cache_lookups_total",
+    "PSK cache lookups by result",
+    ("result",),
+    collect=lambda: {("hit",): psk_cache.hits, ("miss",): psk_cache.misses},
+)
+
+
 class PskFrontend:
     """TLS-PSK frontend proxy that decrypts and forwards device connections.
 
@@ -206,28 +969,71 @@ class PskFrontend:
     5. Encrypts responses and sends back to device
 
     Each PskFrontend instance handles one port mapping (e.g., 443→80 or 8886→1883).
-    Multiple sessions can be active simultaneously, tracked in the sessions list.
+    Its listening socket and the sockets of all its sessions are registered
+    with a Reactor, which may be shared with other PskFrontend instances.
+    A dict from file descriptor to (session, peer socket) finds the
+    destination of readable data in O(1), however many sessions are active.
+
+    TLS-PSK handshakes run non-blocking on the reactor: a device that stalls
+    mid-handshake only occupies its own socket until HANDSHAKE_TIMEOUT, while
+    all other handshakes and sessions keep going. Handshake results and
+    durations are recorded in the module's metrics registry.
+
+    The TLS-PSK context is built once per listener, and derived keys are
+    looked up in the module's PskCache, so a reconnecting device costs a
+    handshake but no key derivation.
+
+    Each direction of a session is buffered in a Pipe of buffer_size bytes.
+    A socket is watched for writability only while bytes for it are
+    buffered, and reading from the faster side is paused while the buffer
+    towards the slower side is full.
+
+    With pool_size > 0 (meant for the HTTP mapping), backend connections
+    are taken from a BackendPool of warm connections. MQTT sessions are
+    long-lived, so MQTT mappings connect one backend socket per session.
+
+    Sessions that forward nothing for idle_timeout seconds are closed by an
+    IdleReaper. Every closed session is logged with its byte counts,
+    duration and the reason it was closed.
 
     Attributes:
         listening_host: IP address to listen on (e.g., "10.42.42.1")
         listening_port: Port to accept TLS-PSK connections (e.g., 443, 8886)
         host: Backend server IP to forward to (e.g., "10.42.42.1")
         port: Backend server port to forward to (e.g., 80, 1883)
+        reactor: Event loop the sockets are registered with
         server_sock: The listening socket accepting new connections
-        sessions: List of (client_ssl_socket, backend_socket) tuples for active connections
+        sessions: Active sessions
+        peers: File descriptor → (session, socket the data is forwarded to)
+        handshakes: File descriptor → handshake in progress
+        handshake_timeout: Seconds a device may take to complete the handshake
         hint: PSK hint bytes used for key derivation during handshake
+        context: TLS-PSK server context shared by all connections of this listener
+        buffer_size: Bytes buffered per direction of a session
+        pool: Warm backend connections, None to connect per session
+        reaper: Closes idle sessions, None if idle sessions are kept
+        accept_timer: Resumes accepting after a failed accept(), None while accepting
 
     Example:
-        >>> # Create HTTPS→HTTP proxy
-        >>> proxy = PskFrontend("10.42.42.1", 443, "10.42.42.1", 80)
-        >>> # In event loop:
-        >>> readables = proxy.readables()
-        >>> r, _, _ = select.select(readables, [], [])
-        >>> for s in r:
-        ...     proxy.data_ready_cb(s)
+        >>> # Create HTTPS→HTTP and MQTT-TLS→MQTT proxies on one event loop
+        >>> reactor = Reactor()
+        >>> https = PskFrontend("10.42.42.1", 443, "10.42.42.1", 80, reactor, pool_size=8)
+        >>> mqtt = PskFrontend("10.42.42.1", 8886, "10.42.42.1", 1883, reactor)
+        >>> reactor.run()
     """
 
-    def __init__(self, listening_host: str, listening_port: int, host: str, port: int) -> None:
+    def __init__(
+        self,
+        listening_host: str,
+        listening_port: int,
+        host: str,
+        port: int,
+        reactor: Optional[Reactor] = None,
+        buffer_size: int = SOCKET_BUFFER_SIZE,
+        pool_size: int = 0,
+        reuse_port: bool = False,
+        idle_timeout: Optional[float] = None,
+    ) -> None:
         """Initialize PSK frontend proxy with listening and backend addresses.
 
         Args:
@@ -235,61 +1041,182 @@ class PskFrontend:
             listening_port: Port for TLS-PSK connections (443 or 8886)
             host: Backend server IP to forward decrypted traffic
             port: Backend server port (80 for HTTP, 1883 for MQTT)
+            reactor: Event loop to register with; a private one is created if None
+            buffer_size: Bytes buffered per direction of a session
+            pool_size: Warm backend connections to keep (0: connect per session)
+            reuse_port: Bind the listener with SO_REUSEPORT (worker processes)
+            idle_timeout: Seconds a session may be idle before it is closed
+                (default: from IDLE_TIMEOUTS by listening port; 0: never)
         """
         self.listening_port: int = listening_port
         self.listening_host: str = listening_host
         self.host: str = host
         self.port: int = port
-
-        self.server_sock: socket.socket = listener(listening_host, listening_port)
-        self.sessions: List[Tuple[socket.socket, socket.socket]] = []
+        self.reactor: Reactor = reactor or Reactor()
+        self.buffer_size: int = buffer_size
+
+        self.server_sock: socket.socket = listener(listening_host, listening_port, reuse_port)
+        self.server_sock.setblocking(False)
+        self.sessions: Set[Session] = set()
+        self.peers: Dict[int, Tuple[Session, socket.socket]] = {}
+        self.handshakes: Dict[int, Handshake] = {}
+        self.handshake_timeout: float = HANDSHAKE_TIMEOUT
         self.hint: bytes = PSK_HINT
+        self.context: SSLPSKContext = self.psk_context()
+        self.reactor.register(self.server_sock, self.data_ready_cb)
+        self.accept_timer: Optional[Timer] = None
+        self.pool: Optional[BackendPool] = None
+        if pool_size > 0:
+            self.pool = BackendPool(host, port, self.reactor, pool_size)
+            self.pool.fill()
+        if idle_timeout is None:
+            idle_timeout = IDLE_TIMEOUTS.get(listening_port, DEFAULT_IDLE_TIMEOUT)
+        self.reaper: Optional[IdleReaper] = None
+        if idle_timeout > 0:
+            self.reaper = IdleReaper(self.reactor, idle_timeout, self.session_idle)
+
+    def close(self) -> None:
+        """Stop accepting connections; handshakes and sessions in progress continue."""
+        if self.accept_timer is not None:
+            self.accept_timer.cancel()
+            self.accept_timer = None
+        self.reactor.unregister(self.server_sock)
+        self.server_sock.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    def connect_backend(self) -> socket.socket:
+        """Return a connection to the backend server, from the pool if there is one.
+
+        Raises:
+            OSError: If connecting fails (e.g., service not running)
+        """
+        if self.pool is not None:
+            return self.pool.get()
+        return client(self.host, self.port)
 
-    def readables(self) -> List[socket.socket]:
-        """Return list of all sockets to monitor for readable data.
+    def psk_context(self) -> SSLPSKContext:
+        """Create the TLS-PSK server context for the connections of this listener.
 
-        Collects sockets from:
-        - The listening socket (for new client connections)
-        - All client SSL sockets (encrypted data from devices)
-        - All backend sockets (plaintext data from local servers)
+        Returns:
+            A context limited to TLSv1.2 and PSK-AES128-CBC-SHA256 that looks
+            up the PSK of the client identity in psk_cache
+        """
+        context = SSLPSKContext(ssl.PROTOCOL_TLS_SERVER)
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers("PSK-AES128-CBC-SHA256")
+        # sslpsk3 (like ssl in Python 3.13+) passes identity and hint as str
+        context.set_psk_server_callback(
+            lambda identity: psk_cache.get((identity or "").encode(), self.hint),
+            identity_hint=self.hint.decode(),
+        )
+        return context
+
+    def add_session(self, client_sock: socket.socket, backend_sock: socket.socket) -> Session:
+        """Start forwarding between a device socket and its backend socket.
 
-        This list is used with select.select() to implement non-blocking I/O.
+        Args:
+            client_sock: TLS-PSK socket of the device
+            backend_sock: Connected socket to the backend server
 
         Returns:
-            List of socket objects to monitor for incoming data.
+            The new session
+        """
+        session = Session(client_sock, backend_sock, self.buffer_size)
+        client_sock.setblocking(False)
+        backend_sock.setblocking(False)
+        try:
+            self.update_events(session)
+        except (KeyError, ValueError, OSError):
+            self.reactor.unregister(client_sock)
+            self.reactor.unregister(backend_sock)
+            raise
+        self.peers[client_sock.fileno()] = (session, backend_sock)
+        self.peers[backend_sock.fileno()] = (session, client_sock)
+        self.sessions.add(session)
+        active_sessions.inc((str(self.listening_port),))
+        if self.reaper is not None:
+            self.reaper.add(session)
+        return session
+
+    def update_events(self, session: Session) -> None:
+        """Register the sockets of a session for the events its pipes need."""
+        for sock in (session.client, session.backend):
+            events = session.wanted_events(sock)
+            current = session.events[sock]
+            if events == current:
+                continue
+            if not events:
+                self.reactor.unregister(sock)
+            elif not current:
+                self.reactor.register(sock, self.data_ready_cb, events)
+            else:
+                self.reactor.modify(sock, self.data_ready_cb, events)
+            session.events[sock] = events
+
+    def session_idle(self, session: Session) -> None:
+        """Close a session that has been idle for too long (IdleReaper callback)."""
+        self.close_session(session, "idle")
+
+    def close_session(self, session: Session, reason: str = "closed") -> None:
+        """Stop forwarding, shut down and close both sockets of a session.
+
+        Safe to call more than once for the same session.
 
-        Example:
-            >>> proxy = PskFrontend("10.42.42.1", 443, "10.42.42.1", 80)
-            >>> sockets = proxy.readables()
-            >>> len(sockets) >= 1  # At minimum, the server socket
-            True
+        Args:
+            session: The session
+            reason: Why it ends, for the log line: "closed", "error" or "idle"
         """
-        readables = [self.server_sock]
-        for s1, s2 in self.sessions:
-            readables.append(s1)
-            readables.append(s2)
-        return readables
+        if session not in self.sessions:
+            return
+        self.sessions.discard(session)
+        active_sessions.inc((str(self.listening_port),), -1)
+        if self.reaper is not None:
+            self.reaper.discard(session)
+        print(
+            "session on port %d %s: %d bytes up, %d bytes down, %.1f s"
+            % (
+                self.listening_port,
+                reason,
+                session.upstream.total,
+                session.downstream.total,
+                time.monotonic() - session.started,
+            )
+        )
+        for sock in (session.client, session.backend):
+            self.peers.pop(sock.fileno(), None)
+            self.reactor.unregister(sock)
+        for sock in (session.client, session.backend):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Peer already gone
+                pass
+            sock.close()
 
     def new_client(self, s1: socket.socket) -> None:
-        """Handle new client connection by setting up TLS-PSK and backend connection.
+        """Start the TLS-PSK handshake of a new device connection.
 
-        Performs TLS-PSK handshake with the device and creates a corresponding
-        connection to the backend server. The two sockets are paired as a session
-        for bidirectional data forwarding.
+        The handshake runs non-blocking: the TLS socket is registered with the
+        reactor, and handshake_cb() continues the handshake whenever the device
+        sends more data. Once it completes, a connection to the backend server
+        is opened and the two sockets are paired as a session for
+        bidirectional data forwarding.
 
         Process:
-        1. Create TLS-PSK context with TLSv1.2 and PSK-AES128-CBC-SHA256 cipher
-        2. Set PSK callback to derive key from device identity
-        3. Perform TLS handshake with device
-        4. Connect to backend server (HTTP/MQTT)
-        5. Add socket pair to sessions list
+        1. Wrap the socket with the listener's TLS-PSK context, without handshaking
+        2. Start the handshake timeout
+        3. Drive the handshake from reactor events (handshake_cb); the PSK
+           callback derives the key from the device identity (psk_cache)
+        4. Connect to backend server (HTTP/MQTT) and register the session
 
         Args:
             s1: The accepted client socket from the device. Will be wrapped with
                 TLS-PSK encryption.
 
         Side Effects:
-            - Adds (ssl_socket, backend_socket) tuple to self.sessions
+            - Adds a Handshake to self.handshakes, and after the handshake a
+              Session of (ssl_socket, backend_socket) to self.sessions
             - Prints connection info and any errors to stdout
 
         Note:
@@ -305,102 +1232,731 @@ class PskFrontend:
             ID: 004241...
             PSK: a1b2c3...
         """
+        started = time.monotonic()
         try:
-            # Create SSLPSKContext for TLS-PSK connection
-            context = SSLPSKContext(ssl.PROTOCOL_TLS_SERVER)
-            context.maximum_version = ssl.TLSVersion.TLSv1_2
-            context.set_ciphers("PSK-AES128-CBC-SHA256")
-            context.set_psk_server_callback(
-                lambda identity: gen_psk(identity, self.hint), identity_hint=self.hint
+            s1.setblocking(False)
+            ssl_sock = self.context.wrap_socket(s1, server_side=True, do_handshake_on_connect=False)
+            # sslpsk3 installs the PSK callbacks on every do_handshake() call,
+            # which also resets a handshake in progress; install them once here
+            # and continue with the plain SSLSocket handshake (handshake_cb).
+            self.context.setup_psk_callbacks(ssl_sock)
+            timer = self.reactor.call_later(
+                self.handshake_timeout, self.handshake_timed_out, ssl_sock
             )
+            self.handshakes[ssl_sock.fileno()] = Handshake(ssl_sock, started, timer)
+            self.reactor.register(ssl_sock, self.handshake_cb)
+        except ssl.SSLError as e:
+            self.ssl_error(e)
+            s1.close()
+            return
+        except Exception as e:
+            print(e)
+            s1.close()
+            return
+        # The ClientHello has usually arrived together with the connection
+        self.handshake_cb(ssl_sock, selectors.EVENT_READ)
+
+    def ssl_error(self, e: ssl.SSLError) -> None:
+        """Print a failed handshake, with a hint for non-Tuya clients."""
+        print("could not establish sslpsk socket:", e)
+        if e and (
+            "NO_SHARED_CIPHER" in e.reason
+            or "WRONG_VERSION_NUMBER" in e.reason
+            or "WRONG_SSL_VERSION" in e.reason
+        ):
+            print("don't panic this is probably just your phone!")
+
+    def handshake_cb(self, s: socket.socket, mask: int) -> None:
+        """Continue a handshake when its socket is ready (reactor callback).
 
-            ssl_sock = context.wrap_socket(s1, server_side=True)
-
-            s2 = client(self.host, self.port)
-            self.sessions.append((ssl_sock, s2))
+        Args:
+            s: TLS socket of the device
+            mask: Ready events reported by the reactor
+        """
+        handshake = self.handshakes.get(s.fileno())
+        if handshake is None:
+            return
+        sock = handshake.sock
+        try:
+            ssl.SSLSocket.do_handshake(sock)
+        except ssl.SSLWantReadError:
+            self.reactor.modify(sock, self.handshake_cb, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.reactor.modify(sock, self.handshake_cb, selectors.EVENT_WRITE)
+            return
         except ssl.SSLError as e:
-            print("could not establish sslpsk socket:", e)
-            if e and (
-                "NO_SHARED_CIPHER" in e.reason
-                or "WRONG_VERSION_NUMBER" in e.reason
-                or "WRONG_SSL_VERSION" in e.reason
-            ):
-                print("don't panic this is probably just your phone!")
+            self.ssl_error(e)
+            self.end_handshake(handshake, "failed")
+            sock.close()
+            return
+        except OSError as e:
+            print(e)
+            self.end_handshake(handshake, "failed")
+            sock.close()
+            return
+        self.end_handshake(handshake, "ok")
+        try:
+            s2 = self.connect_backend()
+            self.add_session(sock, s2)
         except Exception as e:
             print(e)
+            sock.close()
+
+    def handshake_timed_out(self, sock: ssl.SSLSocket) -> None:
+        """Drop a device that did not complete the handshake in time (timer callback)."""
+        handshake = self.handshakes.get(sock.fileno())
+        if handshake is None:
+            return
+        print("handshake timeout on port %d" % self.listening_port)
+        self.end_handshake(handshake, "timeout")
+        sock.close()
+
+    def end_handshake(self, handshake: Handshake, result: str) -> None:
+        """Stop tracking a handshake and record its result and duration.
+
+        Args:
+            handshake: The finished handshake
+            result: "ok", "failed" or "timeout"
+        """
+        self.handshakes.pop(handshake.sock.fileno(), None)
+        handshake.timer.cancel()
+        self.reactor.unregister(handshake.sock)
+        port = str(self.listening_port)
+        handshake_results.inc((port, result))
+        if result == "ok":
+            handshake_durations.observe((port,), time.monotonic() - handshake.started)
+
+    def pause_accept(self) -> None:
+        """Stop watching the listening socket for ACCEPT_RETRY_DELAY seconds.
+
+        The selector is level-triggered: while accept() fails (e.g. the
+        process is out of file descriptors) the queued connection keeps the
+        listener readable, and retrying on every wakeup would spin the CPU.
+        """
+        self.reactor.unregister(self.server_sock)
+        self.accept_timer = self.reactor.call_later(ACCEPT_RETRY_DELAY, self.resume_accept)
 
-    def data_ready_cb(self, s: socket.socket) -> None:
-        """Handle readable data on a socket (new connection or data transfer).
+    def resume_accept(self) -> None:
+        """Watch the listening socket again after pause_accept() (timer callback)."""
+        self.accept_timer = None
+        self.reactor.register(self.server_sock, self.data_ready_cb)
 
-        Called when select.select() indicates a socket has readable data. This
+    def data_ready_cb(self, s: socket.socket, mask: int = selectors.EVENT_READ) -> None:
+        """Handle a ready socket (new connection or data transfer).
+
+        Called by the reactor when a registered socket is ready. This
         method handles two cases:
         1. New connection on server socket - accepts and sets up TLS-PSK session
-        2. Data on session socket - forwards data to the paired socket
+        2. Session socket - readable: reads into the pipe towards its peer and
+           sends as much as the peer accepts; writable: sends the bytes
+           buffered for it
 
         Data Flow:
-            Device → SSL Socket → Decrypt → Backend Socket → Local Server
-            Device ← SSL Socket ← Encrypt ← Backend Socket ← Local Server
+            Device → SSL Socket → Decrypt → upstream Pipe → Backend Socket → Local Server
+            Device ← SSL Socket ← Encrypt ← downstream Pipe ← Backend Socket ← Local Server
 
         Connection Lifecycle:
-        - Empty recv() (0 bytes) indicates graceful close - both sockets shut down
+        - Empty recv (0 bytes) indicates graceful close - the bytes already
+          buffered for the peer are sent, then both sockets are shut down
         - Socket errors (OSError, BrokenPipeError) indicate abrupt close - session removed
-        - Session is removed from sessions list on any closure
+        - Session is removed from sessions and its sockets closed on any closure
 
         Args:
-            s: The socket that has readable data (from select.select() result).
-                Can be the server socket (new connection) or a session socket (data).
+            s: The ready socket. Can be the server socket (new connection)
+                or a session socket (data).
+            mask: Ready events reported by the reactor
 
         Side Effects:
             - Accepts new connections and creates sessions
             - Forwards data between socket pairs
-            - Removes closed sessions from sessions list
+            - Removes closed sessions from sessions and peers
             - Prints connection info and errors to stdout
 
         Example:
             >>> proxy = PskFrontend("10.42.42.1", 443, "10.42.42.1", 80)
-            >>> readables = proxy.readables()
-            >>> r, _, _ = select.select(readables, [], [])
-            >>> for sock in r:
-            ...     proxy.data_ready_cb(sock)
+            >>> proxy.reactor.poll()  # Calls data_ready_cb for ready sockets
             new client on port 443 from 192.168.1.100:54321
         """
-        if s == self.server_sock:
-            _s, frm = s.accept()
-            print("new client on port %d from %s:%d" % (self.listening_port, frm[0], frm[1]))
-            self.new_client(_s)
-
-        for s1, s2 in self.sessions:
-            if s == s1 or s == s2:
-                c = s1 if s == s2 else s2
+        if s is self.server_sock:
+            # Accept every pending connection, not one per wakeup
+            while True:
                 try:
-                    buf = s.recv(SOCKET_BUFFER_SIZE)
-                    if len(buf) > 0:
-                        c.send(buf)
-                    else:
-                        s1.shutdown(socket.SHUT_RDWR)
-                        s2.shutdown(socket.SHUT_RDWR)
-                        self.sessions.remove((s1, s2))
-                except (OSError, ValueError, BrokenPipeError) as e:
-                    # Handle socket errors, connection issues, and session removal errors
-                    print(f"Session error: {e}")
-                    try:
-                        self.sessions.remove((s1, s2))
-                    except ValueError:
-                        # Session already removed
-                        pass
+                    _s, frm = s.accept()
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as e:
+                    # E.g. EMFILE; the connection stays queued, so the listener
+                    # would be reported ready again at once
+                    print(f"accept failed: {e}")
+                    self.pause_accept()
+                    return
+                print("new client on port %d from %s:%d" % (self.listening_port, frm[0], frm[1]))
+                self.new_client(_s)
+
+        entry = self.peers.get(s.fileno())
+        if entry is None:
+            return
+        session = entry[0]
+        session.last_activity = time.monotonic()
+        outgoing, incoming = session.pipes(s)
+        try:
+            if mask & selectors.EVENT_WRITE:
+                incoming.forward(readable=False)
+            if mask & selectors.EVENT_READ:
+                outgoing.forward(readable=True)
+        except (OSError, ValueError) as e:
+            # Handle socket errors and connection issues
+            print(f"Session error: {e}")
+            self.close_session(session, "error")
+            return
+        if (outgoing.eof and not outgoing.size) or (incoming.eof and not incoming.size):
+            self.close_session(session)
+            return
+        self.update_events(session)
+
+
+def stats_summary(registry: MetricsRegistry = metrics) -> List[str]:
+    """Return the handshake, session, PSK cache and backend pool statistics as log lines.
+
+    Args:
+        registry: The metrics of this process, or the merged metrics of all workers
+    """
+
+    def values(name: str) -> Dict[Tuple[str, ...], Any]:
+        # Merged registries only have the families some worker reported
+        family = registry.families.get(name)
+        return family.values() if family is not None else {}
+
+    lines = []
+    results = values("psk_handshakes_total")
+    sessions = values("psk_sessions")
+    durations = registry.families.get("psk_handshake_duration_seconds")
+    for port in sorted({labels[0] for labels in results}, key=int):
+        p50 = durations.quantile((port,), 0.5) if durations is not None else 0.0
+        p99 = durations.quantile((port,), 0.99) if durations is not None else 0.0
+        lines.append(
+            "handshakes on port %s: %d ok, %d failed, %d timed out, p50 %.1f ms, p99 %.1f ms, "
+            "%d sessions"
+            % (
+                port,
+                results.get((port, "ok"), 0),
+                results.get((port, "failed"), 0),
+                results.get((port, "timeout"), 0),
+                p50 * 1000,
+                p99 * 1000,
+                sessions.get((port,), 0),
+            )
+        )
+    cache = values("psk_cache_lookups_total")
+    lines.append(
+        "psk cache: %d hits, %d misses" % (cache.get(("hit",), 0), cache.get(("miss",), 0))
+    )
+    pools = values("psk_backend_connections_total")
+    for backend in sorted({labels[0] for labels in pools}):
+        lines.append(
+            "backend pool %s: %d hits, %d misses, %d stale"
+            % (
+                backend,
+                pools.get((backend, "hit"), 0),
+                pools.get((backend, "miss"), 0),
+                pools.get((backend, "stale"), 0),
+            )
+        )
+    return lines
+
+
+class Mapping(NamedTuple):
+    """A TLS-PSK listener and the backend it forwards to.
+
+    Attributes:
+        listen_host: IP address to listen on, e.g. the gateway of an AP
+        listen_port: TLS-PSK port, e.g. 443 or 8886
+        host: Backend server IP
+        port: Backend server port, e.g. 80 or 1883
+        pool_size: Warm backend connections to keep (0: connect per session)
+        idle_timeout: Seconds before an idle session is closed (None: by
+            port, see IDLE_TIMEOUTS; 0: never)
+    """
+
+    listen_host: str
+    listen_port: int
+    host: str
+    port: int
+    pool_size: int = 0
+    idle_timeout: Optional[float] = None
+
+
+def gateway_mappings(gateway: str) -> List[Mapping]:
+    """Return the standard mappings of a gateway: 443→80 (with pool) and 8886→1883."""
+    return [
+        Mapping(gateway, HTTPS_PORT, gateway, HTTP_PORT, BACKEND_POOL_SIZE),
+        Mapping(gateway, MQTT_ALT_PORT, gateway, MQTT_PORT),
+    ]
+
+
+def parse_mapping(text: str) -> Mapping:
+    """Parse a mapping written as LISTEN_HOST:PORT=BACKEND_HOST:PORT[,pool=N][,idle=S].
+
+    Args:
+        text: The mapping, e.g. "10.42.43.1:443=10.42.43.1:80,pool=8,idle=60"
+
+    Returns:
+        The parsed mapping
+
+    Raises:
+        ValueError: If the text is not a valid mapping
+    """
+    spec, *options = text.strip().split(",")
+    try:
+        listen, backend = spec.split("=")
+        listen_host, listen_port = listen.rsplit(":", 1)
+        host, port = backend.rsplit(":", 1)
+        pool_size = 0
+        idle_timeout = None
+        for option in options:
+            name, value = option.split("=")
+            name = name.strip()
+            if name == "pool":
+                pool_size = int(value)
+            elif name == "idle":
+                idle_timeout = float(value)
+            else:
+                raise ValueError("unknown option %r" % name)
+        return Mapping(
+            listen_host.strip(), int(listen_port), host.strip(), int(port), pool_size, idle_timeout
+        )
+    except ValueError as e:
+        raise ValueError("invalid mapping %r: %s" % (text, e)) from None
+
+
+def load_mappings(path: str) -> List[Mapping]:
+    """Read a mapping table: one parse_mapping() entry per line, # starts a comment.
+
+    Args:
+        path: File with the mapping table
+
+    Returns:
+        The mappings, in file order
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If a line is not a valid mapping
+    """
+    mappings = []
+    with open(path) as table:
+        for line in table:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                mappings.append(parse_mapping(line))
+    return mappings
+
+
+class ProxyTable:
+    """The listeners of a mapping table on one reactor, changeable at runtime.
+
+    apply() starts listeners for new mappings and closes the listeners of
+    mappings that were removed or changed. Closing a listener only stops
+    new connections; its handshakes and sessions in progress continue.
+
+    Attributes:
+        reactor: Event loop of all listeners
+        reuse_port: Bind the listeners with SO_REUSEPORT (worker processes)
+        proxies: (listen host, listen port) → listener
+        mappings: (listen host, listen port) → mapping of the listener
+    """
+
+    def __init__(self, reactor: Reactor, reuse_port: bool = False) -> None:
+        """Create an empty table."""
+        self.reactor = reactor
+        self.reuse_port = reuse_port
+        self.proxies: Dict[Tuple[str, int], PskFrontend] = {}
+        self.mappings: Dict[Tuple[str, int], Mapping] = {}
+
+    def apply(self, mappings: List[Mapping]) -> None:
+        """Make the running listeners match a mapping table.
+
+        A listener that cannot be started (e.g. the address is not configured
+        yet) is reported and skipped; it is tried again on the next apply().
+
+        Args:
+            mappings: The complete mapping table
+        """
+        wanted = {(m.listen_host, m.listen_port): m for m in mappings}
+        for key, proxy in list(self.proxies.items()):
+            if wanted.get(key) != self.mappings[key]:
+                print("closing listener %s:%d" % key)
+                proxy.close()
+                del self.proxies[key]
+                del self.mappings[key]
+        for key, mapping in wanted.items():
+            if key in self.proxies:
+                continue
+            try:
+                self.proxies[key] = PskFrontend(
+                    mapping.listen_host,
+                    mapping.listen_port,
+                    mapping.host,
+                    mapping.port,
+                    self.reactor,
+                    pool_size=mapping.pool_size,
+                    reuse_port=self.reuse_port,
+                    idle_timeout=mapping.idle_timeout,
+                )
+            except OSError as e:
+                print("cannot listen on %s:%d: %s" % (key[0], key[1], e))
+                continue
+            self.mappings[key] = mapping
+            print("listening on %s:%d for %s:%d" % (key[0], key[1], mapping.host, mapping.port))
+
+
+def print_stats(reactor: Reactor, last: List[str]) -> None:
+    """Print stats_summary() if it changed, every STATS_INTERVAL (timer callback)."""
+    # Only print when something changed, to keep the psk log readable
+    summary = stats_summary()
+    if summary != last:
+        print("\n".join(summary))
+    reactor.call_later(STATS_INTERVAL, print_stats, reactor, summary)
+
+
+def serve(
+    load: Callable[[], List[Mapping]], reuse_port: bool = False, report_fd: Optional[int] = None
+) -> None:
+    """Run the listeners of a mapping table until interrupted.
+
+    SIGHUP calls load() again and applies the new table; if it fails, the
+    current listeners are kept.
+
+    Args:
+        load: Returns the mapping table
+        reuse_port: Bind the listeners with SO_REUSEPORT (worker processes)
+        report_fd: Pipe to a supervisor; a JSON snapshot of the metrics is
+            written to it as one line every WORKER_REPORT_INTERVAL. Without
+            one, stats_summary() is printed every STATS_INTERVAL.
+
+    Raises:
+        BrokenPipeError: When the supervisor is gone
+        SystemExit: If none of the listeners can be started
+    """
+    reactor = Reactor()
+    table = ProxyTable(reactor, reuse_port)
+    table.apply(load())
+    if not table.proxies:
+        print("no listener could be started")
+        sys.exit(1)
+
+    def reload() -> None:
+        try:
+            mappings = load()
+        except (OSError, ValueError) as e:
+            print("keeping the current mappings: %s" % e)
+            return
+        table.apply(mappings)
+
+    reactor.add_signal_handler(signal.SIGHUP, reload)
+    if report_fd is None:
+        reactor.call_later(STATS_INTERVAL, print_stats, reactor, [])
+    else:
+
+        def report() -> None:
+            os.write(report_fd, json.dumps(metrics.snapshot()).encode() + b"\n")
+            reactor.call_later(WORKER_REPORT_INTERVAL, report)
+
+        report()
+    reactor.run()
+
+
+def run_worker(load: Callable[[], List[Mapping]], report_fd: int) -> None:
+    """Run the listeners in a worker process and report its metrics to the supervisor.
+
+    Args:
+        load: Returns the mapping table
+        report_fd: Pipe to the supervisor
+
+    Raises:
+        BrokenPipeError: When the supervisor is gone
+    """
+    serve(load, reuse_port=True, report_fd=report_fd)
+
+
+class Worker:
+    """A worker process as seen by the supervisor.
+
+    Attributes:
+        index: Slot of the worker, kept across restarts
+        pid: Process ID
+        report_fd: Read end of the pipe the worker reports its metrics on
+        received: Bytes of an incomplete report line
+        snapshot: Last metrics snapshot reported by the worker
+    """
+
+    __slots__ = ("index", "pid", "report_fd", "received", "snapshot")
+
+    def __init__(self, index: int, pid: int, report_fd: int) -> None:
+        """Track a started worker."""
+        self.index = index
+        self.pid = pid
+        self.report_fd = report_fd
+        self.received = b""
+        self.snapshot: Dict[str, Any] = {}
+
+
+class Supervisor:
+    """Run workers in child processes, restart them when they exit and sum their metrics.
+
+    Each worker runs target(report_fd) in a forked process; target reports
+    metrics snapshots as JSON lines on report_fd (see run_worker()). The
+    counters and histograms of exited workers are kept, so the totals do not
+    drop when a worker is restarted; their gauges are dropped, as the
+    sessions and connections they counted are gone. A worker that exits with
+    an error before its first report could not start serving (e.g. no port
+    could be bound); it would fail the same way again, so the supervisor
+    stops instead of restarting it.
+
+    Attributes:
+        count: Number of workers to keep running
+        target: Function run in every worker process
+        workers: PID → running worker
+        restarts: Number of workers restarted
+        restart_delay: Minimum seconds between two starts of the same slot
+        retired: Summed counters and histograms of workers that exited
+        failure: Why the supervisor stopped, None while it runs
+    """
+
+    def __init__(self, count: int, target: Callable[[int], None]) -> None:
+        """Create a supervisor; start() forks the workers.
+
+        Args:
+            count: Number of workers to keep running
+            target: Function run in every worker with the report pipe
+        """
+        self.count = count
+        self.target = target
+        self.workers: Dict[int, Worker] = {}
+        self.restarts = 0
+        self.restart_delay = WORKER_RESTART_DELAY
+        self.retired = MetricsRegistry()
+        self.failure: Optional[str] = None
+        self.selector = selectors.DefaultSelector()
+        self._started: Dict[int, float] = {}
+        self._pending: Dict[int, float] = {}
+
+    def start(self) -> None:
+        """Fork all workers."""
+        for index in range(self.count):
+            self.start_worker(index)
+
+    def start_worker(self, index: int) -> None:
+        """Fork the worker of a slot."""
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Worker: default signal handling, so the supervisor can stop it
+            code = 0
+            try:
+                os.close(read_fd)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self.target(write_fd)
+            except BrokenPipeError:
+                pass
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                print("worker %d failed: %r" % (index, e))
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        os.close(write_fd)
+        worker = Worker(index, pid, read_fd)
+        self.workers[pid] = worker
+        self._started[index] = time.monotonic()
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+
+    def poll(self, timeout: float) -> None:
+        """Read worker reports, reap exited workers and restart them once.
+
+        Args:
+            timeout: Seconds to wait for reports at most
+        """
+        for key, _mask in self.selector.select(timeout):
+            if not self.read_report(key.data):
+                self.selector.unregister(key.fd)
+        self.reap()
+        now = time.monotonic()
+        for index, due in list(self._pending.items()):
+            if due <= now:
+                del self._pending[index]
+                self.restarts += 1
+                self.start_worker(index)
+
+    def read_report(self, worker: Worker) -> bool:
+        """Read reports of a worker and keep the last snapshot; False at end of file."""
+        data = os.read(worker.report_fd, 65536)
+        if not data:
+            return False
+        lines = (worker.received + data).split(b"\n")
+        worker.received = lines.pop()
+        for line in lines:
+            worker.snapshot = json.loads(line)
+        return True
+
+    def reap(self) -> None:
+        """Collect exited workers and schedule their restart."""
+        # Wait for our workers only; other children belong to someone else
+        for pid in list(self.workers):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                continue
+            worker = self.workers.pop(pid)
+            try:
+                self.selector.unregister(worker.report_fd)
+            except KeyError:
+                pass
+            while self.read_report(worker):
+                pass
+            os.close(worker.report_fd)
+            self.retired.merge(
+                {name: data for name, data in worker.snapshot.items() if data["type"] != GAUGE}
+            )
+            code = os.waitstatus_to_exitcode(status)
+            if code and not worker.snapshot:
+                failure = "worker %d (pid %d) exited with status %d before serving"
+                self.failure = failure % (worker.index, pid, code)
+                print(self.failure + ", not restarting")
+                continue
+            print(
+                "worker %d (pid %d) exited with status %d, restarting" % (worker.index, pid, code)
+            )
+            due = self._started[worker.index] + self.restart_delay
+            self._pending[worker.index] = max(due, time.monotonic())
+
+    def totals(self) -> MetricsRegistry:
+        """Return the summed metrics of all current and exited workers."""
+        total = MetricsRegistry()
+        total.merge(self.retired.snapshot())
+        for worker in self.workers.values():
+            total.merge(worker.snapshot)
+        return total
+
+    def stop(self) -> None:
+        """Terminate all workers and wait for them."""
+        self._pending.clear()
+        self.signal_workers(signal.SIGTERM)
+        for pid, worker in list(self.workers.items()):
+            os.waitpid(pid, 0)
+            os.close(worker.report_fd)
+        self.workers.clear()
+        self.selector.close()
+
+    def signal_workers(self, signum: int) -> None:
+        """Send a signal to all running workers."""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        """Start the workers and supervise them until interrupted or terminated.
+
+        SIGHUP is passed on to the workers, so they reload the mapping table.
+
+        Raises:
+            SystemExit: With status 1 if a worker could not start serving
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.signal_workers(signum))
+        self.start()
+        last: List[str] = []
+        next_stats = time.monotonic() + STATS_INTERVAL
+        try:
+            while self.failure is None:
+                self.poll(min(1.0, max(0.0, next_stats - time.monotonic())))
+                if time.monotonic() >= next_stats:
+                    next_stats += STATS_INTERVAL
+                    summary = stats_summary(self.totals())
+                    if summary != last:
+                        print("\n".join(summary))
+                    last = summary
+        finally:
+            self.stop()
+        print("stopping the workers: %s" % self.failure)
+        sys.exit(1)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line arguments of the proxy.
+
+    Args:
+        argv: Arguments without the program name, sys.argv[1:] if None
+
+    Returns:
+        The parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="TLS-PSK frontend proxy for Tuya devices",
+        epilog="Mappings are written as LISTEN_HOST:PORT=BACKEND_HOST:PORT[,pool=N][,idle=S]. "
+        "Send SIGHUP to re-read --config; listeners are added and removed, "
+        "sessions in progress are kept.",
+    )
+    parser.add_argument(
+        "--gateway",
+        action="append",
+        default=[],
+        help="gateway IP to serve 443->80 and 8886->1883 on; repeat for several APs "
+        "(default: %s unless --map or --config is given)" % DEFAULT_GATEWAY,
+    )
+    parser.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        type=parse_mapping,
+        help="additional mapping; may be repeated",
+    )
+    parser.add_argument("--config", help="file with one mapping per line, re-read on SIGHUP")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of proxy processes (0: one per CPU core, default: 1)",
+    )
+    args = parser.parse_args(argv)
+    if not (args.gateway or args.map or args.config):
+        args.gateway = [DEFAULT_GATEWAY]
+    return args
+
+
+def mapping_table(args: argparse.Namespace) -> List[Mapping]:
+    """Return the mappings of the command line, reading --config again.
+
+    Raises:
+        OSError: If the --config file cannot be read
+        ValueError: If it contains an invalid mapping
+    """
+    mappings = [mapping for gateway in args.gateway for mapping in gateway_mappings(gateway)]
+    mappings += args.map
+    if args.config:
+        mappings += load_mappings(args.config)
+    return mappings
 
 
 def main() -> None:
     """Run PSK frontend proxies for TLS-PSK HTTPS and MQTT connections.
 
-    Creates and runs two concurrent TLS-PSK proxy instances:
+    Without options, creates and runs two concurrent TLS-PSK proxy instances
+    (--gateway, --map and --config choose other mappings, see parse_mapping()):
     1. HTTPS proxy: 10.42.42.1:443 → 10.42.42.1:80
        - Decrypts device API requests and forwards to fake registration server
     2. MQTT-TLS proxy: 10.42.42.1:8886 → 10.42.42.1:1883
        - Decrypts device telemetry and forwards to local MQTT broker
 
-    Uses select() for multiplexed I/O, allowing both proxies to run concurrently
-    in a single-threaded event loop. The loop runs indefinitely until interrupted.
+    Both proxies share one Reactor (epoll on Linux), so they run concurrently in
+    a single-threaded event loop. The loop runs indefinitely until interrupted. The
+    HTTPS proxy keeps BACKEND_POOL_SIZE warm connections to the HTTP server.
 
     Proxies:
         - HTTPS (443→80): Device activation, token requests, upgrade checks
@@ -410,6 +1966,13 @@ def main() -> None:
         Run as root (required for binding to privileged ports):
             $ sudo ./psk-frontend.py
 
+        With --workers N (0: one per CPU core), N worker processes run the
+        proxies on SO_REUSEPORT listeners under a Supervisor:
+            $ sudo ./psk-frontend.py --workers 4
+
+        kill -HUP re-reads the --config mapping table (the supervisor passes
+        the signal on to its workers).
+
         The proxies will run indefinitely. Press Ctrl+C to stop.
 
     Side Effects:
@@ -425,20 +1988,13 @@ def main() -> None:
         >>> # This would run forever, so we don't actually call it in tests
         >>> # main()  # Runs until Ctrl+C
     """
-    gateway = DEFAULT_GATEWAY
-    proxies = [
-        PskFrontend(gateway, HTTPS_PORT, gateway, HTTP_PORT),
-        PskFrontend(gateway, MQTT_ALT_PORT, gateway, MQTT_PORT),
-    ]
-
-    while True:
-        readables: List[socket.socket] = []
-        for p in proxies:
-            readables = readables + p.readables()
-        r, _, _ = select.select(readables, [], [])
-        for s in r:
-            for p in proxies:
-                p.data_ready_cb(s)
+    args = parse_args()
+    load = partial(mapping_table, args)
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        Supervisor(workers, partial(run_worker, load)).run()
+        return
+    serve(load)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Offline batch PSK derivation for captured TLS-PSK identities.
+
+Parses the identities psk-frontend.py logged to smarthack-psk.log
+("ID: <hex>" lines) and derives the PSK of every identity for every
+candidate hint and derivation variant, for the PSK identity 02 research
+(see docs/Collaboration-document-for-PSK-Identity-02.md). The results are
+written to a compact indexed file that can be queried without deriving
+anything again.
+
+How It Works:
+    1. Identities are collected from the logs and deduplicated; how often
+       each one was seen is kept, but its keys are derived only once
+    2. The AES key of a (hint, variant) pair does not depend on the
+       identity, so one AES-ECB cipher per distinct key is created up front
+       and CBC is chained by hand (two blocks); the IV, the MD5 of the
+       identity, is computed once per identity
+    3. Identities are split into chunks that are derived in a process pool
+    4. The keys are written as a matrix of 32 byte records after a sorted
+       identity table, so a lookup is a binary search plus one read
+
+Variants:
+    tuya       key MD5(hint[-16:]), IV MD5(identity[1:]), encrypts identity[1:33]
+               (gen_psk() in psk-frontend.py; correct for identity 01)
+    full-hint  like tuya, but the key is the MD5 of the whole hint
+    with-type  like tuya, but the identity type byte is not stripped
+
+Index File Format (little-endian):
+    header      "PSKI", version (u16), hints (u16), variants (u16), identities (u32)
+    hints       length (u16) + bytes, per hint
+    variants    length (u8) + ASCII name, per variant
+    offsets     u32 per identity plus one, into the identity blob
+    identities  sorted identity bytes, concatenated
+    seen        u32 per identity, number of log lines it appeared in
+    keys        32 bytes per (identity, hint, variant), in that nesting order
+
+Typical Usage:
+    $ ./psk_batch.py derive smarthack-psk.log -o psk.idx --hints-file hints.txt --variant all
+    $ ./psk_batch.py lookup psk.idx 0242416f68626d64...
+    $ ./psk_batch.py dump psk.idx > psk.tsv
+
+Example:
+    >>> identities = parse_identities(open("smarthack-psk.log"))
+    >>> write_index("psk.idx", identities, [DEFAULT_HINT], ["tuya"])
+    >>> PskIndex("psk.idx").lookup(next(iter(identities)), DEFAULT_HINT, "tuya").hex()
+    '2a9cf84b...'
+"""
+
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import md5
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+)
+
+from Cryptodome.Cipher import AES
+
+# PSK hint psk-frontend.py sends (PSK_HINT there)
+DEFAULT_HINT = b"1dHRsc2NjbHltbGx3eWh5" b"0000000000000000"
+
+# Identity bytes after the type byte that are encrypted into the PSK
+PSK_LENGTH = 32
+BLOCK_SIZE = 16
+
+# Identities derived per process pool task
+CHUNK_SIZE = 2048
+
+INDEX_MAGIC = b"PSKI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sHHHI")
+
+# "ID: <hex>" as logged by gen_psk(), possibly after a timestamp
+IDENTITY_LINE = re.compile(r"\bID: ([0-9a-fA-F]+)\s*$")
+
+
+class Variant(NamedTuple):
+    """
+    A way of deriving the PSK from identity and hint.
+
+    Attributes:
+            full_hint: Key is the MD5 of the whole hint instead of its last 16 bytes
+            strip_type: Drop the identity type byte (01/02) before deriving
+    """
+
+    full_hint: bool
+    strip_type: bool
+
+
+VARIANTS: Dict[str, Variant] = {
+    "tuya": Variant(full_hint=False, strip_type=True),
+    "full-hint": Variant(full_hint=True, strip_type=True),
+    "with-type": Variant(full_hint=False, strip_type=False),
+}
+
+
+def parse_hint(text: str) -> bytes:
+    """
+    Parse a candidate hint: plain text, or "hex:" followed by hex digits.
+
+    Raises:
+            ValueError: If the hex digits are invalid
+    """
+    if text.startswith("hex:"):
+        return bytes.fromhex(text[4:])
+    return text.encode()
+
+
+def format_hint(hint: bytes) -> str:
+    """Return a hint the way parse_hint() reads it."""
+    if hint.isascii() and hint.decode().isprintable() and not hint.startswith(b"hex:"):
+        return hint.decode()
+    return "hex:" + hint.hex()
+
+
+def parse_identities(lines: Iterable[str]) -> "Counter[bytes]":
+    """
+    Collect the identities of "ID: <hex>" log lines.
+
+    Identities too short to derive a key from (fewer than 33 bytes) and
+    lines with an odd number of hex digits are skipped.
+
+    Args:
+            lines: Lines of one or more smarthack-psk.log files
+
+    Returns:
+            Identity → number of lines it appeared in
+    """
+    identities: "Counter[bytes]" = Counter()
+    for line in lines:
+        match = IDENTITY_LINE.search(line)
+        if match is None:
+            continue
+        try:
+            identity = bytes.fromhex(match.group(1))
+        except ValueError:
+            continue
+        if len(identity) > PSK_LENGTH:
+            identities[identity] += 1
+    return identities
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    """XOR two 16 byte blocks."""
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(
+        BLOCK_SIZE, "little"
+    )
+
+
+def derive_chunk(
+    identities: Sequence[bytes], hints: Sequence[bytes], variants: Sequence[str]
+) -> bytes:
+    """
+    Derive the keys of some identities for all hints and variants.
+
+    Args:
+            identities: Identities including the type byte
+            hints: Candidate hints
+            variants: Names from VARIANTS
+
+    Returns:
+            The 32 byte keys, concatenated in (identity, hint, variant) order
+    """
+    specs = [VARIANTS[name] for name in variants]
+    # One ECB cipher per distinct AES key, shared by all identities
+    ciphers: Dict[bytes, Any] = {}
+    encryptors = []
+    for hint in hints:
+        for spec in specs:
+            key = md5(hint if spec.full_hint else hint[-BLOCK_SIZE:]).digest()
+            cipher = ciphers.get(key)
+            if cipher is None:
+                cipher = ciphers[key] = AES.new(key, AES.MODE_ECB)
+            encryptors.append((cipher.encrypt, spec.strip_type))
+    output = bytearray()
+    for identity in identities:
+        # IV and plaintext per identity form, computed once for all hints
+        forms = {}
+        for strip in (True, False):
+            body = identity[1:] if strip else identity
+            forms[strip] = (md5(body).digest(), body[:BLOCK_SIZE], body[BLOCK_SIZE:PSK_LENGTH])
+        for encrypt, strip in encryptors:
+            iv, first, second = forms[strip]
+            block = encrypt(_xor(first, iv))
+            output += block
+            output += encrypt(_xor(second, block))
+    return bytes(output)
+
+
+def derive_all(
+    identities: Sequence[bytes],
+    hints: Sequence[bytes],
+    variants: Sequence[str],
+    jobs: Optional[int] = None,
+) -> bytes:
+    """
+    Derive the keys of all identities, in a process pool if there are many.
+
+    Args:
+            identities: Identities including the type byte
+            hints: Candidate hints
+            variants: Names from VARIANTS
+            jobs: Worker processes (default: one per CPU core)
+
+    Returns:
+            The keys, as derive_chunk() returns them for all identities
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(identities) <= CHUNK_SIZE:
+        return derive_chunk(identities, hints, variants)
+    chunks = []
+    for start in range(0, len(identities), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        chunks.append(identities[start:end])
+    with ProcessPoolExecutor(jobs) as pool:
+        results = pool.map(derive_chunk, chunks, [hints] * len(chunks), [variants] * len(chunks))
+        return b"".join(results)
+
+
+def write_index(
+    path: str,
+    identities: "Counter[bytes]",
+    hints: Sequence[bytes],
+    variants: Sequence[str],
+    jobs: Optional[int] = None,
+) -> None:
+    """
+    Derive all keys and write them to an index file.
+
+    The file is written to a temporary name and renamed, so a reader never
+    sees a partial index.
+
+    Args:
+            path: Index file to write
+            identities: Identity → times seen, e.g. from parse_identities()
+            hints: Candidate hints
+            variants: Names from VARIANTS
+            jobs: Worker processes (default: one per CPU core)
+    """
+    ordered = sorted(identities)
+    keys = derive_all(ordered, hints, variants, jobs)
+    parts = [INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(hints), len(variants), len(ordered))]
+    for hint in hints:
+        parts.append(struct.pack("<H", len(hint)) + hint)
+    for name in variants:
+        parts.append(struct.pack("<B", len(name)) + name.encode())
+    offsets = [0]
+    for identity in ordered:
+        offsets.append(offsets[-1] + len(identity))
+    parts.append(struct.pack("<%dI" % len(offsets), *offsets))
+    parts.extend(ordered)
+    parts.append(struct.pack("<%dI" % len(ordered), *(identities[i] for i in ordered)))
+    parts.append(keys)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(b"".join(parts))
+    os.replace(temporary, path)
+
+
+class PskIndex:
+    """
+    Read-only view of an index file written by write_index().
+
+    The file is memory-mapped; opening it reads the header, the hints and
+    the variants, and lookups binary-search the identity table in place.
+
+    Attributes:
+            hints: Candidate hints, in file order
+            variants: Variant names, in file order
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Open an index file.
+
+        Raises:
+                OSError: If the file cannot be read
+                ValueError: If it is not an index file of this version
+        """
+        with open(path, "rb") as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hint_count, variant_count, count = INDEX_HEADER.unpack_from(self._data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%s is not a PSK index (version %d)" % (path, INDEX_VERSION))
+        position = INDEX_HEADER.size
+        self.hints: List[bytes] = []
+        for _ in range(hint_count):
+            (length,) = struct.unpack_from("<H", self._data, position)
+            self.hints.append(self._read(position + 2, length))
+            position += 2 + length
+        self.variants: List[str] = []
+        for _ in range(variant_count):
+            length = self._data[position]
+            self.variants.append(self._read(position + 1, length).decode())
+            position += 1 + length
+        self._count: int = count
+        self._offsets = struct.unpack_from("<%dI" % (count + 1), self._data, position)
+        self._blob = position + 4 * (count + 1)
+        self._seen = self._blob + self._offsets[-1]
+        self._keys = self._seen + 4 * count
+        self._stride = hint_count * variant_count * PSK_LENGTH
+
+    def __len__(self) -> int:
+        """Return the number of identities."""
+        return self._count
+
+    def _read(self, start: int, length: int) -> bytes:
+        """Return length bytes of the file from offset start."""
+        end = start + length
+        return self._data[start:end]
+
+    def identity(self, index: int) -> bytes:
+        """Return the identity at a position of the sorted table."""
+        start = self._offsets[index]
+        return self._read(self._blob + start, self._offsets[index + 1] - start)
+
+    def identities(self) -> Iterator[bytes]:
+        """Iterate over the identities in sorted order."""
+        for index in range(self._count):
+            yield self.identity(index)
+
+    def seen(self, identity: bytes) -> int:
+        """Return how often an identity was logged (0 if it is not in the index)."""
+        index = self._find(identity)
+        if index is None:
+            return 0
+        (count,) = struct.unpack_from("<I", self._data, self._seen + 4 * index)
+        return int(count)
+
+    def _find(self, identity: bytes) -> Optional[int]:
+        """Return the position of an identity (binary search), or None."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.identity(middle) < identity:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self.identity(low) == identity:
+            return low
+        return None
+
+    def keys(self, identity: bytes) -> Iterator[Tuple[bytes, str, bytes]]:
+        """Iterate over (hint, variant, key) of an identity."""
+        index = self._find(identity)
+        if index is None:
+            return
+        position = self._keys + index * self._stride
+        for hint in self.hints:
+            for variant in self.variants:
+                yield hint, variant, self._read(position, PSK_LENGTH)
+                position += PSK_LENGTH
+
+    def lookup(self, identity: bytes, hint: bytes, variant: str = "tuya") -> Optional[bytes]:
+        """
+        Return the key of an identity for one hint and variant.
+
+        Returns:
+                The 32 byte key, or None if identity, hint or variant is not indexed
+        """
+        index = self._find(identity)
+        if index is None or hint not in self.hints or variant not in self.variants:
+            return None
+        column = self.hints.index(hint) * len(self.variants) + self.variants.index(variant)
+        position = self._keys + index * self._stride + column * PSK_LENGTH
+        return self._read(position, PSK_LENGTH)
+
+    def close(self) -> None:
+        """Unmap the file."""
+        self._data.close()
+
+
+def read_lines(paths: Sequence[str]) -> Iterator[str]:
+    """Yield the lines of log files, "-" for standard input."""
+    for path in paths:
+        if path == "-":
+            yield from sys.stdin
+            continue
+        with open(path, errors="replace") as file:
+            yield from file
+
+
+def read_hints(file: TextIO) -> List[bytes]:
+    """Read candidate hints, one parse_hint() entry per line; # starts a comment."""
+    hints = []
+    for line in file:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            hints.append(parse_hint(line))
+    return hints
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point.
+
+    Args:
+            argv: Arguments without the program name (default: sys.argv[1:])
+
+    Returns:
+            0 on success, 1 if nothing was found
+    """
+    parser = argparse.ArgumentParser(description="Derive TLS-PSK keys of logged identities")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    derive = commands.add_parser("derive", help="derive keys and write an index file")
+    derive.add_argument("logs", nargs="+", help='smarthack-psk.log files ("-": stdin)')
+    derive.add_argument("-o", "--output", required=True, help="index file to write")
+    derive.add_argument(
+        "--hint",
+        action="append",
+        default=[],
+        type=parse_hint,
+        help='candidate hint, text or "hex:..." (default: the psk-frontend hint)',
+    )
+    derive.add_argument("--hints-file", help="file with one candidate hint per line")
+    derive.add_argument(
+        "--variant",
+        action="append",
+        choices=sorted(VARIANTS) + ["all"],
+        help="derivation variant (default: tuya); may be repeated",
+    )
+    derive.add_argument("--jobs", type=int, default=0, help="worker processes (0: one per core)")
+
+    lookup = commands.add_parser("lookup", help="print the keys of an identity")
+    lookup.add_argument("index", help="index file")
+    lookup.add_argument("identity", help="identity in hex, as logged after ID:")
+
+    dump = commands.add_parser("dump", help="print all keys as tab-separated values")
+    dump.add_argument("index", help="index file")
+    args = parser.parse_args(argv)
+
+    if args.command == "derive":
+        hints = list(args.hint)
+        if args.hints_file:
+            with open(args.hints_file) as file:
+                hints += read_hints(file)
+        variants = args.variant or ["tuya"]
+        if "all" in variants:
+            variants = list(VARIANTS)
+        identities = parse_identities(read_lines(args.logs))
+        if not identities:
+            print("no identities (ID: lines) found in %s" % ", ".join(args.logs), file=sys.stderr)
+            return 1
+        write_index(args.output, identities, hints or [DEFAULT_HINT], variants, args.jobs)
+        print(
+            "%d identities (%d log lines) x %d hints x %d variants written to %s"
+            % (
+                len(identities),
+                sum(identities.values()),
+                len(hints or [DEFAULT_HINT]),
+                len(variants),
+                args.output,
+            )
+        )
+        return 0
+
+    index = PskIndex(args.index)
+    try:
+        if args.command == "lookup":
+            identity = bytes.fromhex(args.identity)
+            found = False
+            for hint, variant, key in index.keys(identity):
+                print("%s\t%s\t%s" % (format_hint(hint), variant, key.hex()))
+                found = True
+            return 0 if found else 1
+        for identity in index.identities():
+            for hint, variant, key in index.keys(identity):
+                print("%s\t%s\t%s\t%s" % (identity.hex(), format_hint(hint), variant, key.hex()))
+        return 0
+    finally:
+        index.close()
+
+
+__all__ = [
+    "DEFAULT_HINT",
+    "VARIANTS",
+    "PskIndex",
+    "Variant",
+    "derive_all",
+    "format_hint",
+    "parse_hint",
+    "parse_identities",
+    "write_index",
+]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+TLS-PSK load generator and throughput benchmark for psk-frontend.py.
+
+Starts a PskFrontend and a local echo backend in their own processes and
+drives them with TLS-PSK clients that authenticate like Tuya devices
+(identities in the IDENTITY_PREFIX format, see gen_psk()). Two phases run
+for every buffer size under test, each against a fresh frontend:
+
+    1. handshakes  --connections clients (at most --concurrency at once)
+                   connect, complete the TLS-PSK handshake and echo one
+                   ping through the backend; handshakes per second and
+                   p50/p99 handshake latency are reported
+    2. throughput  --streams clients each send --megabytes through the
+                   proxy and read the echo back; the payload rate is
+                   reported in MB/s (every byte crosses the proxy twice)
+
+The buffer size is the per-direction session buffer of the frontend
+(SOCKET_BUFFER_SIZE, the buffer_size argument of PskFrontend), so runs with
+several sizes show where larger buffers stop paying off.
+
+Client, frontend and backend share the CPUs of one host; on small hosts the
+numbers are a lower bound of what the proxy alone can do. Compare runs made
+on the same host only.
+
+Typical Usage:
+    $ ./psk_loadgen.py --connections 500 --buffer-sizes 4096,16384,65536 --json psk-bench.json
+
+Example:
+    >>> config = LoadConfig(connections=50, streams=2, megabytes=4)
+    >>> runs = run_benchmark(config, [16384])
+    >>> runs[0].failed
+    0
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import ssl
+import sys
+import time
+from multiprocessing.connection import Connection
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from device_simulator import percentile, psk_client_context
+
+# Buffer sizes compared by default, around psk-frontend's SOCKET_BUFFER_SIZE
+DEFAULT_BUFFER_SIZES = (4096, 16384, 65536)
+
+# Bytes per write of the throughput clients and per read of the echo backend
+CHUNK_SIZE = 65536
+
+# Payload round trip checking that a session reaches the backend
+PING = b"ping"
+
+MEGABYTE = 1000 * 1000
+
+FRONTEND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "psk-frontend.py")
+
+
+class LoadConfig(NamedTuple):
+    """
+    Shape of the generated load.
+
+    Attributes:
+            host: Address the frontend and the echo backend listen on
+            connections: Number of handshakes in the handshake phase
+            concurrency: Maximum number of handshakes in flight at once
+            identities: Distinct PSK identities used, 0 for one per connection
+                (fewer identities exercise the frontend's PSK cache)
+            streams: Concurrent connections in the throughput phase
+            megabytes: Payload each throughput connection sends
+            timeout: Seconds a handshake or ping may take
+    """
+
+    host: str = "127.0.0.1"
+    connections: int = 200
+    concurrency: int = 50
+    identities: int = 0
+    streams: int = 4
+    megabytes: int = 16
+    timeout: float = 10.0
+
+
+class BenchmarkRun(NamedTuple):
+    """
+    Results for one buffer size.
+
+    Attributes:
+            buffer_size: Per-direction session buffer of the frontend
+            handshakes: Successful handshakes
+            failed: Connections that failed to handshake or echo the ping
+            handshakes_per_s: Successful handshakes per second of the phase
+            handshake_p50_ms: Median connect and handshake latency
+            handshake_p99_ms: 99th percentile connect and handshake latency
+            throughput_bytes: Payload echoed through the proxy
+            throughput_mb_per_s: Payload MB per second echoed through the proxy
+    """
+
+    buffer_size: int
+    handshakes: int
+    failed: int
+    handshakes_per_s: float
+    handshake_p50_ms: float
+    handshake_p99_ms: float
+    throughput_bytes: int
+    throughput_mb_per_s: float
+
+
+class EchoProtocol(asyncio.Protocol):
+    """Echo backend connection: sends every byte back, with flow control."""
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Keep the transport to write to."""
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        """Echo received bytes."""
+        self.transport.write(data)
+
+    def pause_writing(self) -> None:
+        """Stop reading while the peer is not reading its echo."""
+        self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        """Read again once the echo has drained."""
+        self.transport.resume_reading()
+
+
+def run_echo_server(host: str, ready: Connection) -> None:
+    """
+    Run the echo backend until terminated (process target).
+
+    Args:
+            host: Address to listen on; the port is chosen by the kernel
+            ready: Pipe the listening port is sent to
+    """
+
+    async def serve() -> None:
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(EchoProtocol, host, 0)
+        ready.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def load_frontend() -> Any:
+    """Import psk-frontend.py (its file name is not a module name)."""
+    spec = importlib.util.spec_from_file_location("psk_frontend", FRONTEND_PATH)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_frontend(host: str, backend_port: int, buffer_size: int, ready: Connection) -> None:
+    """
+    Run a PskFrontend in front of the echo backend until terminated (process target).
+
+    The frontend's per-connection log lines are discarded.
+
+    Args:
+            host: Address to listen on; the port is chosen by the kernel
+            backend_port: Port of the echo backend
+            buffer_size: Per-direction session buffer
+            ready: Pipe the listening port is sent to
+    """
+    sys.stdout = open(os.devnull, "w")
+    psk_frontend = load_frontend()
+    reactor = psk_frontend.Reactor()
+    proxy = psk_frontend.PskFrontend(host, 0, host, backend_port, reactor, buffer_size=buffer_size)
+    ready.send(proxy.server_sock.getsockname()[1])
+    reactor.run()
+
+
+def start_process(target: Any, *args: Any) -> Tuple[multiprocessing.Process, int]:
+    """
+    Start a server process and wait for the port it listens on.
+
+    Args:
+            target: run_echo_server or run_frontend
+            args: Arguments of the target before the ready pipe
+
+    Returns:
+            The process and its listening port
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=args + (sender,), daemon=True)
+    process.start()
+    sender.close()
+    if not receiver.poll(30):
+        process.terminate()
+        raise RuntimeError("%s did not start" % target.__name__)
+    port: int = receiver.recv()
+    receiver.close()
+    return process, port
+
+
+async def measure_handshakes(
+    config: LoadConfig, port: int, contexts: List[ssl.SSLContext]
+) -> Tuple[List[float], int, float]:
+    """
+    Open config.connections TLS-PSK connections and echo a ping through each.
+
+    Args:
+            config: Load shape
+            port: Frontend port
+            contexts: Client contexts, one per identity, used round robin
+
+    Returns:
+            Handshake latencies in seconds, number of failed connections and
+            the wall clock seconds of the phase
+    """
+    latencies: List[float] = []
+    failed = 0
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async def connect(index: int) -> None:
+        nonlocal failed
+        writer = None
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        config.host,
+                        port,
+                        ssl=contexts[index % len(contexts)],
+                        server_hostname="",
+                    ),
+                    config.timeout,
+                )
+                latencies.append(time.perf_counter() - started)
+                writer.write(PING)
+                echo = await asyncio.wait_for(reader.readexactly(len(PING)), config.timeout)
+                if echo != PING:
+                    raise ValueError("echo mismatch")
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                failed += 1
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(index) for index in range(config.connections)))
+    return latencies, failed, time.perf_counter() - started
+
+
+async def measure_throughput(
+    config: LoadConfig, port: int, context: ssl.SSLContext
+) -> Tuple[int, float]:
+    """
+    Echo config.megabytes through each of config.streams connections at once.
+
+    Args:
+            config: Load shape
+            port: Frontend port
+            context: Client context of the connections
+
+    Returns:
+            Payload bytes echoed in total and the wall clock seconds of the phase
+
+    Raises:
+            OSError: If a connection fails
+            asyncio.IncompleteReadError: If the proxy closes a connection early
+    """
+    total = config.megabytes * MEGABYTE
+    chunk = os.urandom(CHUNK_SIZE)
+
+    async def stream() -> int:
+        reader, writer = await asyncio.open_connection(
+            config.host, port, ssl=context, server_hostname=""
+        )
+
+        async def send() -> None:
+            remaining = total
+            while remaining:
+                count = min(remaining, CHUNK_SIZE)
+                writer.write(chunk[:count])
+                await writer.drain()
+                remaining -= count
+
+        sender = asyncio.ensure_future(send())
+        received = 0
+        try:
+            while received < total:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", total - received)
+                received += len(data)
+            await sender
+        finally:
+            sender.cancel()
+            writer.close()
+        return received
+
+    started = time.perf_counter()
+    echoed = await asyncio.gather(*(stream() for _ in range(config.streams)))
+    return sum(echoed), time.perf_counter() - started
+
+
+def run_benchmark(config: LoadConfig, buffer_sizes: List[int]) -> List[BenchmarkRun]:
+    """
+    Benchmark a fresh frontend for every buffer size.
+
+    Args:
+            config: Load shape
+            buffer_sizes: Per-direction session buffers to compare
+
+    Returns:
+            One result per buffer size, in the given order
+    """
+    echo, backend_port = start_process(run_echo_server, config.host)
+    identities = config.identities or config.connections
+    contexts = [psk_client_context("loadgen%05d" % index) for index in range(identities)]
+    runs = []
+    try:
+        for buffer_size in buffer_sizes:
+            frontend, port = start_process(run_frontend, config.host, backend_port, buffer_size)
+            # A private loop: asyncio.run() would leave the thread without one
+            loop = asyncio.new_event_loop()
+            try:
+                latencies, failed, elapsed = loop.run_until_complete(
+                    measure_handshakes(config, port, contexts)
+                )
+                echoed, seconds = loop.run_until_complete(
+                    measure_throughput(config, port, contexts[0])
+                )
+            finally:
+                loop.close()
+                frontend.terminate()
+                frontend.join()
+            runs.append(
+                BenchmarkRun(
+                    buffer_size=buffer_size,
+                    handshakes=len(latencies),
+                    failed=failed,
+                    handshakes_per_s=round(len(latencies) / elapsed, 1),
+                    handshake_p50_ms=round(percentile(latencies, 0.50) * 1000, 3),
+                    handshake_p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+                    throughput_bytes=echoed,
+                    throughput_mb_per_s=round(echoed / MEGABYTE / seconds, 1),
+                )
+            )
+    finally:
+        echo.terminate()
+        echo.join()
+    return runs
+
+
+def format_runs(runs: List[BenchmarkRun]) -> str:
+    """Return a human-readable table of benchmark results."""
+    lines = [
+        "%8s %10s %6s %12s %8s %8s %8s"
+        % ("buffer", "handshakes", "failed", "handshakes/s", "p50 ms", "p99 ms", "MB/s")
+    ]
+    for run in runs:
+        lines.append(
+            "%8d %10d %6d %12.1f %8.1f %8.1f %8.1f"
+            % (
+                run.buffer_size,
+                run.handshakes,
+                run.failed,
+                run.handshakes_per_s,
+                run.handshake_p50_ms,
+                run.handshake_p99_ms,
+                run.throughput_mb_per_s,
+            )
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point.
+
+    Args:
+            argv: Arguments without the program name (default: sys.argv[1:])
+
+    Returns:
+            0 if every connection succeeded, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark TLS-PSK handshakes and forwarding of psk-frontend"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to run the servers on")
+    parser.add_argument("--connections", type=int, default=200, help="handshakes per run")
+    parser.add_argument("--concurrency", type=int, default=50, help="handshakes in flight")
+    parser.add_argument(
+        "--identities", type=int, default=0, help="distinct PSK identities (0: one per connection)"
+    )
+    parser.add_argument("--streams", type=int, default=4, help="throughput connections")
+    parser.add_argument("--megabytes", type=int, default=16, help="payload per stream in MB")
+    parser.add_argument("--timeout", type=float, default=10.0, help="handshake timeout in seconds")
+    parser.add_argument(
+        "--buffer-sizes",
+        default=",".join(str(size) for size in DEFAULT_BUFFER_SIZES),
+        help="comma-separated session buffer sizes to compare",
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    config = LoadConfig(
+        host=args.host,
+        connections=args.connections,
+        concurrency=args.concurrency,
+        identities=args.identities,
+        streams=args.streams,
+        megabytes=args.megabytes,
+        timeout=args.timeout,
+    )
+    buffer_sizes = [int(size) for size in args.buffer_sizes.split(",")]
+    runs = run_benchmark(config, buffer_sizes)
+    print(format_runs(runs))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {"config": config._asdict(), "runs": [run._asdict() for run in runs]},
+                file,
+                indent=2,
+            )
+    return 0 if all(run.failed == 0 for run in runs) else 1
+
+
+__all__ = [
+    "BenchmarkRun",
+    "LoadConfig",
+    "format_runs",
+    "run_benchmark",
+]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Pre-rendered reply cache for the fake registration server.
+
+Every Tuya API reply is a fixed answer template plus a handful of values that
+change per request (the timestamp ``t`` and, for a few endpoints, fields such
+as ``devId`` or ``time``). This module renders each template once and, at
+request time, only splices in the per-request values.
+
+Plain replies (protocol 2.1) are stored as literal JSON fragments that are
+joined around the dynamic values.
+
+Encrypted replies (protocol 2.2) exploit the fact that AES-ECB encrypts every
+16-byte block independently. The static part of the plaintext in front of the
+first dynamic value is encrypted once, in chunks of 48 bytes so that its
+base64 encoding can be concatenated with the base64 of the remainder. The MD5
+signature state over ``result=<static base64>`` is precomputed as well, so a
+cache hit only encrypts, encodes and hashes the short tail of the message.
+
+Rendered output is byte-for-byte identical to building the full answer dict
+and running it through ``json.dumps`` / ``encrypt`` / ``b64encode`` / ``md5``.
+
+Cache entries are keyed by (template name, encrypted) and are dropped when the
+secret key changes or when invalidate() is called, e.g. after the firmware
+file has been rehashed.
+
+Example:
+    >>> cache = ResponseCache()
+    >>> cache.render("timer", {"devId": "abc", "count": 0}, False,
+    ...              "0000000000000000", 1234567890, dynamic=("devId",))
+    '{"t":1234567890,"e":false,"success":true,"result":{"devId":"abc","count":0}}'
+"""
+
+import hashlib
+import json
+import re
+from base64 import b64encode
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from crypto_utils import ecb_cipher, pad
+
+# AES block size in bytes; ECB ciphertext blocks are independent of each other
+AES_BLOCK_BYTES = 16
+
+# Smallest span that is both a whole number of AES blocks and a whole number of
+# base64 input groups (3 bytes), so precomputed base64 can be concatenated
+SPLICE_ALIGNMENT = 3 * AES_BLOCK_BYTES
+
+# Placeholder written into the template JSON for per-request values
+_PLACEHOLDER = "\x00field:%s\x00"
+_PLACEHOLDER_RE = re.compile(r'"\\u0000field:([^\\"]+)\\u0000"')
+
+
+def _jsonstr(value: Any) -> str:
+    """Serialize a value the same way as the server's jsonstr() helper."""
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _split_template(text: str) -> List[str]:
+    """
+    Split serialized JSON into alternating literal and field-name parts.
+
+    Args:
+            text: JSON text containing quoted placeholders
+
+    Returns:
+            List [literal, field, literal, field, ..., literal]
+    """
+    return _PLACEHOLDER_RE.split(text)
+
+
+class ResponseTemplate:
+    """
+    A single pre-rendered answer with splice points for per-request values.
+
+    Attributes:
+            encrypted: Whether this template renders protocol 2.2 replies
+            fields: Names of the per-request values, in rendering order
+    """
+
+    def __init__(
+        self,
+        result: Any,
+        encrypted: bool,
+        sec_key: str,
+        dynamic: Sequence[str] = (),
+    ) -> None:
+        """
+        Pre-render an answer template.
+
+        Args:
+                result: Answer payload; top-level keys listed in dynamic are
+                        replaced by splice points
+                encrypted: Render protocol 2.2 (encrypted and signed) replies
+                sec_key: Secret key used for encryption and signing
+                dynamic: Top-level result keys whose values change per request
+        """
+        self.encrypted = encrypted
+        self._sec_key = sec_key
+        if dynamic and isinstance(result, dict):
+            result = dict(result)
+            for key in dynamic:
+                result[key] = _PLACEHOLDER % key
+
+        if encrypted:
+            text = '{"result":%s,"t":"\\u0000field:t\\u0000","success":true}' % _jsonstr(result)
+            parts = _split_template(text)
+            self._prepare_encrypted(parts)
+        else:
+            text = '{"t":"\\u0000field:t\\u0000","e":false,"success":true'
+            if result:
+                text += ',"result":' + _jsonstr(result)
+            parts = _split_template(text + "}")
+            self._parts: List[str] = parts
+
+        self.fields: Tuple[str, ...] = tuple(parts[1::2])
+
+    def _prepare_encrypted(self, parts: List[str]) -> None:
+        """
+        Encrypt, encode and hash the static prefix of an encrypted template.
+
+        Args:
+                parts: Template split into literal and field-name parts
+        """
+        head = parts[0]
+        spliced = len(head) - len(head) % SPLICE_ALIGNMENT
+        self._cipher = ecb_cipher(self._sec_key.encode())
+        head_b64 = b64encode(self._cipher.encrypt(head[:spliced].encode()))
+        self._head_b64 = head_b64.decode()
+        self._sign_state = hashlib.md5(b"result=" + head_b64)
+        self._parts = [head[spliced:]] + parts[1:]
+
+    def _fill(self, values: Dict[str, Any]) -> str:
+        """Join literal parts with the JSON encoding of the dynamic values."""
+        parts = self._parts
+        out = [parts[0]]
+        for i in range(1, len(parts), 2):
+            out.append(_jsonstr(values[parts[i]]))
+            out.append(parts[i + 1])
+        return "".join(out)
+
+    def render(self, ts: int, values: Dict[str, Any]) -> str:
+        """
+        Render the final JSON reply.
+
+        Args:
+                ts: Reply timestamp
+                values: Current values for the template's dynamic fields
+
+        Returns:
+                JSON reply string
+        """
+        values = dict(values, t=ts)
+        tail = self._fill(values)
+        if not self.encrypted:
+            return tail
+        tail_b64 = b64encode(self._cipher.encrypt(pad(tail).encode())).decode()
+        sign_state = self._sign_state.copy()
+        sign_state.update(("%s||t=%d||%s" % (tail_b64, ts, self._sec_key)).encode())
+        signature = sign_state.hexdigest()[8:24]
+        return '{"result":"%s%s","t":%d,"sign":"%s"}' % (self._head_b64, tail_b64, ts, signature)
+
+
+class ResponseCache:
+    """
+    Cache of pre-rendered answer templates.
+
+    Attributes:
+            hits: Number of replies rendered from an existing template
+            misses: Number of templates built
+    """
+
+    def __init__(self) -> None:
+        """Create an empty cache."""
+        self._templates: Dict[Tuple[str, bool], ResponseTemplate] = {}
+        self._sec_key: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached templates."""
+        return len(self._templates)
+
+    def invalidate(self) -> None:
+        """Drop all templates, e.g. after the firmware file changed."""
+        self._templates.clear()
+
+    def render(
+        self,
+        name: str,
+        result: Any,
+        encrypted: bool,
+        sec_key: str,
+        ts: int,
+        dynamic: Sequence[str] = (),
+    ) -> str:
+        """
+        Render a reply, building its template on first use.
+
+        On a cache hit only the values of the dynamic keys are read from
+        result; all other keys are assumed unchanged for the given name.
+
+        Args:
+                name: Template name, unique per static answer shape
+                result: Answer payload
+                encrypted: Render protocol 2.2 (encrypted and signed) reply
+                sec_key: Secret key used for encryption and signing
+                ts: Reply timestamp
+                dynamic: Top-level result keys whose values change per request
+
+        Returns:
+                JSON reply string
+        """
+        if sec_key != self._sec_key:
+            self.invalidate()
+            self._sec_key = sec_key
+        key = (name, encrypted)
+        template = self._templates.get(key)
+        if template is None:
+            self.misses += 1
+            template = ResponseTemplate(result, encrypted, sec_key, dynamic)
+            self._templates[key] = template
+        else:
+            self.hits += 1
+        values = {field: result[field] for field in dynamic} if dynamic else {}
+        return template.render(ts, values)
+
+
+__all__ = ["ResponseCache", "ResponseTemplate"]
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Low-overhead metrics for the fake registration server.
+
+Counters, gauges and latency histograms are kept in plain dicts keyed by
+label values. Recording a value costs a dict lookup and an addition (plus a
+bisect over the bucket bounds for histograms), and no locks are taken: all
+values are recorded from the single-threaded Tornado IOLoop. That keeps
+instrumentation cheap enough to stay on during real flashing runs.
+
+Values owned by other objects (session counts, fired upgrade triggers) are
+not copied on every change; a family can instead be given a collect function
+that is only called when the metrics are read.
+
+The registry renders the Prometheus text exposition format and a JSON
+snapshot of the same data. Snapshots of several processes can be summed
+with MetricsRegistry.merge(); WorkerSnapshots exchanges them between forked
+worker processes through files in a shared directory.
+
+Label values may come from devices (e.g. the action name), so every family
+keeps at most ``max_series`` label combinations; further ones are counted
+under the label value "other".
+
+Example:
+    >>> metrics = MetricsRegistry()
+    >>> requests = metrics.counter("tuya_requests_total", "API requests", ("action",))
+    >>> requests.inc(("s.gw.token.get",))
+    >>> print(metrics.render())
+    # HELP tuya_requests_total API requests
+    # TYPE tuya_requests_total counter
+    tuya_requests_total{action="s.gw.token.get"} 1
+"""
+
+import json
+import os
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Metric kinds
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Latency bucket upper bounds in seconds, from 100 µs to 2.5 s
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# Upper bound for label combinations per family and the label value used beyond it
+DEFAULT_MAX_SERIES = 256
+OVERFLOW_LABEL = "other"
+
+Labels = Tuple[str, ...]
+
+
+class HistogramValue:
+    """
+    Bucket counts, sum and count of one histogram series.
+
+    Attributes:
+            counts: Observations per bucket (not cumulative), the last one for +Inf
+            sum: Sum of all observed values
+            count: Number of observations
+    """
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, bucket_count: int) -> None:
+        """Create an empty series with bucket_count finite buckets."""
+        self.counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value like the Prometheus client libraries do."""
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text exposition format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricFamily:
+    """
+    A named metric with one value per combination of label values.
+
+    Attributes:
+            kind: COUNTER, GAUGE or HISTOGRAM
+            name: Metric name, e.g. "tuya_requests_total"
+            help: One-line description
+            label_names: Names of the labels, in the order values are passed
+            buckets: Histogram bucket upper bounds (histograms only)
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        collect: Optional[Callable[[], Dict[Labels, float]]] = None,
+        max_series: int = DEFAULT_MAX_SERIES,
+    ) -> None:
+        """
+        Create a family; use the MetricsRegistry factory methods instead.
+
+        Args:
+                kind: COUNTER, GAUGE or HISTOGRAM
+                name: Metric name
+                help: One-line description
+                label_names: Names of the labels
+                buckets: Histogram bucket upper bounds, ascending
+                collect: Function returning the current values, called on read
+                max_series: Maximum number of label combinations kept
+        """
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.max_series = max_series
+        self._collect = collect
+        self._values: Dict[Labels, Any] = {}
+        self._overflow = (OVERFLOW_LABEL,) * len(self.label_names)
+
+    def _key(self, labels: Labels) -> Labels:
+        """Return the series key for label values, folding excess series into "other"."""
+        if labels in self._values or len(self._values) < self.max_series:
+            return labels
+        return self._overflow
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        """
+        Add to a counter or gauge.
+
+        Args:
+                labels: Label values, in the order of label_names
+                amount: Value to add
+        """
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, labels: Labels, value: float) -> None:
+        """Set a gauge."""
+        self._values[self._key(labels)] = value
+
+    def observe(self, labels: Labels, value: float) -> None:
+        """
+        Record one observation in a histogram.
+
+        Args:
+                labels: Label values, in the order of label_names
+                value: Observed value, e.g. a duration in seconds
+        """
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = HistogramValue(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def quantile(self, labels: Labels, q: float) -> float:
+        """
+        Estimate a quantile of a histogram series from its buckets.
+
+        Interpolates linearly within the bucket holding the quantile, like
+        Prometheus' histogram_quantile(). Values in the +Inf bucket are
+        reported as the largest finite bound.
+
+        Args:
+                labels: Label values of the series
+                q: Quantile, e.g. 0.99
+
+        Returns:
+                The estimate, or 0.0 if the series has no observations
+        """
+        series = self._values.get(labels)
+        if series is None or not series.count:
+            return 0.0
+        rank = q * series.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, series.counts):
+            if count and cumulative + count >= rank:
+                estimate: float = lower + (bound - lower) * (rank - cumulative) / count
+                return estimate
+            cumulative += count
+            lower = bound
+        return self.buckets[-1] if self.buckets else 0.0
+
+    def merge(self, samples: List[Dict[str, Any]]) -> None:
+        """
+        Add the samples of a snapshot() of the same family to this family.
+
+        Args:
+                samples: The "samples" list of the snapshot
+        """
+        for sample in samples:
+            labels = tuple(sample["labels"].get(name, "") for name in self.label_names)
+            if self.kind != HISTOGRAM:
+                self.inc(labels, sample["value"])
+                continue
+            key = self._key(labels)
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = HistogramValue(len(self.buckets))
+            previous = 0
+            for index, cumulative in enumerate(sample["buckets"].values()):
+                series.counts[index] += cumulative - previous
+                previous = cumulative
+            series.sum += sample["sum"]
+            series.count += sample["count"]
+
+    def values(self) -> Dict[Labels, Any]:
+        """Return the current value of every series (collecting if needed)."""
+        if self._collect is not None:
+            return self._collect()
+        return self._values
+
+    def clear(self) -> None:
+        """Forget all recorded values."""
+        self._values.clear()
+
+    def render(self) -> List[str]:
+        """Return the lines of the family in the Prometheus text format."""
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for labels, value in sorted(self.values().items()):
+            pairs = ['%s="%s"' % (name, _escape(v)) for name, v in zip(self.label_names, labels)]
+            if self.kind != HISTOGRAM:
+                selector = "{%s}" % ",".join(pairs) if pairs else ""
+                lines.append("%s%s %s" % (self.name, selector, _format_value(value)))
+                continue
+            cumulative = 0
+            bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, value.counts):
+                cumulative += count
+                selector = ",".join(pairs + ['le="%s"' % bound])
+                lines.append("%s_bucket{%s} %d" % (self.name, selector, cumulative))
+            selector = "{%s}" % ",".join(pairs) if pairs else ""
+            lines.append("%s_sum%s %s" % (self.name, selector, _format_value(value.sum)))
+            lines.append("%s_count%s %d" % (self.name, selector, value.count))
+        return lines
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the family as a JSON-serializable dict."""
+        samples = []
+        for labels, value in sorted(self.values().items()):
+            sample: Dict[str, Any] = {"labels": dict(zip(self.label_names, labels))}
+            if self.kind == HISTOGRAM:
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(list(self.buckets) + ["+Inf"], value.counts):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                sample.update(count=value.count, sum=value.sum, buckets=buckets)
+            else:
+                sample["value"] = value
+            samples.append(sample)
+        return {"type": self.kind, "help": self.help, "samples": samples}
+
+
+class MetricsRegistry:
+    """
+    Ordered collection of metric families.
+
+    Attributes:
+            families: Registered families, in registration order
+    """
+
+    def __init__(self) -> None:
+        """Create an empty registry."""
+        self.families: Dict[str, MetricFamily] = {}
+
+    def _add(self, family: MetricFamily) -> MetricFamily:
+        """Register a family under its name."""
+        if family.name in self.families:
+            raise ValueError("metric %s is already registered" % family.name)
+        self.families[family.name] = family
+        return family
+
+    def counter(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        collect: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ) -> MetricFamily:
+        """Register a monotonically increasing counter."""
+        return self._add(MetricFamily(COUNTER, name, help, label_names, collect=collect))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        collect: Optional[Callable[[], Dict[Labels, float]]] = None,
+    ) -> MetricFamily:
+        """Register a gauge (a value that can go up and down)."""
+        return self._add(MetricFamily(GAUGE, name, help, label_names, collect=collect))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> MetricFamily:
+        """Register a histogram with the given bucket upper bounds."""
+        return self._add(MetricFamily(HISTOGRAM, name, help, label_names, buckets))
+
+    def render(self) -> str:
+        """Return all families in the Prometheus text exposition format."""
+        lines = []
+        for family in self.families.values():
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return all families as a JSON-serializable dict keyed by metric name."""
+        return {name: family.snapshot() for name, family in self.families.items()}
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        """
+        Add the values of a snapshot(), e.g. taken in another process.
+
+        Counters, gauges and histogram buckets are summed. Families that are
+        not registered here are created from the snapshot.
+
+        Args:
+                snapshot: A snapshot() of a registry with the same metrics
+        """
+        for name, data in snapshot.items():
+            samples = data["samples"]
+            family = self.families.get(name)
+            if family is None:
+                if not samples:
+                    continue
+                label_names = list(samples[0]["labels"])
+                buckets: Sequence[float] = ()
+                if data["type"] == HISTOGRAM:
+                    buckets = [float(bound) for bound in samples[0]["buckets"] if bound != "+Inf"]
+                family = self._add(
+                    MetricFamily(data["type"], name, data["help"], label_names, buckets)
+                )
+            family.merge(samples)
+
+    def clear(self) -> None:
+        """Forget all recorded values (collected families are not affected)."""
+        for family in self.families.values():
+            family.clear()
+
+
+class WorkerSnapshots:
+    """
+    Metrics of worker processes sharing a directory of snapshot files.
+
+    Every worker periodically publishes the snapshot() of its registry as
+    ``metrics-<worker>.json``. The worker answering a scrape merges its own
+    live values with the files of all other workers, which are at most one
+    publishing interval old.
+
+    Attributes:
+            directory: Directory shared by all workers
+            worker: Number of this worker
+            shared: Families read from state shared by the workers (e.g. a
+                    session database); they are taken from this worker only
+    """
+
+    def __init__(self, directory: str, worker: int, shared: Sequence[str] = ()) -> None:
+        """
+        Create the exchange of one worker.
+
+        Args:
+                directory: Directory shared by all workers
+                worker: Number of this worker
+                shared: Families every worker reports with the same value
+        """
+        self.directory = directory
+        self.worker = worker
+        self.shared = frozenset(shared)
+
+    def _path(self, worker: int) -> str:
+        return os.path.join(self.directory, "metrics-%d.json" % worker)
+
+    def publish(self, registry: MetricsRegistry) -> bool:
+        """
+        Write the snapshot of this worker's registry for the other workers.
+
+        Args:
+                registry: Metrics of this worker
+
+        Returns:
+                True if the snapshot was written
+        """
+        path = self._path(self.worker)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(registry.snapshot(), file, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write metrics snapshot {path}: {e}")
+            return False
+        return True
+
+    def merged(self, registry: MetricsRegistry) -> MetricsRegistry:
+        """
+        Return the metrics of all workers.
+
+        Args:
+                registry: Live metrics of this worker
+
+        Returns:
+                A registry with the summed values; it only has the families
+                some worker has values for
+        """
+        total = MetricsRegistry()
+        total.merge(registry.snapshot())
+        own = os.path.basename(self._path(self.worker))
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in sorted(names):
+            if not (name.startswith("metrics-") and name.endswith(".json")) or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r") as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                # Removed or replaced by a restarted worker meanwhile
+                continue
+            total.merge(
+                {family: data for family, data in snapshot.items() if family not in self.shared}
+            )
+        return total
+
+
+__all__ = [
+    "COUNTER",
+    "DEFAULT_BUCKETS",
+    "GAUGE",
+    "HISTOGRAM",
+    "MetricFamily",
+    "MetricsRegistry",
+    "WorkerSnapshots",
+]
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Per-device session state for the fake registration server.
+
+Every device talking to the server is tracked by its gwId. A session records
+what the device told us (protocol, encryption mode, API version), what we
+served it (schema variant) and when it reached each protocol stage, so the
+server can make per-device decisions and operators can see where a device
+got stuck.
+
+Memory is bounded: sessions expire after a time-to-live without activity and
+the least recently used session is evicted when the store is full. This lets
+a single server run for weeks across thousands of devices.
+
+Optionally the store is snapshotted to a JSON file, so a restarted server
+still knows about devices that were in the middle of being flashed.
+
+When the server runs several worker processes, SqliteSessionStore keeps the
+sessions in a shared SQLite database in WAL mode instead, so every worker
+sees the same activation state. Code changing a session must call commit()
+to make the change visible to the other workers; decisions that depend on
+the current state (such as claiming a device's upgrade trigger) go through
+update(), which reads and writes the session in one transaction.
+
+Example:
+    >>> store = SessionStore(max_sessions=100, ttl=3600)
+    >>> session = store.touch("43511212112233445566", "s.gw.token.get", encrypted=True)
+    >>> session.protocol
+    '2.2'
+    >>> "43511212112233445566" in store
+    True
+"""
+
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar
+
+# Default limits
+DEFAULT_MAX_SESSIONS = 4096
+DEFAULT_SESSION_TTL = 3600  # seconds without activity before a session expires
+
+# Distinct stages remembered per session; protects against clients sending
+# arbitrary action names
+MAX_STAGES_PER_SESSION = 32
+
+# Version of the on-disk snapshot format
+SNAPSHOT_VERSION = 1
+
+# Upgrade status values
+UPGRADE_SCHEDULED = "scheduled"
+UPGRADE_TRIGGERED = "triggered"
+UPGRADE_OFFERED = "offered"
+UPGRADE_REPORTED = "reported"
+
+T = TypeVar("T")
+
+
+class DeviceSession:
+    """
+    State of a single device.
+
+    Attributes:
+            gw_id: Gateway ID of the device
+            protocol: "2.2" for encrypted devices, "2.1" otherwise
+            encrypted: Whether the device last used the encrypted protocol
+            api_version: Value of the 'v' request parameter, if sent
+            schema_variant: Number of schema keys served on activation, or None
+            upgrade_status: One of the UPGRADE_* values, or None
+            created: Time the session was created
+            last_seen: Time of the last request
+            stages: Last time each action was requested, by action name
+    """
+
+    __slots__ = (
+        "gw_id",
+        "protocol",
+        "encrypted",
+        "api_version",
+        "schema_variant",
+        "upgrade_status",
+        "created",
+        "last_seen",
+        "stages",
+    )
+
+    def __init__(self, gw_id: str, now: float) -> None:
+        """
+        Create an empty session.
+
+        Args:
+                gw_id: Gateway ID of the device
+                now: Creation time
+        """
+        self.gw_id = gw_id
+        self.protocol: Optional[str] = None
+        self.encrypted = False
+        self.api_version: Optional[str] = None
+        self.schema_variant: Optional[int] = None
+        self.upgrade_status: Optional[str] = None
+        self.created = now
+        self.last_seen = now
+        self.stages: Dict[str, float] = {}
+
+    def record_stage(self, stage: str, now: float) -> None:
+        """
+        Remember when a protocol stage was reached.
+
+        Args:
+                stage: Stage name, usually the Tuya action
+                now: Time the stage was reached
+        """
+        if stage in self.stages or len(self.stages) < MAX_STAGES_PER_SESSION:
+            self.stages[stage] = now
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the session as a JSON-serializable dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DeviceSession":
+        """
+        Restore a session from to_dict() output.
+
+        Raises:
+                KeyError: If required fields are missing
+        """
+        session = cls(data["gw_id"], data["created"])
+        for name in cls.__slots__:
+            if name in data:
+                setattr(session, name, data[name])
+        return session
+
+
+class SessionStore:
+    """
+    LRU/TTL-bounded map from gwId to DeviceSession.
+
+    Attributes:
+            max_sessions: Maximum number of sessions kept
+            ttl: Seconds without activity after which a session expires
+            snapshot_path: JSON snapshot location, or None to disable snapshots
+            evicted: Number of sessions dropped because of the size limit
+            expired: Number of sessions dropped because of the TTL
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl: float = DEFAULT_SESSION_TTL,
+        snapshot_path: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Create an empty store.
+
+        Args:
+                max_sessions: Maximum number of sessions kept
+                ttl: Seconds without activity after which a session expires
+                snapshot_path: JSON snapshot location, or None to disable snapshots
+                clock: Time source, replaceable for testing
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.evicted = 0
+        self.expired = 0
+        self._clock = clock
+        self._sessions: "OrderedDict[str, DeviceSession]" = OrderedDict()
+        self._dirty = False
+
+    def __len__(self) -> int:
+        """Return the number of sessions, including not yet collected expired ones."""
+        return len(self._sessions)
+
+    def __contains__(self, gw_id: object) -> bool:
+        """Return whether a live session exists for the gwId."""
+        return isinstance(gw_id, str) and self.get(gw_id) is not None
+
+    def __iter__(self) -> Iterator[DeviceSession]:
+        """Iterate over sessions, least recently used first."""
+        return iter(list(self._sessions.values()))
+
+    def commit(self, session: DeviceSession) -> None:
+        """
+        Publish changes made to a session (no-op for the in-memory store).
+
+        Args:
+                session: Session returned by get() or touch()
+        """
+
+    def _is_expired(self, session: DeviceSession, now: float) -> bool:
+        return now - session.last_seen > self.ttl
+
+    def get(self, gw_id: str) -> Optional[DeviceSession]:
+        """
+        Look up a live session without refreshing it.
+
+        Args:
+                gw_id: Gateway ID of the device
+
+        Returns:
+                The session, or None if unknown or expired
+        """
+        session = self._sessions.get(gw_id)
+        if session is not None and self._is_expired(session, self._clock()):
+            del self._sessions[gw_id]
+            self.expired += 1
+            self._dirty = True
+            return None
+        return session
+
+    def update(self, gw_id: str, change: Callable[[DeviceSession], T]) -> T:
+        """
+        Change the session of a device atomically, creating it if needed.
+
+        Args:
+                gw_id: Gateway ID of the device
+                change: Called with the current session, which it may modify
+
+        Returns:
+                The return value of change
+        """
+        session = self.get(gw_id)
+        if session is None:
+            session = DeviceSession(gw_id, self._clock())
+            self._sessions[gw_id] = session
+            self._evict(session.created)
+        result = change(session)
+        self._dirty = True
+        return result
+
+    def touch(
+        self,
+        gw_id: str,
+        stage: Optional[str] = None,
+        encrypted: bool = False,
+        api_version: Optional[str] = None,
+    ) -> DeviceSession:
+        """
+        Record a request from a device, creating its session if needed.
+
+        Args:
+                gw_id: Gateway ID of the device
+                stage: Protocol stage reached, usually the Tuya action
+                encrypted: Whether the request used the encrypted protocol
+                api_version: Value of the 'v' request parameter, if sent
+
+        Returns:
+                The (new or refreshed) session, now most recently used
+        """
+        now = self._clock()
+        session = self.get(gw_id)
+        if session is None:
+            session = DeviceSession(gw_id, now)
+            self._sessions[gw_id] = session
+            self._evict(now)
+        else:
+            self._sessions.move_to_end(gw_id)
+        self._update(session, now, stage, encrypted, api_version)
+        self._dirty = True
+        return session
+
+    @staticmethod
+    def _update(
+        session: DeviceSession,
+        now: float,
+        stage: Optional[str],
+        encrypted: bool,
+        api_version: Optional[str],
+    ) -> None:
+        """Apply the data of a request to a session."""
+        session.last_seen = now
+        session.encrypted = encrypted
+        session.protocol = "2.2" if encrypted else "2.1"
+        if api_version:
+            session.api_version = api_version
+        if stage:
+            session.record_stage(stage, now)
+
+    def _evict(self, now: float) -> None:
+        """Drop expired sessions from the LRU end, then enforce the size limit."""
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if not self._is_expired(oldest, now):
+                break
+            del self._sessions[oldest.gw_id]
+            self.expired += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def evict_expired(self) -> None:
+        """Drop all expired sessions (meant for periodic housekeeping)."""
+        now = self._clock()
+        for session in list(self._sessions.values()):
+            if self._is_expired(session, now):
+                del self._sessions[session.gw_id]
+                self.expired += 1
+                self._dirty = True
+
+    def clear(self) -> None:
+        """Drop all sessions."""
+        self._sessions.clear()
+        self._dirty = True
+
+    def save(self, force: bool = False) -> bool:
+        """
+        Write a snapshot if enabled and something changed since the last one.
+
+        Args:
+                force: Write even if nothing changed
+
+        Returns:
+                True if a snapshot was written
+        """
+        if not self.snapshot_path or not (self._dirty or force):
+            return False
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "sessions": [session.to_dict() for session in self._sessions.values()],
+        }
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(data, file, separators=(",", ":"))
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"Could not write session snapshot {self.snapshot_path}: {e}")
+            return False
+        self._dirty = False
+        return True
+
+    def load(self) -> int:
+        """
+        Restore sessions from the snapshot, skipping expired ones.
+
+        Returns:
+                Number of sessions restored
+        """
+        if not self.snapshot_path:
+            return 0
+        try:
+            with open(self.snapshot_path, "r") as file:
+                data = json.load(file)
+            if data.get("version") != SNAPSHOT_VERSION:
+                return 0
+            sessions = [DeviceSession.from_dict(entry) for entry in data["sessions"]]
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Ignoring unreadable session snapshot {self.snapshot_path}: {e}")
+            return 0
+        now = self._clock()
+        for session in sorted(sessions, key=lambda s: s.last_seen):
+            if not self._is_expired(session, now):
+                self._sessions[session.gw_id] = session
+        self._evict(now)
+        return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SessionStore shared between processes through a SQLite database.
+
+    The database runs in WAL mode, so readers in one worker never block the
+    writer in another. Each process opens its own connection; create the
+    store after forking.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl: float = DEFAULT_SESSION_TTL,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Open (and if needed create) the session database.
+
+        Args:
+                db_path: SQLite database file shared by all workers
+                max_sessions: Maximum number of sessions kept
+                ttl: Seconds without activity after which a session expires
+                clock: Time source, replaceable for testing
+        """
+        super().__init__(max_sessions, ttl, None, clock)
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, timeout=5.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(gw_id TEXT PRIMARY KEY, last_seen REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+
+    def __len__(self) -> int:
+        """Return the number of sessions, including not yet collected expired ones."""
+        return int(self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0])
+
+    def __iter__(self) -> Iterator[DeviceSession]:
+        """Iterate over sessions, least recently used first."""
+        rows = self._db.execute("SELECT data FROM sessions ORDER BY last_seen").fetchall()
+        return iter([DeviceSession.from_dict(json.loads(data)) for (data,) in rows])
+
+    def commit(self, session: DeviceSession) -> None:
+        """
+        Write a session to the database.
+
+        Args:
+                session: Session returned by get() or touch()
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (gw_id, last_seen, data) VALUES (?, ?, ?)",
+            (session.gw_id, session.last_seen, json.dumps(session.to_dict())),
+        )
+
+    def get(self, gw_id: str) -> Optional[DeviceSession]:
+        """
+        Look up a live session without refreshing it.
+
+        Args:
+                gw_id: Gateway ID of the device
+
+        Returns:
+                The session, or None if unknown or expired
+        """
+        row = self._db.execute(
+            "SELECT last_seen, data FROM sessions WHERE gw_id = ?", (gw_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if self._clock() - row[0] > self.ttl:
+            self._db.execute("DELETE FROM sessions WHERE gw_id = ?", (gw_id,))
+            self.expired += 1
+            return None
+        return DeviceSession.from_dict(json.loads(row[1]))
+
+    def touch(
+        self,
+        gw_id: str,
+        stage: Optional[str] = None,
+        encrypted: bool = False,
+        api_version: Optional[str] = None,
+    ) -> DeviceSession:
+        """
+        Record a request from a device, creating its session if needed.
+
+        Args:
+                gw_id: Gateway ID of the device
+                stage: Protocol stage reached, usually the Tuya action
+                encrypted: Whether the request used the encrypted protocol
+                api_version: Value of the 'v' request parameter, if sent
+
+        Returns:
+                The (new or refreshed) session, already committed
+        """
+        now = self._clock()
+
+        def refresh(session: DeviceSession) -> DeviceSession:
+            self._update(session, now, stage, encrypted, api_version)
+            return session
+
+        return self.update(gw_id, refresh)
+
+    def update(self, gw_id: str, change: Callable[[DeviceSession], T]) -> T:
+        """
+        Change the session of a device atomically, creating it if needed.
+
+        The session is read, changed and committed in one write transaction,
+        so concurrent workers never act on or overwrite a stale copy.
+
+        Args:
+                gw_id: Gateway ID of the device
+                change: Called with the current session, which it may modify
+
+        Returns:
+                The return value of change
+        """
+        now = self._clock()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            session = self.get(gw_id)
+            created = session is None
+            if session is None:
+                session = DeviceSession(gw_id, now)
+            result = change(session)
+            self.commit(session)
+            if created:
+                self._evict(now)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return result
+
+    def _evict(self, now: float) -> None:
+        """Drop expired sessions, then the least recently used beyond the size limit."""
+        self.evict_expired()
+        excess = len(self) - self.max_sessions
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM sessions WHERE gw_id IN "
+                "(SELECT gw_id FROM sessions ORDER BY last_seen LIMIT ?)",
+                (excess,),
+            )
+            self.evicted += excess
+
+    def evict_expired(self) -> None:
+        """Drop all expired sessions (meant for periodic housekeeping)."""
+        cursor = self._db.execute(
+            "DELETE FROM sessions WHERE last_seen < ?", (self._clock() - self.ttl,)
+        )
+        self.expired += max(cursor.rowcount, 0)
+
+    def clear(self) -> None:
+        """Drop all sessions."""
+        self._db.execute("DELETE FROM sessions")
+
+    def save(self, force: bool = False) -> bool:
+        """Sessions are always persistent, there is no snapshot to write."""
+        return False
+
+    def load(self) -> int:
+        """
+        Return the number of live sessions already in the database.
+
+        Returns:
+                Number of sessions available
+        """
+        self.evict_expired()
+        return len(self)
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self._db.close()
+
+
+__all__ = [
+    "DeviceSession",
+    "SessionStore",
+    "SqliteSessionStore",
+    "UPGRADE_OFFERED",
+    "UPGRADE_REPORTED",
+    "UPGRADE_SCHEDULED",
+    "UPGRADE_TRIGGERED",
+]
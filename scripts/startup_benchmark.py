@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Cold start benchmark for the command-line scripts run during flashing.
+
+mq_pub_15.py and fake-registration-server.py are launched again and again
+while devices are flashed, so their start-up time sits on the critical
+path. This benchmark starts each of them in a fresh interpreter with
+``python -X importtime`` and reports:
+
+    - the wall time of the whole run (interpreter start, compiling the
+      script, imports and the run itself, e.g. printing --help)
+    - the time spent importing modules, and the slowest top-level imports
+    - heavy packages that the script is meant to import only on first use
+      (paho, Cryptodome) but did import anyway
+
+Every target has an import time budget; the exit code is 1 if a target
+exceeds its budget or imports a deferred package, so the benchmark doubles
+as a regression check (see tests/test_startup_budget.py). The fastest of
+--runs runs counts, which filters out noise from other processes.
+
+Module caching matters: without __pycache__ (e.g. PYTHONDONTWRITEBYTECODE)
+every import includes compiling the module, so compare runs made with the
+same settings only.
+
+Typical Usage:
+    $ ./startup_benchmark.py --runs 10 --json startup.json
+
+Example:
+    >>> run = measure(TARGETS[0], runs=3)
+    >>> run.deferred_loaded
+    []
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, NamedTuple, Optional, Sequence, Set, Tuple
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StartupTarget(NamedTuple):
+    """
+    A script whose start-up is measured.
+
+    Attributes:
+            name: Name in reports and for --target
+            argv: Script and arguments, relative to the scripts directory
+            budget_ms: Maximum import time in milliseconds
+            deferred: Top-level packages the run must not import
+    """
+
+    name: str
+    argv: Tuple[str, ...]
+    budget_ms: float
+    deferred: Tuple[str, ...] = ()
+
+
+# Budgets leave room for slow hosts and for compiling without __pycache__.
+# While mq_pub_15 imported paho and Cryptodome at load time it spent ~100 ms
+# importing 172 modules for --help, ~26 ms and 80 modules without. Tornado,
+# which every server handler builds on, is most of the server's budget.
+TARGETS = (
+    StartupTarget("mq_pub_15", ("mq_pub_15.py", "--help"), 75.0, ("paho", "Cryptodome")),
+    StartupTarget(
+        "fake-registration-server",
+        ("fake-registration-server.py", "--help"),
+        300.0,
+        ("paho", "Cryptodome"),
+    ),
+)
+
+
+class ImportRecord(NamedTuple):
+    """
+    One line of -X importtime output.
+
+    Attributes:
+            name: Imported module
+            self_us: Microseconds spent in the module itself
+            cumulative_us: Microseconds including the modules it imported
+            depth: Nesting level, 0 for modules imported by the script
+    """
+
+    name: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+class StartupRun(NamedTuple):
+    """
+    Result of the fastest run of a target.
+
+    Attributes:
+            target: Target name
+            wall_ms: Wall time of the run in milliseconds
+            import_ms: Time spent importing in milliseconds
+            modules: Number of modules imported
+            slowest: (module, milliseconds) of the slowest top-level imports
+            deferred_loaded: Deferred packages that were imported anyway
+            budget_ms: Import time budget of the target
+    """
+
+    target: str
+    wall_ms: float
+    import_ms: float
+    modules: int
+    slowest: List[Tuple[str, float]]
+    deferred_loaded: List[str]
+    budget_ms: float
+
+    @property
+    def passed(self) -> bool:
+        """Whether the run kept to the budget and imported no deferred package."""
+        return self.import_ms <= self.budget_ms and not self.deferred_loaded
+
+
+def parse_importtime(output: str) -> List[ImportRecord]:
+    """
+    Parse the -X importtime lines of a process's stderr, ignoring other lines.
+
+    Args:
+            output: stderr of the process
+
+    Returns:
+            One record per imported module, in import completion order
+    """
+    records = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split(":", 1)[1].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header line
+        name = fields[2].rstrip()
+        indent = len(name) - len(name.lstrip())
+        records.append(
+            ImportRecord(name.strip(), int(fields[0]), int(fields[1]), max(0, indent - 1) // 2)
+        )
+    return records
+
+
+def run_once(target: StartupTarget) -> Tuple[float, List[ImportRecord]]:
+    """
+    Start a target once in a fresh interpreter.
+
+    Returns:
+            The wall time in milliseconds and the import records
+    """
+    command = [sys.executable, "-X", "importtime"] + list(target.argv)
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=SCRIPTS_DIR, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    return wall_ms, parse_importtime(result.stderr)
+
+
+def measure(target: StartupTarget, runs: int = 5, top: int = 8) -> StartupRun:
+    """
+    Start a target several times and report its fastest run.
+
+    Args:
+            target: Script to start
+            runs: Number of runs
+            top: Number of slowest top-level imports reported
+
+    Returns:
+            The fastest run; deferred packages count if any run imported them
+    """
+    best: Optional[Tuple[float, List[ImportRecord]]] = None
+    loaded: Set[str] = set()
+    for _ in range(runs):
+        wall_ms, records = run_once(target)
+        loaded.update(record.name.split(".")[0] for record in records)
+        if best is None or wall_ms < best[0]:
+            best = (wall_ms, records)
+    assert best is not None, "runs must be at least 1"
+    wall_ms, records = best
+    top_level = [record for record in records if record.depth == 0]
+    slowest = sorted(top_level, key=lambda record: record.cumulative_us, reverse=True)[:top]
+    return StartupRun(
+        target=target.name,
+        wall_ms=round(wall_ms, 1),
+        import_ms=round(sum(record.cumulative_us for record in top_level) / 1000, 1),
+        modules=len(records),
+        slowest=[(record.name, round(record.cumulative_us / 1000, 1)) for record in slowest],
+        deferred_loaded=sorted(loaded.intersection(target.deferred)),
+        budget_ms=target.budget_ms,
+    )
+
+
+def format_runs(runs: Sequence[StartupRun]) -> str:
+    """Format benchmark results as a text report."""
+    lines = []
+    for run in runs:
+        lines.append(
+            "%s: %.1f ms wall, %.1f ms importing %d modules (budget %.0f ms) %s"
+            % (
+                run.target,
+                run.wall_ms,
+                run.import_ms,
+                run.modules,
+                run.budget_ms,
+                "ok" if run.passed else "FAILED",
+            )
+        )
+        for name, ms in run.slowest:
+            lines.append("    %8.1f ms  %s" % (ms, name))
+        if run.deferred_loaded:
+            lines.append("    imported deferred packages: %s" % ", ".join(run.deferred_loaded))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point.
+
+    Args:
+            argv: Arguments without the program name (default: sys.argv[1:])
+
+    Returns:
+            0 if every target kept to its budget, 1 otherwise
+    """
+    names = [target.name for target in TARGETS]
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the scripts")
+    parser.add_argument(
+        "--target", action="append", choices=names, help="target to measure (default: all)"
+    )
+    parser.add_argument("--runs", type=int, default=5, help="runs per target")
+    parser.add_argument("--top", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    selected = [target for target in TARGETS if target.name in (args.target or names)]
+    runs = [measure(target, max(1, args.runs), args.top) for target in selected]
+    print(format_runs(runs))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump([dict(run._asdict(), passed=run.passed) for run in runs], file, indent=2)
+    return 0 if all(run.passed for run in runs) else 1
+
+
+__all__ = [
+    "StartupRun",
+    "StartupTarget",
+    "TARGETS",
+    "format_runs",
+    "measure",
+    "parse_importtime",
+]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Non-blocking structured logging for the fake registration server.
+
+The server used to print() every request line, header block, payload and
+reply directly from the Tornado event loop. When stdout is a slow terminal or
+a ``screen -L`` log on a busy disk, every print stalls request handling.
+
+StructuredLog moves all output to a background writer thread:
+
+    - log() only appends a record to a bounded queue and never blocks; if the
+      writer falls behind and the queue is full, records are dropped and
+      counted instead of stalling the caller
+    - the writer drains the queue in batches and issues one write per batch
+    - records below the configured level are discarded before queueing
+    - every record is echoed as plain text to stdout, so the console and the
+      existing screen logs look as before
+    - optionally every record is also written as one JSON object per line
+      (JSONL) to a size-rotated file, tagged with the request id, for
+      post-mortem analysis with standard tools
+
+Example:
+    >>> log = StructuredLog(path="/tmp/web.jsonl", level=INFO)
+    >>> rid = log.new_request_id()
+    >>> log.info("request", "POST /gw.json?a=s.gw.token.get", rid, action="s.gw.token.get")
+    True
+    >>> log.close()
+"""
+
+import atexit
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from typing import IO, Any, Dict, List, NamedTuple, Optional
+
+# Verbosity levels (same values as the logging module)
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+# Queue and batching limits
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 256
+
+# JSONL file rotation
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+
+
+class LogRecord(NamedTuple):
+    """
+    A single queued log record.
+
+    Attributes:
+            ts: Creation time (seconds since the epoch)
+            level: Verbosity level, e.g. INFO
+            event: Short machine-readable event name, e.g. "reply"
+            message: Human-readable text echoed to the console
+            request_id: Id of the request the record belongs to, 0 if none
+            fields: Additional JSON-serializable data
+    """
+
+    ts: float
+    level: int
+    event: str
+    message: str
+    request_id: int
+    fields: Dict[str, Any]
+
+
+def parse_level(name: str) -> int:
+    """
+    Convert a level name such as "info" to its numeric value.
+
+    Raises:
+            ValueError: If the name is not a known level
+    """
+    try:
+        return LEVELS[name.lower()]
+    except KeyError:
+        raise ValueError("unknown log level %r, use one of %s" % (name, ", ".join(LEVELS)))
+
+
+class StructuredLog:
+    """
+    Queue-backed logger with a background writer thread.
+
+    Attributes:
+            level: Records below this level are discarded
+            path: JSONL output file, or None for console output only
+            echo: Whether records are echoed as text to stdout
+            dropped: Number of records dropped because the queue was full
+            written: Number of records written by the writer thread
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        level: int = DEBUG,
+        echo: bool = True,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        backup_count: int = DEFAULT_BACKUP_COUNT,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        """
+        Create a logger; the writer thread starts with the first record.
+
+        Args:
+                path: JSONL output file, or None for console output only
+                level: Minimum level of records that are kept
+                echo: Whether records are echoed as text to stdout
+                max_bytes: Size at which the JSONL file is rotated
+                backup_count: Number of rotated files kept (path.1 ... path.N)
+                queue_size: Maximum number of records waiting for the writer
+                batch_size: Maximum number of records written at once
+        """
+        self.level = level
+        self.path = path
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self._queue: "queue.Queue[Optional[LogRecord]]" = queue.Queue(queue_size)
+        self._request_ids = itertools.count(1)
+        self._file: Optional[IO[str]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def new_request_id(self) -> int:
+        """Return a new id to correlate the records of one request."""
+        return next(self._request_ids)
+
+    def is_enabled(self, level: int) -> bool:
+        """Return whether records of the level are kept."""
+        return level >= self.level
+
+    def log(self, level: int, event: str, message: str, request_id: int = 0, **fields: Any) -> bool:
+        """
+        Queue a record without blocking.
+
+        Args:
+                level: Verbosity level, e.g. INFO
+                event: Short machine-readable event name
+                message: Human-readable text echoed to the console
+                request_id: Id from new_request_id(), 0 if none
+                fields: Additional JSON-serializable data
+
+        Returns:
+                True if the record was queued, False if filtered or dropped
+        """
+        if level < self.level:
+            return False
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(
+                LogRecord(time.time(), level, event, message, request_id, fields)
+            )
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def debug(self, event: str, message: str, request_id: int = 0, **fields: Any) -> bool:
+        """Queue a DEBUG record."""
+        return self.log(DEBUG, event, message, request_id, **fields)
+
+    def info(self, event: str, message: str, request_id: int = 0, **fields: Any) -> bool:
+        """Queue an INFO record."""
+        return self.log(INFO, event, message, request_id, **fields)
+
+    def warning(self, event: str, message: str, request_id: int = 0, **fields: Any) -> bool:
+        """Queue a WARNING record."""
+        return self.log(WARNING, event, message, request_id, **fields)
+
+    def flush(self) -> None:
+        """Block until all queued records have been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Write all queued records, stop the writer thread and close the file."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _start(self) -> None:
+        """Start the writer thread (once)."""
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="structured-log", daemon=True)
+                thread.start()
+                self._thread = thread
+                atexit.register(self.close)
+
+    def _run(self) -> None:
+        """Writer thread: drain the queue in batches until close()."""
+        running = True
+        while running:
+            batch: List[LogRecord] = []
+            record = self._queue.get()
+            taken = 1
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                    taken += 1
+                except queue.Empty:
+                    break
+            running = record is not None
+            try:
+                self._write(batch)
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def _write(self, batch: List[LogRecord]) -> None:
+        """Write a batch to the console and the JSONL file."""
+        if not batch:
+            return
+        if self.echo:
+            try:
+                sys.stdout.write("".join(record.message + "\n" for record in batch))
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                # Console went away (closed pipe or capture); keep the file log going
+                pass
+        if self.path:
+            try:
+                self._write_file("".join(self._format_json(record) for record in batch))
+            except OSError as e:
+                sys.stderr.write("Could not write log file %s: %s\n" % (self.path, e))
+        self.written += len(batch)
+
+    def _format_json(self, record: LogRecord) -> str:
+        """Format a record as one JSONL line."""
+        entry = {
+            "ts": round(record.ts, 6),
+            "level": LEVEL_NAMES.get(record.level, str(record.level)),
+            "event": record.event,
+            "rid": record.request_id,
+            "msg": record.message,
+        }
+        entry.update(record.fields)
+        return json.dumps(entry, default=str, separators=(",", ":")) + "\n"
+
+    def _write_file(self, data: str) -> None:
+        """Append to the JSONL file, rotating it when it grows too large."""
+        assert self.path is not None
+        if self._file is None:
+            self._file = open(self.path, "a")
+        if self._file.tell() + len(data) > self.max_bytes and self._file.tell() > 0:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _rotate(self) -> None:
+        """Shift path -> path.1 -> ... -> path.N and reopen path."""
+        assert self.path is not None and self._file is not None
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.path, index + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a")
+
+
+__all__ = [
+    "DEBUG",
+    "ERROR",
+    "INFO",
+    "WARNING",
+    "LogRecord",
+    "StructuredLog",
+    "parse_level",
+]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+In-process firmware upgrade trigger scheduler.
+
+After a device has been activated, the fake registration server waits a few
+seconds and then publishes a protocol 15 upgrade trigger to the device's MQTT
+topic ``smart/device/in/<gwId>``. Previously every activation started a
+thread that slept and then launched ``mq_pub_15.py`` as a subprocess, which
+paid for a new interpreter and a new broker connection per device.
+
+This module schedules the triggers as timers on the Tornado IOLoop and
+publishes them through a single persistent paho MQTT client:
+
+    - at most one trigger is pending per gwId, repeated activations of the
+      same device while a trigger is pending do not schedule another one
+    - pending triggers can be cancelled individually or all at once
+    - the MQTT client connects lazily on the first trigger and reconnects in
+      its own network thread; QoS 1 messages published while the connection
+      is (re)established are queued by paho
+    - triggers and failures are reported through a StructuredLog, so they
+      reach the server's JSONL log and never block the IOLoop
+    - an optional on_fired callback learns when a device's trigger is no
+      longer pending, e.g. to release a claim held in the shared sessions
+
+Example:
+    >>> scheduler = UpgradeScheduler(broker="127.0.0.1", delay=10)
+    >>> scheduler.schedule("43511212112233445566", "2.2")
+    True
+    >>> scheduler.pending()
+    ['43511212112233445566']
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import tornado.ioloop
+from mq_pub_15 import (
+    DEFAULT_BROKER,
+    DEFAULT_LOCAL_KEY,
+    DEVICE_IN_TOPIC,
+    MQTT_KEEPALIVE,
+    MQTT_PORT,
+    TRIGGER_QOS,
+    build_message,
+    create_mqtt_client,
+    iot_enc_batch,
+)
+from structured_log import StructuredLog
+
+# Seconds between device activation and the upgrade trigger
+UPGRADE_TRIGGER_DELAY = 10
+
+
+class UpgradeScheduler:
+    """
+    Schedules upgrade triggers on the IOLoop and publishes them over MQTT.
+
+    Attributes:
+            broker: MQTT broker address
+            delay: Seconds between schedule() and publishing the trigger
+            local_key: Local key used to encrypt the trigger messages
+            log: Receives trigger and failure records
+            on_fired: Called with the gwId after its trigger was attempted
+            fired: Number of triggers published
+    """
+
+    def __init__(
+        self,
+        broker: str = DEFAULT_BROKER,
+        delay: float = UPGRADE_TRIGGER_DELAY,
+        local_key: str = DEFAULT_LOCAL_KEY,
+        log: Optional[StructuredLog] = None,
+        on_fired: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        """
+        Create a scheduler; no connection is made until the first trigger.
+
+        Args:
+                broker: MQTT broker address
+                delay: Seconds between schedule() and publishing the trigger
+                local_key: Local key used to encrypt the trigger messages
+                log: Receives trigger and failure records (default: a
+                     console-only StructuredLog)
+                on_fired: Called with the gwId after its trigger was published
+                          or failed; not called for cancelled triggers
+        """
+        self.broker = broker
+        self.delay = delay
+        self.local_key = local_key
+        self.log = log if log is not None else StructuredLog()
+        self.on_fired = on_fired
+        self.fired = 0
+        self._pending: Dict[str, Tuple[tornado.ioloop.IOLoop, object]] = {}
+        self._client: Optional[Any] = None
+
+    def pending(self) -> List[str]:
+        """Return the gwIds with a pending trigger."""
+        return list(self._pending)
+
+    def schedule(self, gw_id: str, protocol: str) -> bool:
+        """
+        Schedule an upgrade trigger for a device.
+
+        Args:
+                gw_id: Gateway ID of the activated device
+                protocol: Protocol version of the device, "2.1" or "2.2"
+
+        Returns:
+                True if a trigger was scheduled, False if one was already pending
+        """
+        if gw_id in self._pending:
+            return False
+        io_loop = tornado.ioloop.IOLoop.current()
+        handle = io_loop.call_later(self.delay, self._fire, gw_id, protocol)
+        self._pending[gw_id] = (io_loop, handle)
+        return True
+
+    def cancel(self, gw_id: str) -> bool:
+        """
+        Cancel the pending trigger of a device.
+
+        Args:
+                gw_id: Gateway ID of the device
+
+        Returns:
+                True if a pending trigger was cancelled
+        """
+        entry = self._pending.pop(gw_id, None)
+        if entry is None:
+            return False
+        io_loop, handle = entry
+        io_loop.remove_timeout(handle)
+        return True
+
+    def cancel_all(self) -> None:
+        """Cancel all pending triggers."""
+        for gw_id in list(self._pending):
+            self.cancel(gw_id)
+
+    def close(self) -> None:
+        """Cancel pending triggers and close the MQTT connection."""
+        self.cancel_all()
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+
+    def _connection(self) -> Any:
+        """Return the persistent MQTT client, connecting it on first use."""
+        if self._client is None:
+            client = create_mqtt_client()
+            client.connect_async(self.broker, MQTT_PORT, MQTT_KEEPALIVE)
+            client.loop_start()
+            self._client = client
+        return self._client
+
+    def _fire(self, gw_id: str, protocol: str) -> None:
+        """
+        Publish the upgrade trigger of a device (IOLoop timer callback).
+
+        Args:
+                gw_id: Gateway ID of the device
+                protocol: Protocol version of the device, "2.1" or "2.2"
+        """
+        self._pending.pop(gw_id, None)
+        try:
+            message = build_message(gw_id, protocol)
+            self.log.debug(
+                "upgrade",
+                "encoding %s using protocol %s" % (message, protocol),
+                gwId=gw_id,
+                protocol=protocol,
+            )
+            # iot_enc_batch() produces the same frame as iot_enc() without printing it
+            payload = iot_enc_batch([message], [self.local_key], [protocol])[0]
+            self._connection().publish(DEVICE_IN_TOPIC % gw_id, payload, qos=TRIGGER_QOS)
+            self.fired += 1
+        except (OSError, ValueError) as e:
+            # Never let a failed trigger take down the event loop
+            self.log.warning(
+                "upgrade", f"Could not trigger upgrade for {gw_id}: {e}", gwId=gw_id, error=str(e)
+            )
+        if self.on_fired is not None:
+            self.on_fired(gw_id)
+
+
+__all__ = ["UpgradeScheduler", "UPGRADE_TRIGGER_DELAY"]
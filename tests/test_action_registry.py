@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the action_registry module.
+
+Validates exact lookups, fallback priority, memoization and plugin loading.
+"""
+
+import os
+import sys
+import types
+from unittest.mock import Mock, patch
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from action_registry import FALLBACK_MEMO_SIZE, ActionRegistry, ActionRequest
+
+
+class TestActionRegistry:
+    """Test the generic registry."""
+
+    def test_exact_lookup(self):
+        """Test that exact names resolve to their handler."""
+        registry = ActionRegistry()
+        handler = Mock()
+        registry.register(handler, "a.b", "c.d")
+
+        assert registry.resolve("a.b") is handler
+        assert registry.resolve("c.d") is handler
+        assert "a.b" in registry
+        assert registry.actions() == ["a.b", "c.d"]
+
+    def test_route_decorator(self):
+        """Test the decorator form of register()."""
+        registry = ActionRegistry()
+
+        @registry.route("x.y")
+        def answer(handler, request):
+            pass
+
+        assert registry.resolve("x.y") is answer
+
+    def test_fallback_priority_is_registration_order(self):
+        """Test that the first registered matching fallback wins."""
+        registry = ActionRegistry()
+        first, second = Mock(), Mock()
+        registry.register_fallback(r"\.updatestatus", first)
+        registry.register_fallback(r"\.upgrade", second)
+
+        assert registry.resolve("s.gw.upgrade.updatestatus") is first
+        assert registry.resolve("s.gw.upgrade") is second
+
+    def test_default_handler(self):
+        """Test that unmatched actions use the default handler."""
+        default = Mock()
+        registry = ActionRegistry(default=default)
+
+        assert registry.resolve("anything") is default
+        assert ActionRegistry().dispatch(Mock(), ActionRequest("x", False, "0")) is False
+
+    def test_fallback_memo_is_bounded(self):
+        """Test that memoized fallback lookups cannot grow without limit."""
+        registry = ActionRegistry(default=Mock())
+        for i in range(FALLBACK_MEMO_SIZE + 10):
+            registry.resolve("unknown.%d" % i)
+
+        assert len(registry._memo) == FALLBACK_MEMO_SIZE
+
+    def test_exact_registration_overrides_memo(self):
+        """Test that registering a name after it was memoized takes effect."""
+        registry = ActionRegistry(default=Mock())
+        registry.resolve("new.action")
+        handler = Mock()
+        registry.register(handler, "new.action")
+
+        assert registry.resolve("new.action") is handler
+
+    def test_load_plugins(self):
+        """Test that plugin modules can register actions."""
+        registry = ActionRegistry()
+        handler = Mock()
+        plugin = types.ModuleType("test_actions_plugin")
+        plugin.register_actions = lambda reg: reg.register(handler, "plugin.action")
+
+        with patch.dict(sys.modules, {"test_actions_plugin": plugin}):
+            registry.load_plugins(["test_actions_plugin"])
+
+        assert registry.resolve("plugin.action") is handler
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
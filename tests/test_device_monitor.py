@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the device_monitor module.
+
+Validates decoding and verification of protocol 2.1 and 2.2 frames, the key
+cache and the batched JSONL output without an MQTT broker.
+"""
+
+import io
+import json
+import os
+import sys
+from unittest.mock import Mock, patch
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import device_monitor
+from device_monitor import DeviceMonitor, Frame, KeyCache, decode_frame
+from mq_pub_15 import build_message, iot_enc_batch
+
+GW_ID = "43511212112233445566"
+LOCAL_KEY = "a1b2c3d4e5f67788"
+
+
+def frame(protocol, key=LOCAL_KEY, gw_id=GW_ID, direction="in"):
+    """Encrypted trigger frame as published by mq_pub_15."""
+    payload = iot_enc_batch([build_message(gw_id, protocol, now=1700000000)], [key], [protocol])[0]
+    return Frame(1700000000.5, "smart/device/%s/%s" % (direction, gw_id), payload)
+
+
+def key_cache():
+    """Key cache knowing GW_ID."""
+    keys = KeyCache()
+    keys.load(["%s %s\n" % (GW_ID, LOCAL_KEY)])
+    return keys
+
+
+class TestDecodeFrame:
+    """Test verification and decryption of single frames."""
+
+    def test_protocol_21(self):
+        """Test that a 2.1 frame is verified and decrypted with the device key."""
+        record = decode_frame(frame("2.1"), key_cache())
+
+        assert record["protocol"] == "2.1" and record["valid"] is True
+        assert record["gwId"] == GW_ID and record["t"] == 1700000000.5
+        assert record["message"]["data"] == {"gwId": GW_ID}
+        assert "error" not in record
+
+    def test_protocol_22(self):
+        """Test that a 2.2 frame is CRC checked and decrypted."""
+        record = decode_frame(frame("2.2"), key_cache())
+
+        assert record["protocol"] == "2.2" and record["valid"] is True
+        assert len(record["timestamp"]) == 8
+        assert record["message"]["t"] == "1700000000"
+
+    def test_tampered_frames(self):
+        """Test that a bad signature or CRC is reported and not decrypted."""
+        for protocol, error in (("2.1", "signature mismatch"), ("2.2", "CRC mismatch")):
+            good = frame(protocol)
+            bad = good._replace(payload=good.payload[:-1] + bytes((good.payload[-1] ^ 1,)))
+
+            record = decode_frame(bad, key_cache())
+
+            assert record["valid"] is False and record["error"] == error
+            assert "message" not in record
+
+    def test_unknown_device_uses_default_key(self):
+        """Test the default key fallback and a 2.2 frame under the wrong key."""
+        keys = key_cache()
+
+        assert decode_frame(frame("2.1", "0000000000000000", "other0000000000"), keys)["valid"]
+        record = decode_frame(frame("2.2", key="0000000000000000"), keys)
+        assert record["valid"] is True and "error" in record
+
+    def test_raw_payload(self):
+        """Test that payloads in neither format are kept as text."""
+        record = decode_frame(Frame(0.0, "smart/device/out/" + GW_ID, b'{"online":1}'), KeyCache())
+
+        assert record["protocol"] is None and record["raw"] == '{"online":1}'
+
+
+class TestDeviceMonitor:
+    """Test queueing and batched output."""
+
+    def test_process_writes_jsonl(self):
+        """Test that a batch becomes one JSON line per frame, in order."""
+        output = io.StringIO()
+        monitor = DeviceMonitor(output, key_cache())
+        bad = frame("2.2")._replace(payload=b"2.2garbage")
+
+        monitor.process([frame("2.1"), bad, frame("2.2", direction="out")])
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [r["protocol"] for r in records] == ["2.1", "2.2", "2.2"]
+        assert records[2]["topic"] == "smart/device/out/" + GW_ID
+        assert monitor.written == 3 and monitor.invalid == 1
+
+    def test_full_queue_drops(self):
+        """Test that frames are dropped instead of blocking when the queue is full."""
+        monitor = DeviceMonitor(io.StringIO(), queue_size=1)
+
+        assert monitor.feed(frame("2.1")) is True
+        assert monitor.feed(frame("2.1")) is False
+        assert monitor.received == 2 and monitor.dropped == 1
+
+    def test_subscription_and_stop_drains(self):
+        """Test that received messages are decoded and written by stop()."""
+        client = Mock()
+        output = io.StringIO()
+        monitor = DeviceMonitor(output, key_cache(), "10.42.42.1")
+        with patch.object(device_monitor, "create_mqtt_client", return_value=client):
+            monitor.start()
+        client.connect_async.assert_called_once_with("10.42.42.1", 1883, 60)
+        client.on_connect(client, None, {}, 0)
+        client.subscribe.assert_called_once_with("smart/device/#", qos=1)
+
+        for protocol in ("2.1", "2.2"):
+            message = Mock(topic=frame(protocol).topic, payload=frame(protocol).payload)
+            client.on_message(client, None, message)
+        monitor.stop()
+
+        assert monitor.written == 2
+        assert all(json.loads(line)["valid"] for line in output.getvalue().splitlines())
+        client.loop_stop.assert_called_once()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the device_simulator module.
+
+Validates trigger decoding for both MQTT protocols, the device-side PSK
+derivation, latency percentiles and the fleet report.
+"""
+
+import hashlib
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+from Cryptodome.Cipher import AES
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from device_simulator import FleetReport, StageError, decode_trigger, device_psk, percentile
+from mq_pub_15 import build_message, iot_enc
+
+LOCAL_KEY = "0000000000000000"
+
+
+class TestDecodeTrigger:
+    """Test decoding of the protocol 15 upgrade trigger."""
+
+    @pytest.mark.parametrize("protocol", ["2.1", "2.2"])
+    def test_roundtrip(self, protocol):
+        """Test that triggers published by mq_pub_15 are decoded."""
+        with patch("builtins.print"):
+            payload = iot_enc(build_message("sim00001", protocol), LOCAL_KEY, protocol)
+
+        message = decode_trigger(payload, LOCAL_KEY)
+
+        assert message["protocol"] == 15
+        assert message["data"]["gwId"] == "sim00001"
+
+    def test_corrupted_22_message(self):
+        """Test that a protocol 2.2 message with a bad CRC is rejected."""
+        with patch("builtins.print"):
+            payload = bytearray(iot_enc(build_message("sim00001", "2.2"), LOCAL_KEY, "2.2"))
+        payload[-1] ^= 0xFF
+
+        with pytest.raises(ValueError):
+            decode_trigger(bytes(payload), LOCAL_KEY)
+
+
+class TestDevicePsk:
+    """Test the device side of the TLS-PSK key derivation."""
+
+    def test_matches_frontend_algorithm(self):
+        """Test that the key is AES-CBC(identity) keyed by the hint, as in gen_psk()."""
+        identity = b"\x01BAohbmd6aG91IFR1" + b"0123456789abcdef"
+        hint = b"1dHRsc2NjbHltbGx3eWh50000000000000000"
+
+        key = hashlib.md5(hint[-16:]).digest()
+        iv = hashlib.md5(identity[1:]).digest()
+        expected = AES.new(key, AES.MODE_CBC, iv).encrypt(identity[1:33])
+
+        assert device_psk(identity, hint) == expected
+        assert len(expected) == 32
+
+
+class TestReport:
+    """Test latency statistics."""
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = [float(i) for i in range(1, 101)]
+
+        assert percentile(values, 0.50) == 50.0
+        assert percentile(values, 0.99) == 99.0
+        assert percentile(values, 1.0) == 100.0
+        assert percentile([], 0.5) == 0.0
+
+    def test_report_counts_stages_and_failures(self):
+        """Test that completed devices and failed stages are summarized."""
+        report = FleetReport(3)
+        report.add({"token": 0.001, "active": 0.002}, None)
+        report.add({"token": 0.003}, StageError("active", "HTTP 500"))
+        report.add({"token": 0.002}, StageError("active", "HTTP 500"))
+        report.elapsed = 1.0
+
+        data = report.to_dict()
+
+        assert data["completed"] == 1
+        assert data["stages"]["token"]["count"] == 3
+        assert data["stages"]["token"]["max_ms"] == 3.0
+        assert data["stages"]["active"]["failed"] == 2
+        assert data["failures"] == [{"stage": "active", "reason": "HTTP 500", "count": 2}]
+        assert "1/3 devices completed" in report.format()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -11,7 +11,14 @@ import sys
 import os
 import pytest
 from unittest.mock import Mock, MagicMock, patch, call
+import asyncio
 import binascii
+import json
+import shutil
+import tempfile
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
 
 # Add scripts directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
@@ -228,8 +235,8 @@ class TestJSONHandlerEndpoints:
         handler.set_header = Mock()
         handler.write = Mock()
 
-        # Clear activated_ids to simulate first activation
-        JSONHandler.activated_ids = {}
+        # Clear device sessions to simulate first activation
+        JSONHandler.sessions.clear()
 
         with patch('builtins.print'), \
              patch('subprocess.run') as mock_subprocess, \
@@ -246,6 +253,80 @@ class TestJSONHandlerEndpoints:
         # First activation should have 20 schema keys
         assert response['result']['schema'].count('"id":1') == 20
 
+    def test_active_endpoint_schedules_upgrade(self):
+        """Test .active endpoint schedules the upgrade trigger in-process."""
+        handler = JSONHandler.__new__(JSONHandler)
+        handler.request = Mock()
+        handler.request.uri = "/gw.json?a=s.gw.dev.pk.active&gwId=newdevice123"
+        handler.request.method = "POST"
+        handler.request.headers = {}
+        handler.request.body = b""
+
+        handler.get_argument = Mock(side_effect=lambda key, default: {
+            'a': 's.gw.dev.pk.active',
+            'gwId': 'newdevice123',
+            'et': '1'
+        }.get(key, default))
+
+        handler.set_header = Mock()
+        handler.write = Mock()
+        JSONHandler.sessions.clear()
+
+        with patch('builtins.print'), \
+             patch('subprocess.run') as mock_subprocess, \
+             patch.object(fake_server.upgrade_scheduler, 'schedule') as mock_schedule:
+            handler.post()
+
+        # No subprocess is started, the trigger runs on the IOLoop
+        mock_schedule.assert_called_once_with('newdevice123', '2.2')
+        assert not mock_subprocess.called
+
+    def test_active_endpoint_claims_upgrade_once(self, tmp_path):
+        """Test that only the worker claiming the device schedules its trigger."""
+        path = str(tmp_path / "sessions.db")
+        workers = [fake_server.SqliteSessionStore(path), fake_server.SqliteSessionStore(path)]
+        templates = []
+
+        def activate(store):
+            handler = JSONHandler.__new__(JSONHandler)
+            handler.request = Mock()
+            handler.request.uri = "/gw.json?a=s.gw.dev.pk.active&gwId=newdevice123"
+            handler.request.method = "POST"
+            handler.request.headers = {}
+            handler.request.body = b""
+            handler.get_argument = Mock(
+                side_effect=lambda key, default: {
+                    "a": "s.gw.dev.pk.active",
+                    "gwId": "newdevice123",
+                    "et": "0",
+                }.get(key, default)
+            )
+            handler.reply = Mock(side_effect=lambda *args, **kwargs: templates.append(kwargs))
+            with patch.object(JSONHandler, "sessions", store):
+                handler.post()
+
+        with patch("subprocess.run"), patch.object(
+            fake_server.upgrade_scheduler, "schedule", return_value=True
+        ) as mock_schedule:
+            for store in workers:
+                activate(store)
+            assert mock_schedule.call_count == 1
+
+            # Once the trigger was sent, a new activation may schedule another
+            with patch.object(JSONHandler, "sessions", workers[1]):
+                fake_server.release_upgrade_claim("newdevice123")
+            activate(workers[0])
+            assert mock_schedule.call_count == 2
+
+        assert [kwargs["template"] for kwargs in templates] == [
+            "s.gw.dev.pk.active:20",
+            "s.gw.dev.pk.active:1",
+            "s.gw.dev.pk.active:1",
+        ]
+        assert workers[1].get("newdevice123").upgrade_status == fake_server.UPGRADE_SCHEDULED
+        for store in workers:
+            store.close()
+
     def test_upgrade_endpoint(self):
         """Test .upgrade endpoint."""
         handler = JSONHandler.__new__(JSONHandler)
@@ -517,6 +598,22 @@ class TestHelperFunctions:
         finally:
             os.unlink(temp_path)
 
+    def test_exit_cleanly_closes_upgrade_scheduler(self):
+        """Test that shutdown cancels pending triggers and closes the MQTT client."""
+        store = fake_server.SessionStore()
+        store.update("gw1", lambda session: setattr(session, "upgrade_status", "scheduled"))
+        with patch.object(fake_server.JSONHandler, "sessions", store), patch.object(
+            fake_server, "upgrade_scheduler"
+        ) as scheduler, patch.object(fake_server, "event_log") as event_log:
+            scheduler.pending.return_value = ["gw1"]
+            with pytest.raises(SystemExit):
+                fake_server.exit_cleanly(2, None)
+
+        # The claim is released, so the device is triggered again after a restart
+        assert store.get("gw1").upgrade_status is None
+        scheduler.close.assert_called_once()
+        event_log.close.assert_called_once()
+
 
 class TestFileFingerprint:
     """Test file fingerprint calculation."""
@@ -629,5 +726,320 @@ class TestConfigEndpoints:
         assert answer['devId'] == 'test123'
 
 
+def substring_route(a, encrypted):
+    """The historical if/elif chain of JSONHandler.post, as reply names."""
+    if a == "s.gw.token.get":
+        return "s.gw.token.get"
+    elif ".active" in a:
+        return "s.gw.dev.pk.active"
+    elif ".updatestatus" in a:
+        return "s.gw.upgrade.updatestatus"
+    elif (".upgrade" in a) and encrypted:
+        return "s.gw.upgrade.get"
+    elif ".device.upgrade" in a:
+        return "tuya.device.upgrade.get"
+    elif ".upgrade" in a:
+        return "s.gw.upgrade"
+    elif ".log" in a:
+        return "atop.online.debug.log"
+    elif ".timer" in a:
+        return "s.gw.dev.timer.count"
+    elif ".config.get" in a:
+        return "tuya.device.dynamic.config.get"
+    return "generic"
+
+
+ACTIONS = [
+    "s.gw.token.get",
+    "s.gw.dev.pk.active",
+    "tuya.device.active",
+    "s.gw.dev.active",
+    "s.gw.upgrade.updatestatus",
+    "tuya.device.upgrade.updatestatus",
+    "s.gw.upgrade.get",
+    "s.gw.upgrade",
+    "tuya.device.upgrade.get",
+    "tuya.device.upgrade.silent.get",
+    "atop.online.debug.log",
+    "s.gw.log",
+    "s.gw.dev.timer.count",
+    "s.gw.dev.timer.get",
+    "tuya.device.dynamic.config.get",
+    "s.gw.dev.config.get",
+    "s.gw.unknown",
+    "0",
+]
+
+
+def routed_template(action, encrypted):
+    """Run the action through the registry and return the reply template used."""
+    handler = JSONHandler.__new__(JSONHandler)
+    handler.reply = Mock()
+    JSONHandler.sessions.clear()
+    with patch("builtins.print"), patch("subprocess.run"), patch.object(
+        fake_server.upgrade_scheduler, "schedule"
+    ):
+        fake_server.action_registry.dispatch(
+            handler, fake_server.ActionRequest(action, encrypted, "gw")
+        )
+    template = handler.reply.call_args.kwargs["template"]
+    return template.split(":")[0]
+
+
+class TestServerRouting:
+    """Test that the server routes like the historical substring chain."""
+
+    @pytest.mark.parametrize("encrypted", [False, True])
+    @pytest.mark.parametrize("action", ACTIONS)
+    def test_routing_matches_substring_chain(self, action, encrypted):
+        """Test per action that the registry picks the historical answer."""
+        assert routed_template(action, encrypted) == substring_route(action, encrypted)
+
+
+class TestFirmwareDownload(AsyncHTTPTestCase):
+    """Test sendfile delivery of catalog images through FilesHandler."""
+
+    IMAGE = bytes(range(256)) * 1024
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "upgrade.bin"), "wb") as file:
+            file.write(self.IMAGE)
+        with open(os.path.join(self.directory, "index.html"), "w") as file:
+            file.write("files")
+        catalog = fake_server.FirmwareCatalog(self.directory, "0000000000000000")
+        catalog.load()
+        self.catalog_patch = patch.object(fake_server, "firmware_catalog", catalog)
+        self.catalog_patch.start()
+        self.image = catalog.get("upgrade.bin")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        # AsyncTestCase leaves "no current event loop" behind; later tests rely
+        # on asyncio creating one implicitly, so start from a fresh policy
+        asyncio.set_event_loop_policy(None)
+        self.catalog_patch.stop()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return tornado.web.Application(
+            [("/files/(.*)", fake_server.FilesHandler, {"path": self.directory})]
+        )
+
+    def test_full_download(self):
+        """Test that the whole image is sent with the catalog ETag."""
+        response = self.fetch("/files/upgrade.bin")
+
+        assert response.code == 200
+        assert response.body == self.IMAGE
+        assert response.headers["Etag"] == '"%s"' % self.image.md5
+        assert response.headers["Accept-Ranges"] == "bytes"
+
+    def test_range_resumes_download(self):
+        """Test that a Range request returns only the missing tail."""
+        response = self.fetch("/files/upgrade.bin", headers={"Range": "bytes=1000-"})
+
+        assert response.code == 206
+        assert response.body == self.IMAGE[1000:]
+        assert response.headers["Content-Range"] == "bytes 1000-%d/%d" % (
+            len(self.IMAGE) - 1,
+            len(self.IMAGE),
+        )
+
+    def test_unsatisfiable_range(self):
+        """Test that a range beyond the image is rejected."""
+        response = self.fetch("/files/upgrade.bin", headers={"Range": "bytes=999999999-"})
+
+        assert response.code == 416
+
+    def test_etag_revalidation(self):
+        """Test that an unchanged image is not sent again."""
+        response = self.fetch(
+            "/files/upgrade.bin", headers={"If-None-Match": '"%s"' % self.image.md5}
+        )
+
+        assert response.code == 304
+
+    def test_non_catalog_file_uses_tornado(self):
+        """Test that files not (yet) in the catalog are served normally."""
+        with open(os.path.join(self.directory, "new.bin"), "wb") as file:
+            file.write(b"new")
+
+        with patch.object(fake_server.FilesHandler, "send_image") as send_image:
+            response = self.fetch("/files/new.bin")
+
+        assert response.code == 200
+        assert response.body == b"new"
+        send_image.assert_not_called()
+
+    def test_hidden_files_are_refused(self):
+        """Test that dotfiles such as a catalog index are not served."""
+        with open(os.path.join(self.directory, ".firmware-index.json"), "w") as file:
+            file.write("{}")
+
+        assert self.fetch("/files/.firmware-index.json").code == 404
+        assert self.fetch("/files/.firmware-index.json.tmp").code == 404
+
+    def test_index_fallback(self):
+        """Test that directory requests serve index.html."""
+        response = self.fetch("/files/")
+
+        assert response.code == 200
+        assert response.body == b"files"
+
+    def test_per_ip_download_cap(self):
+        """Test that clients over the concurrency cap are asked to retry."""
+        with patch.dict(
+            fake_server.FilesHandler.downloads, {"127.0.0.1": fake_server.MAX_DOWNLOADS_PER_IP}
+        ):
+            response = self.fetch("/files/upgrade.bin")
+
+        assert response.code == 503
+        assert response.headers["Retry-After"] == str(fake_server.DOWNLOAD_RETRY_AFTER)
+        assert fake_server.FilesHandler.downloads == {}
+
+
+class TestDeviceSimulatorFlow(AsyncHTTPTestCase):
+    """Test the virtual device flow against the real handlers."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "upgrade.bin"), "wb") as file:
+            file.write(os.urandom(64 * 1024))
+        catalog = fake_server.FirmwareCatalog(self.directory, fake_server.options.secKey)
+        catalog.load()
+        self.patches = [
+            patch.object(fake_server, "firmware_catalog", catalog),
+            patch.multiple(
+                fake_server, file_md5="", file_sha256="", file_hmac="", file_len="0"
+            ),
+            patch.object(fake_server.upgrade_scheduler, "schedule", return_value=True),
+            patch.object(fake_server.subprocess, "run"),
+        ]
+        for started in self.patches:
+            started.start()
+        fake_server.use_firmware_image(catalog.get("upgrade.bin"))
+        JSONHandler.sessions.clear()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        asyncio.set_event_loop_policy(None)
+        for started in reversed(self.patches):
+            started.stop()
+        fake_server.response_cache.invalidate()
+        JSONHandler.sessions.clear()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return tornado.web.Application(
+            [
+                ("/gw.json", JSONHandler),
+                ("/files/(.*)", fake_server.FilesHandler, {"path": self.directory}),
+            ]
+        )
+
+    def run_device(self, encrypted):
+        from device_simulator import SimulatorConfig, VirtualDevice
+
+        config = SimulatorConfig(
+            http_port=self.get_http_port(),
+            sec_key=fake_server.options.secKey,
+            wait_for_trigger=False,
+        )
+        device = VirtualDevice("sim00000000000000001", encrypted, config)
+        return self.io_loop.run_sync(device.run, timeout=10)
+
+    def test_plain_device_completes_flow(self):
+        """Test token, active, upgrade and MD5-verified download (protocol 2.1)."""
+        durations = self.run_device(encrypted=False)
+
+        assert list(durations) == ["token", "active", "upgrade", "download"]
+        assert JSONHandler.sessions.get("sim00000000000000001").upgrade_status == "offered"
+
+    def test_encrypted_device_completes_flow(self):
+        """Test encrypted replies and the HMAC-verified download (protocol 2.2)."""
+        durations = self.run_device(encrypted=True)
+
+        assert list(durations) == ["token", "active", "upgrade", "download"]
+        assert JSONHandler.sessions.get("sim00000000000000001").protocol == "2.2"
+
+
+class TestMetricsEndpoint(AsyncHTTPTestCase):
+    """Test the /metrics endpoint."""
+
+    def setUp(self):
+        fake_server.metrics.clear()
+        JSONHandler.sessions.clear()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        asyncio.set_event_loop_policy(None)
+        fake_server.metrics.clear()
+        JSONHandler.sessions.clear()
+
+    def get_app(self):
+        return tornado.web.Application(
+            [("/gw.json", JSONHandler), ("/metrics", fake_server.MetricsHandler)]
+        )
+
+    def post_action(self, action, body=""):
+        return self.fetch(
+            "/gw.json?a=%s&gwId=sim00000000000000001&et=0" % action, method="POST", body=body
+        )
+
+    def test_prometheus_text(self):
+        """Test per-action counters, phase histograms and session counts."""
+        payload = binascii.hexlify(
+            fake_server.encrypt('{"t":1}', fake_server.options.secKey.encode())
+        ).decode()
+        with patch.object(fake_server.upgrade_scheduler, "schedule", return_value=True):
+            self.post_action("s.gw.dev.pk.active", "data=" + payload)
+        self.post_action("s.gw.dev.pk.active", "data=zz")
+
+        response = self.fetch("/metrics")
+        text = response.body.decode()
+
+        assert response.code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert 'tuya_requests_total{action="s.gw.dev.pk.active"} 2' in text
+        assert "tuya_decrypt_failures_total 1" in text
+        for phase in ("decrypt", "handler", "reply"):
+            assert (
+                'tuya_request_duration_seconds_count{phase="%s",action="s.gw.dev.pk.active"}'
+                % phase
+                in text
+            )
+        assert 'tuya_sessions{status="scheduled"} 1' in text
+
+    def test_json_snapshot(self):
+        """Test that ?format=json returns the same metrics as JSON."""
+        self.post_action("atop.online.debug.log")
+
+        snapshot = json.loads(self.fetch("/metrics?format=json").body)
+
+        assert snapshot["tuya_requests_total"]["samples"] == [
+            {"labels": {"action": "atop.online.debug.log"}, "value": 1}
+        ]
+        assert snapshot["tuya_request_duration_seconds"]["type"] == "histogram"
+
+    def test_workers_are_merged(self):
+        """Test that with --workers a scrape includes the snapshots of other workers."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        other = fake_server.WorkerSnapshots(directory, 1)
+        self.post_action("atop.online.debug.log")
+        other.publish(fake_server.metrics)
+
+        with patch.object(
+            fake_server, "worker_metrics", fake_server.WorkerSnapshots(directory, 0)
+        ):
+            text = self.fetch("/metrics").body.decode()
+
+        assert 'tuya_requests_total{action="atop.online.debug.log"} 2' in text
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
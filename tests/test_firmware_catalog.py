@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the firmware_catalog module.
+
+Validates digest calculation, the sidecar index and change detection.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from firmware_catalog import INDEX_FILE_NAME, FirmwareCatalog, firmware_hmac, hash_file
+
+SEC_KEY = "0000000000000000"
+
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    write(tmp_path / "upgrade.bin", b"intermediate firmware")
+    write(tmp_path / "tasmota.bin", b"final firmware" * 1000)
+    return tmp_path
+
+
+class TestHashFile:
+    """Test streaming digest calculation."""
+
+    def test_hash_file_matches_hashlib(self, tmp_path):
+        """Test that streaming digests match hashing the whole file."""
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        path = tmp_path / "image.bin"
+        write(path, content)
+
+        digests = hash_file(str(path))
+
+        assert digests.md5 == hashlib.md5(content).hexdigest()
+        assert digests.sha256 == hashlib.sha256(content).hexdigest().upper()
+
+    def test_hash_empty_file(self, tmp_path):
+        """Test that empty files can be hashed."""
+        path = tmp_path / "empty.bin"
+        write(path, b"")
+
+        assert hash_file(str(path)).md5 == hashlib.md5(b"").hexdigest()
+
+    def test_firmware_hmac(self):
+        """Test HMAC derivation from the SHA256 hex digest."""
+        sha256 = hashlib.sha256(b"test").hexdigest().upper()
+        expected = hmac.HMAC(SEC_KEY.encode(), sha256.encode(), "sha256").hexdigest().upper()
+        assert firmware_hmac(sha256, SEC_KEY) == expected
+
+
+class TestFirmwareCatalog:
+    """Test catalog indexing and refresh."""
+
+    def test_load_indexes_all_images(self, image_dir):
+        """Test that load() indexes every visible file."""
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY)
+        catalog.load()
+
+        assert len(catalog) == 2
+        image = catalog.get("upgrade.bin")
+        assert image.size == len(b"intermediate firmware")
+        assert image.md5 == hashlib.md5(b"intermediate firmware").hexdigest()
+        assert image.hmac == firmware_hmac(image.sha256, SEC_KEY)
+        assert catalog.get("missing.bin") is None
+
+    def test_index_file_is_written_and_hidden(self, image_dir):
+        """Test that the sidecar index is written and not indexed itself."""
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY)
+        catalog.load()
+
+        with open(image_dir / INDEX_FILE_NAME) as f:
+            data = json.load(f)
+        assert set(data["images"]) == {"upgrade.bin", "tasmota.bin"}
+        assert INDEX_FILE_NAME not in catalog
+
+    def test_reload_uses_index_without_rehashing(self, image_dir):
+        """Test that unchanged images are not hashed again after a restart."""
+        FirmwareCatalog(str(image_dir), SEC_KEY).load()
+
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY)
+        catalog.load()
+
+        assert catalog.hashed == 0
+        assert len(catalog) == 2
+
+    def test_index_hmac_follows_sec_key(self, image_dir):
+        """Test that the HMAC is derived with the current secret key."""
+        FirmwareCatalog(str(image_dir), SEC_KEY).load()
+
+        catalog = FirmwareCatalog(str(image_dir), "1111111111111111")
+        catalog.load()
+
+        image = catalog.get("upgrade.bin")
+        assert image.hmac == firmware_hmac(image.sha256, "1111111111111111")
+
+    def test_refresh_detects_changes(self, image_dir):
+        """Test that refresh() rehashes changed files and notifies listeners."""
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY)
+        catalog.load()
+        events = []
+        catalog.add_listener(lambda name, image: events.append((name, image)))
+
+        assert catalog.refresh() == []
+
+        write(image_dir / "upgrade.bin", b"new intermediate firmware")
+        write(image_dir / "espurna.bin", b"espurna")
+        os.unlink(image_dir / "tasmota.bin")
+
+        assert sorted(catalog.refresh()) == ["espurna.bin", "tasmota.bin", "upgrade.bin"]
+        assert (
+            catalog.get("upgrade.bin").md5 == hashlib.md5(b"new intermediate firmware").hexdigest()
+        )
+        assert catalog.get("tasmota.bin") is None
+        assert ("tasmota.bin", None) in events
+
+    def test_poll_hashes_settled_images_off_the_loop(self, image_dir):
+        """Test that poll() waits for an image to stop changing before hashing it."""
+        errors = []
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY, log=errors.append)
+        catalog.load()
+        loop = asyncio.new_event_loop()
+        try:
+            write(image_dir / "upgrade.bin", b"partial")
+            assert loop.run_until_complete(catalog.poll()) == []
+            write(image_dir / "upgrade.bin", b"partial copy, still growing")
+            assert loop.run_until_complete(catalog.poll()) == []
+            assert catalog.hashed == 2
+
+            assert loop.run_until_complete(catalog.poll()) == ["upgrade.bin"]
+            assert loop.run_until_complete(catalog.poll()) == []
+        finally:
+            loop.close()
+
+        expected = hashlib.md5(b"partial copy, still growing").hexdigest()
+        assert catalog.get("upgrade.bin").md5 == expected
+        assert catalog.hashed == 3 and errors == []
+
+    def test_corrupt_index_is_ignored(self, image_dir):
+        """Test that an unreadable index falls back to hashing."""
+        write(image_dir / INDEX_FILE_NAME, b"not json")
+
+        catalog = FirmwareCatalog(str(image_dir), SEC_KEY)
+        catalog.load()
+
+        assert catalog.hashed == 2
+
+    def test_missing_directory(self, tmp_path):
+        """Test that a missing directory yields an empty catalog."""
+        catalog = FirmwareCatalog(str(tmp_path / "missing"), SEC_KEY)
+        catalog.load()
+
+        assert len(catalog) == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -15,7 +15,8 @@ from unittest.mock import patch, MagicMock
 # Add scripts directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
 
-from mq_pub_15 import main, Usage, iot_enc, iot_dec
+import mq_pub_15
+from mq_pub_15 import main, Usage, iot_enc, iot_dec, iot_enc_batch
 
 
 class TestUsageException:
@@ -68,7 +69,7 @@ class TestMainErrorHandling:
         result = main(["mq_pub_15.py", "--help"])
         assert result == 2
 
-    @patch("mq_pub_15.publish.single")
+    @patch("paho.mqtt.publish.single")
     def test_valid_arguments_success(self, mock_publish):
         """Test that valid arguments allow execution to proceed."""
         # Mock MQTT publish to avoid actual network call
@@ -82,7 +83,7 @@ class TestMainErrorHandling:
         # Verify MQTT publish was called
         assert mock_publish.called
 
-    @patch("mq_pub_15.publish.single")
+    @patch("paho.mqtt.publish.single")
     def test_protocol_2_2_with_valid_args(self, mock_publish):
         """Test protocol 2.2 with valid arguments."""
         mock_publish.return_value = None
@@ -137,6 +138,37 @@ class TestIotEncFunction:
             iot_enc(message, local_key, "2.1")
 
 
+class TestIotEncBatch:
+    """Test the batch encoder against iot_enc."""
+
+    def test_matches_iot_enc_in_input_order(self):
+        """Test that mixed keys and protocols give the iot_enc frames, in order."""
+        messages = ['{"n":%d}' % i + "x" * i for i in range(20)]
+        keys = ["0000000000000000", "a1b2c3d4e5f67788", "0000000000000000"] * 7
+        keys = keys[:20]
+        protocols = ["2.1", "2.2"] * 10
+
+        with patch.object(mq_pub_15.time, "time", return_value=1700000000.42):
+            expected = [iot_enc(*item) for item in zip(messages, keys, protocols)]
+            frames = iot_enc_batch(messages, keys, protocols)
+
+        assert frames == expected
+        assert iot_dec(frames[0].decode(), keys[0]) == messages[0]
+
+    def test_does_not_print(self, capsys):
+        """Test that the batch encoder has no debug output."""
+        iot_enc_batch(["{}"], ["0000000000000000"], ["2.1"])
+        assert capsys.readouterr().out == ""
+
+    def test_invalid_input(self):
+        """Test mismatched lengths and bad keys."""
+        assert iot_enc_batch([], [], []) == []
+        with pytest.raises(ValueError):
+            iot_enc_batch(["{}"], [], ["2.1"])
+        with pytest.raises(ValueError):
+            iot_enc_batch(["{}"], ["short"], ["2.1"])
+
+
 class TestIotDecFunction:
     """Test iot_dec function error handling."""
 
@@ -192,7 +224,7 @@ class TestCommandLineInterface:
         result = main(["mq_pub_15.py"])
         assert result == 2  # Should fail due to missing required args
 
-    @patch("mq_pub_15.publish.single")
+    @patch("paho.mqtt.publish.single")
     def test_custom_broker(self, mock_publish):
         """Test specifying custom broker address."""
         mock_publish.return_value = None
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the persistent TriggerPublisher of mq_pub_15.
+
+Validates batching over one connection, PUBACK tracking, retries with
+backoff, the batch command line option and the daemon request protocol
+against a fake paho client.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import mq_pub_15
+from mq_pub_15 import (
+    EXIT_ERROR,
+    EXIT_SUCCESS,
+    Trigger,
+    TriggerPublisher,
+    TriggerServer,
+    iot_dec,
+    main,
+    parse_request,
+    read_batch,
+    serve_requests,
+)
+
+GW_IDS = ["43511212112233445566", "43511212112233445577", "43511212112233445588"]
+
+
+def message_info(published=True, rc=0):
+    """Fake paho MQTTMessageInfo."""
+    info = Mock(rc=rc)
+    info.is_published.return_value = published
+    return info
+
+
+@pytest.fixture
+def mqtt_client():
+    """Fake paho client returned by create_mqtt_client(), acknowledging every publish."""
+    client = Mock()
+
+    def publish(*args, **kwargs):
+        client.on_publish(client, None, 1)
+        return message_info()
+
+    client.publish.side_effect = publish
+    client.loop_start.side_effect = lambda: client.on_connect(client, None, {}, 0)
+    with patch.object(mq_pub_15, "create_mqtt_client", return_value=client) as create:
+        client.create = create
+        yield client
+
+
+class TestTriggerPublisher:
+    """Test publishing and acknowledgement tracking."""
+
+    def test_batch_uses_one_connection(self, mqtt_client):
+        """Test that a batch is published in order over a single client."""
+        publisher = TriggerPublisher("10.42.42.1", ack_timeout=1)
+        pending = publisher.publish_batch([Trigger(gw_id) for gw_id in GW_IDS])
+        assert publisher.wait(pending, timeout=5) is True
+        more = publisher.publish(GW_IDS[0], protocol="2.2")
+        assert publisher.wait([more], timeout=5) is True
+        publisher.close()
+
+        assert mqtt_client.create.call_count == 1
+        mqtt_client.connect_async.assert_called_once_with("10.42.42.1", 1883, 60)
+        topics = [c[0][0] for c in mqtt_client.publish.call_args_list]
+        assert topics == ["smart/device/in/%s" % gw_id for gw_id in GW_IDS + GW_IDS[:1]]
+        assert all(c[1]["qos"] == 1 for c in mqtt_client.publish.call_args_list)
+        assert publisher.acked == 4 and publisher.failed == 0
+        assert all(t.attempts == 1 and t.latency() is not None for t in pending)
+        mqtt_client.loop_stop.assert_called_once()
+
+    def test_payload_decrypts_with_device_key(self, mqtt_client):
+        """Test that each trigger is encrypted with its own key."""
+        publisher = TriggerPublisher()
+        pending = publisher.publish(GW_IDS[1], "a1b2c3d4e5f67788", "2.1")
+        publisher.wait([pending], timeout=5)
+        publisher.close()
+
+        payload = mqtt_client.publish.call_args[0][1]
+        assert GW_IDS[1] in iot_dec(payload.decode(), "a1b2c3d4e5f67788")
+
+    def test_missing_puback_is_retried_with_backoff(self, mqtt_client):
+        """Test that an unacknowledged trigger is republished after the backoff."""
+        infos = [message_info(published=False), message_info()]
+        mqtt_client.publish.side_effect = infos
+        publisher = TriggerPublisher(ack_timeout=5, retries=2, backoff=0.5)
+        publisher._client = mqtt_client
+        publisher._connected = True
+        trigger = mq_pub_15.PendingTrigger(Trigger(GW_IDS[0]), b"payload")
+        publisher._queue.append(trigger)
+
+        assert publisher._step(100.0) == 5.0
+        assert publisher._step(105.0) == 0.5
+        assert trigger.attempts == 1 and mqtt_client.publish.call_count == 1
+        assert publisher._step(105.5) == 5.0
+        assert publisher._step(106.0) is None
+
+        assert trigger.acked is True and trigger.attempts == 2
+        assert trigger.done.is_set()
+
+    def test_fails_after_retries(self, mqtt_client):
+        """Test that a trigger fails once its retries are used up."""
+        mqtt_client.publish.side_effect = lambda *args, **kwargs: message_info(published=False)
+        publisher = TriggerPublisher(ack_timeout=1, retries=1, backoff=2)
+        publisher._client = mqtt_client
+        publisher._connected = True
+        trigger = mq_pub_15.PendingTrigger(Trigger(GW_IDS[0]), b"payload")
+        publisher._queue.append(trigger)
+
+        publisher._step(0.0)
+        assert publisher._step(1.0) == 2.0
+        publisher._step(3.0)
+        assert publisher._step(4.0) is None
+
+        assert trigger.acked is False
+        assert trigger.error == "no PUBACK after 2 attempts"
+        assert publisher.failed == 1 and publisher.published == 2
+
+    def test_publish_error_counts_as_attempt(self, mqtt_client):
+        """Test that a rejected publish is retried instead of waiting for a PUBACK."""
+        mqtt_client.publish.side_effect = [message_info(rc=15), message_info()]
+        publisher = TriggerPublisher(retries=1, backoff=0.5)
+        publisher._client = mqtt_client
+        publisher._connected = True
+        trigger = mq_pub_15.PendingTrigger(Trigger(GW_IDS[0]), b"payload")
+        publisher._queue.append(trigger)
+
+        assert publisher._step(0.0) == 0.5
+        publisher._step(0.5)
+        publisher._step(0.6)
+
+        assert trigger.acked is True and trigger.attempts == 2
+
+    def test_disconnected_attempts_are_lost(self, mqtt_client):
+        """Test that triggers are held back while disconnected and fail eventually."""
+        publisher = TriggerPublisher(ack_timeout=1, retries=1, backoff=2)
+        publisher._client = mqtt_client
+        trigger = mq_pub_15.PendingTrigger(Trigger(GW_IDS[0]), b"payload")
+        publisher._queue.append(trigger)
+
+        assert publisher._step(0.0) == 1.0
+        assert publisher._step(1.0) == 2.0
+        assert publisher._step(3.0) == 1.0
+        assert publisher._step(4.0) is None
+
+        mqtt_client.publish.assert_not_called()
+        assert trigger.error == "not connected after 2 attempts"
+
+    def test_close_fails_pending_triggers(self, mqtt_client):
+        """Test that closing the publisher releases waiters."""
+        mqtt_client.publish.side_effect = lambda *args, **kwargs: message_info(published=False)
+        publisher = TriggerPublisher(ack_timeout=60)
+        pending = publisher.publish_batch([Trigger(GW_IDS[0])])
+        publisher.close()
+
+        assert publisher.wait(pending, timeout=1) is False
+        assert pending[0].error == "publisher closed"
+        with pytest.raises(ValueError):
+            publisher.publish(GW_IDS[0])
+
+
+class TestBatchOption:
+    """Test the -f/--batch command line option."""
+
+    def test_read_batch(self):
+        """Test parsing of batch lines with defaults and comments."""
+        lines = [
+            "# rack 1\n",
+            "%s\n" % GW_IDS[0],
+            "\n",
+            "%s a1b2c3d4e5f67788 2.2  # lamp\n" % GW_IDS[1],
+        ]
+
+        triggers = read_batch(lines, "0123456789abcdef", "2.1")
+
+        assert triggers == [
+            Trigger(GW_IDS[0], "0123456789abcdef", "2.1"),
+            Trigger(GW_IDS[1], "a1b2c3d4e5f67788", "2.2"),
+        ]
+        with pytest.raises(ValueError):
+            read_batch(["short"])
+
+    def test_read_batch_rejects_unknown_protocol(self):
+        """Test that only protocols 2.1 and 2.2 are accepted, as in daemon requests."""
+        with pytest.raises(ValueError, match="invalid protocol"):
+            read_batch(["%s a1b2c3d4e5f67788 3.3\n" % GW_IDS[0]])
+        with pytest.raises(ValueError, match="invalid protocol"):
+            read_batch([GW_IDS[0]], protocol="2.3")
+
+    def test_read_batch_rejects_short_key(self):
+        """Test that keys the AES encoder cannot use are rejected per line."""
+        with pytest.raises(ValueError, match="not 16 bytes"):
+            read_batch(["%s a1b2c3d4e5 2.1\n" % GW_IDS[0]])
+        with pytest.raises(ValueError, match="not 16 bytes"):
+            read_batch([GW_IDS[0]], local_key="a1b2c3d4e5")
+
+    def test_main_batch_short_key(self, mqtt_client, tmp_path, capsys):
+        """Test that a batch with an unusable key is an error, not a traceback."""
+        batch = tmp_path / "rack.txt"
+        batch.write_text("%s\n%s a1b2c3d4e5\n" % (GW_IDS[0], GW_IDS[1]))
+
+        assert main(["mq_pub_15.py", "-f", str(batch)]) == EXIT_ERROR
+
+        assert "not 16 bytes" in capsys.readouterr().err
+        mqtt_client.publish.assert_not_called()
+
+    def test_main_batch(self, mqtt_client, tmp_path, capsys):
+        """Test that main publishes a batch file and reports each device."""
+        batch = tmp_path / "rack.txt"
+        batch.write_text("\n".join(GW_IDS) + "\n")
+
+        assert main(["mq_pub_15.py", "-f", str(batch)]) == EXIT_SUCCESS
+
+        assert mqtt_client.publish.call_count == 3
+        out = capsys.readouterr().out
+        assert all("%s: acknowledged" % gw_id in out for gw_id in GW_IDS)
+
+    def test_main_batch_missing_file(self, mqtt_client, tmp_path):
+        """Test that an unreadable batch file is an error."""
+        assert main(["mq_pub_15.py", "-f", str(tmp_path / "missing")]) == EXIT_ERROR
+        mqtt_client.create.assert_not_called()
+
+
+class TestDaemon:
+    """Test the JSON line request protocol of daemon mode."""
+
+    def test_parse_request(self):
+        """Test request defaults and validation."""
+        request_id, trigger = parse_request(
+            '{"gwId": "%s", "protocol": "2.2", "id": 7}' % GW_IDS[0], "0123456789abcdef"
+        )
+
+        assert request_id == 7
+        assert trigger == Trigger(GW_IDS[0], "0123456789abcdef", "2.2")
+        for line in [
+            "[]",
+            '{"gwId": "short"}',
+            '{"gwId": "%s", "protocol": "3.3"}' % GW_IDS[0],
+            '{"gwId": "%s", "localKey": "a1b2c3d4e5"}' % GW_IDS[0],
+        ]:
+            with pytest.raises(ValueError):
+                parse_request(line)
+
+    def test_serve_requests_answers_in_order(self, mqtt_client):
+        """Test that every request line gets one result line, in request order."""
+        publisher = TriggerPublisher()
+        lines = ['{"gwId": "%s", "id": %d}\n' % (gw_id, i) for i, gw_id in enumerate(GW_IDS)]
+        lines.insert(1, "not json\n")
+        output = []
+
+        assert serve_requests(publisher, lines, output.append) == 4
+        publisher.close()
+
+        results = [json.loads(line) for line in output]
+        assert [r["id"] for r in results] == [0, None, 1, 2]
+        assert results[1]["ok"] is False and results[1]["error"].startswith("invalid request")
+        for result in results[:1] + results[2:]:
+            assert result["ok"] is True and result["attempts"] == 1
+            assert result["dispatch_ms"] >= 0 and result["ack_ms"] >= 0
+        assert mqtt_client.create.call_count == 1
+
+    def test_socket_server(self, mqtt_client, tmp_path):
+        """Test a request over the Unix socket and removal of the socket file."""
+        path = str(tmp_path / "mq_pub.sock")
+        publisher = TriggerPublisher()
+        server = TriggerServer(path, publisher)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(path)
+                client.sendall(b'{"gwId": "%s", "id": "a"}\n' % GW_IDS[0].encode())
+                client.shutdown(socket.SHUT_WR)
+                result = json.loads(client.makefile().readline())
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            publisher.close()
+
+        assert result["id"] == "a" and result["gwId"] == GW_IDS[0] and result["ok"] is True
+        assert not os.path.exists(path)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the psk_batch module.
+
+Validates identity parsing, key derivation against the device-side
+algorithm, the process pool path and the index file.
+"""
+
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import psk_batch
+from device_simulator import device_psk
+from psk_batch import (
+    DEFAULT_HINT,
+    PskIndex,
+    derive_all,
+    format_hint,
+    parse_hint,
+    parse_identities,
+    write_index,
+)
+
+# Identity 02 and PSK from the smarthack-psk.log sample in the PSK identity 02 docs
+IDENTITY_02 = bytes.fromhex(
+    "0242416f68626d6436614739314946523126e9b5b5bd"
+    "abbb170482e008c373d879b5d1540ec094d09bb7d53fa3fc9645df"
+)
+PSK_02 = bytes.fromhex("2a9cf84b7a1b6bf1ede712edb7ee53c04b065f673e600f43627a67fea9a9d05d")
+
+
+def make_identity(number):
+    """Return an identity 01 in the IDENTITY_PREFIX format."""
+    return b"\x01BAohbmd6aG91IFR1" + b"%016d" % number
+
+
+class TestParsing:
+    """Test reading identities and hints."""
+
+    def test_parse_identities(self):
+        """Test that repeated identities are counted and short ones skipped."""
+        lines = [
+            "new client on port 443 from 10.42.42.25:3694\n",
+            "ID: %s\n" % IDENTITY_02.hex(),
+            "PSK: %s\n" % PSK_02.hex(),
+            "2024-01-01 12:00:00 ID: %s\n" % IDENTITY_02.hex(),
+            "ID: 0011\n",
+            "ID: 0\n",
+        ]
+
+        assert parse_identities(lines) == {IDENTITY_02: 2}
+
+    def test_hints(self):
+        """Test text and hex hints and their round trip."""
+        assert parse_hint("abc") == b"abc"
+        assert parse_hint("hex:00ff") == b"\x00\xff"
+        assert format_hint(b"\x00\xff") == "hex:00ff"
+        assert format_hint(DEFAULT_HINT) == DEFAULT_HINT.decode()
+
+
+class TestDerivation:
+    """Test bulk key derivation."""
+
+    def test_matches_device_algorithm(self):
+        """Test the tuya variant against the device-side derivation and the logged PSK."""
+        identities = [IDENTITY_02] + [make_identity(n) for n in range(5)]
+        hints = [DEFAULT_HINT, b"1dHRsc2NjbHltbGx3eWh5" + b"1" * 16]
+
+        keys = derive_all(identities, hints, ["tuya"], jobs=1)
+
+        assert keys[:32] == PSK_02
+        expected = b"".join(device_psk(i, h) for i in identities for h in hints)
+        assert keys == expected
+
+    def test_process_pool_keeps_order(self, monkeypatch):
+        """Test that chunks derived in worker processes are joined in order."""
+        identities = [make_identity(n) for n in range(10)]
+        variants = list(psk_batch.VARIANTS)
+        inline = derive_all(identities, [DEFAULT_HINT], variants, jobs=1)
+        monkeypatch.setattr(psk_batch, "CHUNK_SIZE", 3)
+
+        assert derive_all(identities, [DEFAULT_HINT], variants, jobs=2) == inline
+
+
+class TestIndex:
+    """Test the indexed output file."""
+
+    def test_write_and_lookup(self, tmp_path):
+        """Test lookups, counts and missing entries."""
+        path = str(tmp_path / "psk.idx")
+        identities = {make_identity(n): n + 1 for n in range(20)}
+        identities[IDENTITY_02] = 3
+        write_index(path, identities, [DEFAULT_HINT, b"other"], ["tuya", "with-type"])
+
+        index = PskIndex(path)
+        try:
+            assert len(index) == 21
+            assert list(index.identities()) == sorted(identities)
+            assert index.lookup(IDENTITY_02, DEFAULT_HINT) == PSK_02
+            assert index.lookup(make_identity(7), b"other", "tuya") == device_psk(
+                make_identity(7), b"other"
+            )
+            assert index.seen(make_identity(7)) == 8
+            assert index.lookup(make_identity(99), DEFAULT_HINT) is None
+            assert index.lookup(IDENTITY_02, b"missing") is None
+            assert index.lookup(IDENTITY_02, DEFAULT_HINT, "full-hint") is None
+            assert len(list(index.keys(IDENTITY_02))) == 4
+        finally:
+            index.close()
+
+    def test_empty_identity_set(self, tmp_path, capsys):
+        """Test that an empty index can be read and the command line refuses to write one."""
+        path = str(tmp_path / "psk.idx")
+        write_index(path, Counter(), [DEFAULT_HINT], ["tuya"])
+
+        index = PskIndex(path)
+        try:
+            assert len(index) == 0 and list(index.identities()) == []
+            assert index.lookup(IDENTITY_02, DEFAULT_HINT) is None
+        finally:
+            index.close()
+
+        log = tmp_path / "smarthack-psk.log"
+        log.write_text("listening on 10.42.42.1:443\n")
+        assert psk_batch.main(["derive", str(log), "-o", str(tmp_path / "new.idx")]) == 1
+        assert "no identities (ID: lines) found in" in capsys.readouterr().err
+        assert not (tmp_path / "new.idx").exists()
+
+    def test_not_an_index(self, tmp_path):
+        """Test that other files are rejected."""
+        path = tmp_path / "psk.idx"
+        path.write_bytes(b"\x00" * 64)
+
+        with pytest.raises(ValueError):
+            PskIndex(str(path))
+
+    def test_command_line(self, tmp_path, capsys):
+        """Test derive and lookup from the command line."""
+        log = tmp_path / "smarthack-psk.log"
+        log.write_text("ID: %s\nID: %s\n" % (IDENTITY_02.hex(), make_identity(1).hex()))
+        path = str(tmp_path / "psk.idx")
+
+        assert psk_batch.main(["derive", str(log), "-o", path, "--variant", "all"]) == 0
+        assert psk_batch.main(["lookup", path, IDENTITY_02.hex()]) == 0
+        assert psk_batch.main(["lookup", path, "00"]) == 1
+
+        out = capsys.readouterr().out
+        assert "2 identities (2 log lines) x 1 hints x 3 variants" in out
+        assert "%s\ttuya\t%s" % (DEFAULT_HINT.decode(), PSK_02.hex()) in out
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -10,9 +10,16 @@ proxy that intercepts and decrypts Tuya device communications.
 import sys
 import os
 import pytest
-from unittest.mock import Mock, MagicMock, patch
+from unittest.mock import Mock, patch
+import selectors
 import socket
 import ssl
+import json
+import errno
+import signal
+import threading
+import time
+from collections import deque
 
 # Add scripts directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
@@ -31,8 +38,42 @@ listener = psk_frontend.listener
 client = psk_frontend.client
 gen_psk = psk_frontend.gen_psk
 PskFrontend = psk_frontend.PskFrontend
+Reactor = psk_frontend.Reactor
+Pipe = psk_frontend.Pipe
+BackendPool = psk_frontend.BackendPool
+Supervisor = psk_frontend.Supervisor
+IdleReaper = psk_frontend.IdleReaper
+Session = psk_frontend.Session
+Mapping = psk_frontend.Mapping
+ProxyTable = psk_frontend.ProxyTable
+parse_mapping = psk_frontend.parse_mapping
+load_mappings = psk_frontend.load_mappings
+stats_summary = psk_frontend.stats_summary
+PskCache = psk_frontend.PskCache
+handshake_results = psk_frontend.handshake_results
+handshake_durations = psk_frontend.handshake_durations
 IDENTITY_PREFIX = psk_frontend.IDENTITY_PREFIX
 
+from server_metrics import MetricsRegistry
+
+
+def watchable_mock(pairs):
+    """Return a Mock socket backed by a real file descriptor the reactor can watch."""
+    pair = socket.socketpair()
+    pairs.extend(pair)
+    sock = Mock()
+    sock.fileno.return_value = pair[0].fileno()
+    return sock
+
+
+@pytest.fixture
+def pairs():
+    """Real sockets behind mock sockets, closed after the test."""
+    created = []
+    yield created
+    for sock in created:
+        sock.close()
+
 
 class TestListenerFunction:
     """Test listener socket creation."""
@@ -63,6 +104,16 @@ class TestListenerFunction:
 
         sock.close()
 
+    def test_listener_reuse_port(self):
+        """Test that worker processes can bind the same port with SO_REUSEPORT."""
+        first = listener("127.0.0.1", 9979, reuse_port=True)
+        second = listener("127.0.0.1", 9979, reuse_port=True)
+
+        assert second.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT) == 1
+
+        first.close()
+        second.close()
+
 
 class TestClientFunction:
     """Test client socket creation."""
@@ -108,6 +159,34 @@ class TestGenPskFunction:
         assert psk1 == psk2
 
 
+class TestPskCache:
+    """Test the LRU cache of derived PSKs."""
+
+    IDENTITY = b"\x01" + IDENTITY_PREFIX + b"test1234567890123456"
+    HINT = b"hint" + b"0" * 12
+
+    def test_hits_and_misses(self, capsys):
+        """Test that a key is derived, and logged, only on the first lookup."""
+        cache = PskCache()
+
+        psk1 = cache.get(self.IDENTITY, self.HINT)
+        psk2 = cache.get(self.IDENTITY, self.HINT)
+
+        assert psk1 == psk2 == gen_psk(self.IDENTITY, self.HINT)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert capsys.readouterr().out.count("PSK:") == 2  # cache miss + direct call
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the cache stays bounded and keeps recently used keys."""
+        cache = PskCache(maxsize=2)
+        with patch("builtins.print"):
+            for device in b"abacab":
+                cache.get(self.IDENTITY[:-1] + bytes([device]), self.HINT)
+
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (2, 4)
+
+
 class TestPskFrontendInit:
     """Test PskFrontend initialization."""
 
@@ -120,45 +199,629 @@ class TestPskFrontendInit:
         assert frontend.host == "10.42.42.1"
         assert frontend.port == 80
         assert frontend.server_sock is not None
-        assert frontend.sessions == []
+        assert frontend.sessions == set()
+        assert frontend.peers == {}
 
         # Clean up
         frontend.server_sock.close()
 
 
-class TestPskFrontendReadables:
-    """Test readables method."""
+class TestPskFrontendReactor:
+    """Test registration with the reactor and the socket-to-session map."""
 
-    def test_readables_returns_server_socket(self):
-        """Test that readables includes server socket."""
+    def test_server_socket_is_registered(self):
+        """Test that the listening socket is watched by the reactor."""
         frontend = PskFrontend("127.0.0.1", 9996, "10.42.42.1", 80)
 
-        readables = frontend.readables()
+        key = frontend.reactor.selector.get_key(frontend.server_sock)
 
-        assert frontend.server_sock in readables
-        assert len(readables) == 1
+        assert key.data == frontend.data_ready_cb
 
         frontend.server_sock.close()
 
-    def test_readables_includes_session_sockets(self):
-        """Test that readables includes all session sockets."""
+    def test_session_sockets_map_to_their_peer(self, pairs):
+        """Test that each session socket maps to its session and the other socket."""
         frontend = PskFrontend("127.0.0.1", 9995, "10.42.42.1", 80)
+        mock_s1 = watchable_mock(pairs)
+        mock_s2 = watchable_mock(pairs)
+
+        session = frontend.add_session(mock_s1, mock_s2)
+
+        assert frontend.sessions == {session}
+        assert frontend.peers[mock_s1.fileno()] == (session, mock_s2)
+        assert frontend.peers[mock_s2.fileno()] == (session, mock_s1)
+        assert len(frontend.reactor.selector.get_map()) == 3
+
+        frontend.server_sock.close()
+
+    def test_listeners_share_a_reactor(self):
+        """Test that several listeners can run on one reactor."""
+        reactor = Reactor()
+        https = PskFrontend("127.0.0.1", 9988, "10.42.42.1", 80, reactor)
+        mqtt = PskFrontend("127.0.0.1", 9987, "10.42.42.1", 1883, reactor)
+
+        assert len(reactor.selector.get_map()) == 2
+
+        https.server_sock.close()
+        mqtt.server_sock.close()
+        reactor.close()
+
+    def test_forwarding_through_reactor(self):
+        """Test that readable data is forwarded to the peer of the socket."""
+        frontend = PskFrontend("127.0.0.1", 9986, "10.42.42.1", 80)
+        device, client_end = socket.socketpair()
+        backend_end, server = socket.socketpair()
+        frontend.add_session(client_end, backend_end)
+
+        device.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        frontend.reactor.poll(1)
+        assert server.recv(100) == b"GET / HTTP/1.1\r\n\r\n"
+
+        device.close()
+        frontend.reactor.poll(1)
+        assert frontend.sessions == set()
+        assert frontend.peers == {}
+        assert server.recv(100) == b""
+
+        server.close()
+        frontend.server_sock.close()
+
+
+class TestReactorTimers:
+    """Test timers of the reactor."""
+
+    def test_call_later_runs_due_timers(self):
+        """Test that due timers run in deadline order and cancelled ones are skipped."""
+        reactor = Reactor()
+        calls = []
+        reactor.call_later(0.02, calls.append, "late")
+        reactor.call_later(0, calls.append, "early")
+        reactor.call_later(0, calls.append, "cancelled").cancel()
+
+        reactor.poll(0)
+        assert calls == ["early"]
+
+        # The poll timeout is clamped to the next timer
+        reactor.poll(5)
+        assert calls == ["early", "late"]
+
+        reactor.close()
+
+    def test_signal_handler_runs_in_the_loop(self):
+        """Test that a signal callback runs from poll() and the handler is reset on close."""
+        reactor = Reactor()
+        calls = []
+        reactor.add_signal_handler(signal.SIGUSR1, lambda: calls.append("usr1"))
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert calls == []
+        reactor.poll(1)
+        assert calls == ["usr1"]
+
+        reactor.close()
+        assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+
 
-        # Add mock sessions
-        mock_s1 = Mock()
-        mock_s2 = Mock()
-        frontend.sessions.append((mock_s1, mock_s2))
+class TestPskFrontendHandshake:
+    """Test non-blocking TLS-PSK handshakes."""
 
-        readables = frontend.readables()
+    def test_handshake_timeout_closes_socket(self):
+        """Test that a device that never sends a ClientHello is dropped."""
+        handshake_results.clear()
+        frontend = PskFrontend("127.0.0.1", 9985, "127.0.0.1", 80)
+        frontend.handshake_timeout = 0.01
+        device = socket.create_connection(("127.0.0.1", 9985))
 
-        assert frontend.server_sock in readables
-        assert mock_s1 in readables
-        assert mock_s2 in readables
-        assert len(readables) == 3
+        frontend.reactor.poll(1)
+        assert len(frontend.handshakes) == 1
+        frontend.reactor.poll(1)
 
+        assert frontend.handshakes == {}
+        assert handshake_results.values() == {("9985", "timeout"): 1}
+        assert device.recv(100) == b""
+
+        device.close()
+        frontend.server_sock.close()
+
+    def test_handshake_does_not_block_other_clients(self):
+        """Test a full TLS-PSK handshake while a silent client is connected."""
+        from device_simulator import psk_client_context
+
+        handshake_results.clear()
+        handshake_durations.clear()
+        backend = socket.socket()
+        backend.bind(("127.0.0.1", 0))
+        backend.listen(1)
+        frontend = PskFrontend("127.0.0.1", 9984, "127.0.0.1", backend.getsockname()[1])
+        silent = socket.create_connection(("127.0.0.1", 9984))
+
+        def device():
+            with socket.create_connection(("127.0.0.1", 9984)) as sock:
+                with psk_client_context("sim00001").wrap_socket(sock) as tls:
+                    tls.sendall(b"ping")
+
+        thread = threading.Thread(target=device)
+        thread.start()
+        backend.setblocking(False)
+        conn = None
+        received = b""
+        for _ in range(500):
+            frontend.reactor.poll(0.01)
+            if conn is None:
+                try:
+                    conn, _addr = backend.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+            try:
+                received += conn.recv(100)
+            except BlockingIOError:
+                continue
+            break
+        thread.join(5)
+
+        assert received == b"ping"
+        assert handshake_results.values() == {("9984", "ok"): 1}
+        assert handshake_durations.values()[("9984",)].count == 1
+        assert len(frontend.handshakes) == 1  # the silent client is still waiting
+
+        conn.close()
+        silent.close()
+        backend.close()
+        frontend.server_sock.close()
+
+
+class TestPipe:
+    """Test buffered forwarding with watermarks."""
+
+    def test_partial_sends_wrap_around(self):
+        """Test that bytes stay in order when sends are partial and the buffer wraps."""
+        data = bytes(range(20))
+        received = bytearray()
+        state = {"offset": 0, "accept": 4}
+
+        def recv_into(view):
+            chunk = data[state["offset"] : state["offset"] + len(view)]
+            if not chunk:
+                raise BlockingIOError()
+            view[: len(chunk)] = chunk
+            state["offset"] += len(chunk)
+            return len(chunk)
+
+        def send(view):
+            count = min(len(view), state["accept"])
+            if not count:
+                raise BlockingIOError()
+            state["accept"] -= count
+            received.extend(view[:count])
+            return count
+
+        src = Mock()
+        src.recv_into.side_effect = recv_into
+        dst = Mock()
+        dst.send.side_effect = send
+        pipe = Pipe(src, dst, buffer_size=8)
+
+        # Buffer full after 8 bytes, receiver takes 4: reading is paused
+        pipe.forward(readable=True)
+        assert (pipe.head, pipe.size, pipe.paused) == (4, 4, True)
+
+        # Drained to the low watermark (2): reading resumes
+        state["accept"] = 3
+        pipe.forward(readable=False)
+        assert (pipe.head, pipe.size, pipe.paused) == (7, 1, False)
+
+        # The next read wraps around to the front of the buffer
+        state["accept"] = 100
+        pipe.forward(readable=True)
+        pipe.forward(readable=True)
+
+        assert bytes(received) == data
+        assert pipe.size == 0
+
+    def test_slow_receiver_pauses_reading(self):
+        """Test that a full buffer stops reading from the sender until it drains."""
+        frontend = PskFrontend("127.0.0.1", 9982, "10.42.42.1", 80, buffer_size=4096)
+        device, client_end = socket.socketpair()
+        backend_end, server = socket.socketpair()
+        for sock in (backend_end, server):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        session = frontend.add_session(client_end, backend_end)
+        payload = bytes(range(256)) * 4096
+        device.setblocking(False)
+        server.setblocking(False)
+
+        sent = 0
+        for _ in range(50):
+            try:
+                sent += device.send(payload[sent:])
+            except BlockingIOError:
+                pass
+            frontend.reactor.poll(0.01)
+        assert session.upstream.paused
+        assert session.events[client_end] == 0
+        assert session.events[backend_end] == selectors.EVENT_READ | selectors.EVENT_WRITE
+        assert session.upstream.size <= 4096
+
+        received = bytearray()
+        for _ in range(10000):
+            if len(received) == len(payload):
+                break
+            try:
+                sent += device.send(payload[sent:])
+            except BlockingIOError:
+                pass
+            frontend.reactor.poll(0)
+            try:
+                received += server.recv(65536)
+            except BlockingIOError:
+                pass
+
+        assert received == payload
+
+        device.close()
+        server.close()
+        frontend.close_session(session)
         frontend.server_sock.close()
 
 
+@pytest.fixture
+def backend():
+    """A listening backend socket on a free port."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    yield sock
+    sock.close()
+
+
+class TestBackendPool:
+    """Test warm backend connections."""
+
+    def poll_until(self, reactor, condition):
+        """Run the reactor until condition() holds (at most about a second)."""
+        for _ in range(100):
+            if condition():
+                return
+            reactor.poll(0.01)
+
+    def test_warm_connections(self, backend):
+        """Test that the pool connects ahead and replaces connections handed out."""
+        reactor = Reactor()
+        pool = BackendPool("127.0.0.1", backend.getsockname()[1], reactor, size=2)
+
+        pool.fill()
+        self.poll_until(reactor, lambda: len(pool.idle) == 2)
+        assert len(pool.idle) == 2
+
+        sock = pool.get()
+        assert sock.getpeername() == backend.getsockname()
+        assert (pool.hits, pool.misses) == (1, 0)
+        self.poll_until(reactor, lambda: len(pool.idle) == 2)
+        assert len(pool.idle) == 2
+        assert "1 hits, 0 misses" in pool.summary()
+
+        sock.close()
+        pool.close()
+        reactor.close()
+
+    def test_stale_connections_are_dropped(self, backend):
+        """Test that idle connections closed by the backend are not handed out."""
+        reactor = Reactor()
+        pool = BackendPool("127.0.0.1", backend.getsockname()[1], reactor, size=1)
+        pool.fill()
+        self.poll_until(reactor, lambda: pool.idle)
+        conn, _addr = backend.accept()
+        conn.close()
+        pool.size = 0
+
+        sock = pool.get()
+
+        assert (pool.hits, pool.misses, pool.stale) == (0, 1, 1)
+        assert sock.getpeername() == backend.getsockname()
+
+        sock.close()
+        pool.close()
+        reactor.close()
+
+    def test_unreachable_backend_is_retried(self, backend):
+        """Test that a refused connect schedules a retry instead of spinning."""
+        port = backend.getsockname()[1]
+        backend.close()
+        reactor = Reactor()
+        pool = BackendPool("127.0.0.1", port, reactor, size=2)
+
+        pool.fill()
+        self.poll_until(reactor, lambda: pool.retry is not None)
+
+        assert pool.retry is not None
+        assert pool.idle == deque()
+        with pytest.raises(OSError):
+            pool.get()
+
+        pool.close()
+        reactor.close()
+
+    @patch.object(psk_frontend, "client")
+    def test_frontend_uses_pool(self, mock_client, backend):
+        """Test that only frontends with a pool take backend connections from it."""
+        http = PskFrontend("127.0.0.1", 9981, "127.0.0.1", backend.getsockname()[1], pool_size=1)
+        mqtt = PskFrontend("127.0.0.1", 9980, "127.0.0.1", 1883)
+        self.poll_until(http.reactor, lambda: http.pool.idle)
+
+        sock = http.connect_backend()
+
+        assert http.pool.hits == 1
+        assert mqtt.pool is None
+        assert mqtt.connect_backend() is mock_client.return_value
+        mock_client.assert_called_once_with("127.0.0.1", 1883)
+
+        sock.close()
+        http.pool.close()
+        http.server_sock.close()
+        mqtt.server_sock.close()
+
+
+def report_and_exit(report_fd):
+    """Worker target: report one successful handshake, then crash."""
+    registry = MetricsRegistry()
+    registry.counter("psk_handshakes_total", "Handshakes", ("port", "result")).inc(("443", "ok"))
+    os.write(report_fd, json.dumps(registry.snapshot()).encode() + b"\n")
+    raise SystemExit(3)
+
+
+def report_sessions_and_exit(report_fd):
+    """Worker target: report a handshake and five live sessions, then crash."""
+    registry = MetricsRegistry()
+    registry.counter("psk_handshakes_total", "Handshakes", ("port", "result")).inc(("443", "ok"))
+    registry.gauge("psk_sessions", "Sessions", ("port",)).inc(("443",), 5)
+    os.write(report_fd, json.dumps(registry.snapshot()).encode() + b"\n")
+    raise SystemExit(3)
+
+
+def fail_to_start(report_fd):
+    """Worker target: exit like serve() when no listener can be bound."""
+    raise SystemExit(1)
+
+
+class TestSupervisor:
+    """Test the worker supervisor."""
+
+    def test_crashed_workers_are_restarted(self, capsys):
+        """Test that exited workers are restarted and their metrics kept."""
+        supervisor = Supervisor(2, report_and_exit)
+        supervisor.restart_delay = 0
+        supervisor.start()
+        for _ in range(500):
+            if supervisor.restarts >= 4:
+                break
+            supervisor.poll(0.01)
+
+        totals = supervisor.totals()
+        supervisor.stop()
+
+        assert supervisor.restarts >= 4
+        assert totals.families["psk_handshakes_total"].values()[("443", "ok")] >= 4
+        assert "exited with status 3, restarting" in capsys.readouterr().out
+
+    def test_restart_drops_gauges_of_exited_workers(self, capsys):
+        """Test that sessions of an exited worker do not stay in the totals."""
+        supervisor = Supervisor(1, report_sessions_and_exit)
+        supervisor.restart_delay = 60
+        supervisor.start()
+        for _ in range(500):
+            if supervisor._pending:
+                break
+            supervisor.poll(0.01)
+
+        totals = supervisor.totals()
+        supervisor.stop()
+
+        assert totals.families["psk_handshakes_total"].values() == {("443", "ok"): 1}
+        assert "psk_sessions" not in totals.families or not totals.families["psk_sessions"].values()
+
+    def test_startup_failure_is_not_restarted(self, capsys):
+        """Test that a worker failing before it served stops the supervisor."""
+        supervisor = Supervisor(2, fail_to_start)
+        supervisor.restart_delay = 0
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGHUP)}
+        try:
+            with pytest.raises(SystemExit) as exit_info:
+                supervisor.run()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        assert exit_info.value.code == 1
+        assert supervisor.restarts == 0 and supervisor.workers == {}
+        out = capsys.readouterr().out
+        assert "exited with status 1 before serving, not restarting" in out
+        assert "stopping the workers: worker" in out
+
+    def test_stats_summary_of_merged_metrics(self):
+        """Test the summary lines of metrics summed from workers."""
+        total = MetricsRegistry()
+        for result in ("ok", "timeout"):
+            worker = MetricsRegistry()
+            worker.counter("psk_handshakes_total", "Handshakes", ("port", "result")).inc(
+                ("8886", result)
+            )
+            worker.counter("psk_cache_lookups_total", "Lookups", ("result",)).inc(("miss",))
+            total.merge(worker.snapshot())
+
+        assert stats_summary(total) == [
+            "handshakes on port 8886: 1 ok, 0 failed, 1 timed out, p50 0.0 ms, p99 0.0 ms, "
+            "0 sessions",
+            "psk cache: 0 hits, 2 misses",
+        ]
+
+
+class TestIdleReaper:
+    """Test closing idle sessions."""
+
+    def test_only_idle_sessions_expire(self):
+        """Test that active sessions move on in the wheel and idle ones expire."""
+        reactor = Reactor()
+        expired = []
+        reaper = IdleReaper(reactor, 0.05, expired.append, interval=0.01)
+        active = Session(Mock(), Mock())
+        idle = Session(Mock(), Mock())
+        gone = Session(Mock(), Mock())
+        for session in (active, idle, gone):
+            reaper.add(session)
+        reaper.discard(gone)
+
+        deadline = time.monotonic() + 1
+        while not expired and time.monotonic() < deadline:
+            active.last_activity = time.monotonic()
+            reactor.poll(0.01)
+
+        assert expired == [idle]
+        assert list(reaper.slot_of) == [active]
+        assert reaper.timer is not None
+
+        reaper.discard(active)
+        reactor.poll(0.05)
+        assert reaper.timer is None
+        reactor.close()
+
+    def test_idle_session_is_closed_and_logged(self, capsys):
+        """Test that the frontend closes an idle session and logs its counters."""
+        frontend = PskFrontend("127.0.0.1", 9974, "10.42.42.1", 80, idle_timeout=0.05)
+        frontend.reaper.interval = 0.01
+        device, client_end = socket.socketpair()
+        backend_end, server = socket.socketpair()
+        frontend.add_session(client_end, backend_end)
+
+        device.sendall(b"ping")
+        frontend.reactor.poll(1)
+        assert server.recv(100) == b"ping"
+        deadline = time.monotonic() + 1
+        while frontend.sessions and time.monotonic() < deadline:
+            frontend.reactor.poll(0.05)
+
+        assert frontend.sessions == set()
+        assert device.recv(100) == b""
+        out = capsys.readouterr().out
+        assert "session on port 9974 idle: 4 bytes up, 0 bytes down" in out
+
+        for sock in (device, server):
+            sock.close()
+        frontend.close()
+
+    def test_default_timeout_by_port(self):
+        """Test the per-port default and that 0 disables the reaper."""
+        https = PskFrontend("127.0.0.1", 9973, "10.42.42.1", 80)
+        never = PskFrontend("127.0.0.1", 9972, "10.42.42.1", 80, idle_timeout=0)
+
+        assert https.reaper.timeout == psk_frontend.DEFAULT_IDLE_TIMEOUT
+        assert never.reaper is None
+
+        https.close()
+        never.close()
+
+
+class TestMappings:
+    """Test the port-mapping table."""
+
+    def test_parse_mapping(self):
+        """Test mappings with and without a backend pool."""
+        assert parse_mapping("10.42.43.1:443=10.42.43.1:80,pool=8") == Mapping(
+            "10.42.43.1", 443, "10.42.43.1", 80, 8
+        )
+        assert parse_mapping(" 10.42.42.1:8883 = 127.0.0.1:1883 ") == Mapping(
+            "10.42.42.1", 8883, "127.0.0.1", 1883, 0
+        )
+        assert parse_mapping("10.42.42.1:8883=127.0.0.1:1883,idle=0").idle_timeout == 0
+
+    @pytest.mark.parametrize(
+        "text", ["10.42.42.1:443", "10.42.42.1=10.42.42.1:80", "a:1=b:2,size=3", "a:x=b:2"]
+    )
+    def test_invalid_mapping(self, text):
+        """Test that malformed mappings are rejected with ValueError."""
+        with pytest.raises(ValueError, match="invalid mapping"):
+            parse_mapping(text)
+
+    def test_load_mappings(self, tmp_path):
+        """Test that comments and blank lines are skipped."""
+        path = tmp_path / "psk-mappings"
+        path.write_text(
+            "# second access point\n"
+            "10.42.43.1:443=10.42.43.1:80,pool=4\n"
+            "\n"
+            "10.42.43.1:8886=10.42.43.1:1883  # MQTT\n"
+        )
+
+        assert load_mappings(str(path)) == [
+            Mapping("10.42.43.1", 443, "10.42.43.1", 80, 4),
+            Mapping("10.42.43.1", 8886, "10.42.43.1", 1883),
+        ]
+
+
+class TestProxyTable:
+    """Test adding and removing listeners at runtime."""
+
+    def test_removed_listener_keeps_sessions(self, capsys):
+        """Test that closing a listener stops accepting but keeps forwarding."""
+        reactor = Reactor()
+        table = ProxyTable(reactor)
+        table.apply([Mapping("127.0.0.1", 9978, "127.0.0.1", 80)])
+        frontend = table.proxies[("127.0.0.1", 9978)]
+        device, client_end = socket.socketpair()
+        backend_end, server = socket.socketpair()
+        frontend.add_session(client_end, backend_end)
+
+        table.apply([Mapping("127.0.0.1", 9977, "127.0.0.1", 80)])
+
+        assert list(table.proxies) == [("127.0.0.1", 9977)]
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection(("127.0.0.1", 9978))
+        device.sendall(b"ping")
+        reactor.poll(1)
+        assert server.recv(100) == b"ping"
+        assert "closing listener 127.0.0.1:9978" in capsys.readouterr().out
+
+        for sock in (device, client_end, backend_end, server):
+            sock.close()
+        table.apply([])
+        reactor.close()
+
+    def test_changed_mapping_is_restarted(self):
+        """Test that a listener whose backend changed is replaced, others are kept."""
+        reactor = Reactor()
+        table = ProxyTable(reactor)
+        table.apply([Mapping("127.0.0.1", 9976, "127.0.0.1", 80)])
+        first = table.proxies[("127.0.0.1", 9976)]
+
+        table.apply([Mapping("127.0.0.1", 9976, "127.0.0.1", 80)])
+        assert table.proxies[("127.0.0.1", 9976)] is first
+
+        table.apply([Mapping("127.0.0.1", 9976, "127.0.0.1", 8080)])
+        assert table.proxies[("127.0.0.1", 9976)] is not first
+        assert table.proxies[("127.0.0.1", 9976)].port == 8080
+
+        table.apply([])
+        reactor.close()
+
+    def test_unavailable_address_is_skipped(self, capsys):
+        """Test that a listener that cannot bind does not stop the others."""
+        reactor = Reactor()
+        table = ProxyTable(reactor)
+        table.apply(
+            [
+                Mapping("192.0.2.1", 443, "192.0.2.1", 80),
+                Mapping("127.0.0.1", 9975, "127.0.0.1", 80),
+            ]
+        )
+
+        assert list(table.proxies) == [("127.0.0.1", 9975)]
+        assert "cannot listen on 192.0.2.1:443" in capsys.readouterr().out
+
+        table.apply([])
+        reactor.close()
+
+
 class TestPskFrontendNewClient:
     """Test new_client method error handling."""
 
@@ -169,8 +832,7 @@ class TestPskFrontendNewClient:
         frontend = PskFrontend("127.0.0.1", 9994, "10.42.42.1", 80)
 
         # Mock SSLContext to raise SSLError
-        mock_context = Mock()
-        mock_ssl_context_class.return_value = mock_context
+        mock_context = mock_ssl_context_class.return_value
         # Create SSLError with reason attribute
         error = ssl.SSLError("NO_SHARED_CIPHER")
         error.reason = "NO_SHARED_CIPHER"
@@ -194,8 +856,7 @@ class TestPskFrontendNewClient:
         frontend = PskFrontend("127.0.0.1", 9993, "10.42.42.1", 80)
 
         # Mock to raise general exception
-        mock_context = Mock()
-        mock_ssl_context_class.return_value = mock_context
+        mock_context = mock_ssl_context_class.return_value
         mock_context.wrap_socket.side_effect = Exception("Test error")
 
         mock_socket = Mock()
@@ -210,18 +871,17 @@ class TestPskFrontendNewClient:
 
     @patch.object(psk_frontend, "client")
     @patch.object(psk_frontend, "SSLPSKContext")
-    def test_new_client_successful_connection(self, mock_ssl_context_class, mock_client):
+    def test_new_client_successful_connection(self, mock_ssl_context_class, mock_client, pairs):
         """Test successful client connection."""
         frontend = PskFrontend("127.0.0.1", 9992, "10.42.42.1", 80)
 
         # Mock successful SSL context
-        mock_context = Mock()
-        mock_ssl_context_class.return_value = mock_context
-        mock_ssl_sock = Mock()
+        mock_context = mock_ssl_context_class.return_value
+        mock_ssl_sock = watchable_mock(pairs)
         mock_context.wrap_socket.return_value = mock_ssl_sock
 
         # Mock client socket
-        mock_client_sock = Mock()
+        mock_client_sock = watchable_mock(pairs)
         mock_client.return_value = mock_client_sock
 
         mock_socket = Mock()
@@ -231,7 +891,26 @@ class TestPskFrontendNewClient:
 
         # Session should be added
         assert len(frontend.sessions) == 1
-        assert frontend.sessions[0] == (mock_ssl_sock, mock_client_sock)
+        (session,) = frontend.sessions
+        assert (session.client, session.backend) == (mock_ssl_sock, mock_client_sock)
+
+        frontend.server_sock.close()
+
+    @patch.object(psk_frontend, "client")
+    @patch.object(psk_frontend, "SSLPSKContext")
+    def test_context_is_built_once(self, mock_ssl_context_class, mock_client, pairs):
+        """Test that all connections of a listener share one TLS-PSK context."""
+        frontend = PskFrontend("127.0.0.1", 9983, "10.42.42.1", 80)
+        mock_context = mock_ssl_context_class.return_value
+        mock_context.wrap_socket.side_effect = lambda *args, **kwargs: watchable_mock(pairs)
+        mock_client.side_effect = lambda *args: watchable_mock(pairs)
+
+        frontend.new_client(Mock())
+        frontend.new_client(Mock())
+
+        assert len(frontend.sessions) == 2
+        mock_ssl_context_class.assert_called_once_with(ssl.PROTOCOL_TLS_SERVER)
+        assert mock_context.wrap_socket.call_count == 2
 
         frontend.server_sock.close()
 
@@ -239,17 +918,17 @@ class TestPskFrontendNewClient:
 class TestPskFrontendDataReadyCb:
     """Test data_ready_cb method error handling."""
 
-    def test_data_ready_cb_handles_socket_errors(self):
+    def test_data_ready_cb_handles_socket_errors(self, pairs):
         """Test that socket errors during data transfer are handled."""
         frontend = PskFrontend("127.0.0.1", 9991, "10.42.42.1", 80)
 
         # Create mock sockets for a session
-        mock_s1 = Mock()
-        mock_s2 = Mock()
-        frontend.sessions.append((mock_s1, mock_s2))
+        mock_s1 = watchable_mock(pairs)
+        mock_s2 = watchable_mock(pairs)
+        frontend.add_session(mock_s1, mock_s2)
 
-        # Make recv raise an OSError (connection error)
-        mock_s1.recv.side_effect = OSError("Connection reset by peer")
+        # Make recv_into raise an OSError (connection error)
+        mock_s1.recv_into.side_effect = OSError("Connection reset by peer")
 
         # Should not raise exception
         frontend.data_ready_cb(mock_s1)
@@ -259,16 +938,16 @@ class TestPskFrontendDataReadyCb:
 
         frontend.server_sock.close()
 
-    def test_data_ready_cb_handles_broken_pipe(self):
+    def test_data_ready_cb_handles_broken_pipe(self, pairs):
         """Test that BrokenPipeError during send is handled."""
         frontend = PskFrontend("127.0.0.1", 9990, "10.42.42.1", 80)
 
-        mock_s1 = Mock()
-        mock_s2 = Mock()
-        frontend.sessions.append((mock_s1, mock_s2))
+        mock_s1 = watchable_mock(pairs)
+        mock_s2 = watchable_mock(pairs)
+        frontend.add_session(mock_s1, mock_s2)
 
-        # recv succeeds but send fails
-        mock_s1.recv.return_value = b"test data"
+        # recv_into succeeds but send fails
+        mock_s1.recv_into.side_effect = [9, BlockingIOError()]
         mock_s2.send.side_effect = BrokenPipeError("Broken pipe")
 
         # Should not raise exception
@@ -279,16 +958,16 @@ class TestPskFrontendDataReadyCb:
 
         frontend.server_sock.close()
 
-    def test_data_ready_cb_handles_shutdown_error(self):
+    def test_data_ready_cb_handles_shutdown_error(self, pairs):
         """Test that shutdown errors are handled."""
         frontend = PskFrontend("127.0.0.1", 9989, "10.42.42.1", 80)
 
-        mock_s1 = Mock()
-        mock_s2 = Mock()
-        frontend.sessions.append((mock_s1, mock_s2))
+        mock_s1 = watchable_mock(pairs)
+        mock_s2 = watchable_mock(pairs)
+        frontend.add_session(mock_s1, mock_s2)
 
-        # recv returns empty (connection closed)
-        mock_s1.recv.return_value = b""
+        # recv_into returns 0 (connection closed)
+        mock_s1.recv_into.return_value = 0
         # shutdown raises error (already closed)
         mock_s1.shutdown.side_effect = OSError("Transport endpoint is not connected")
 
@@ -300,6 +979,26 @@ class TestPskFrontendDataReadyCb:
 
         frontend.server_sock.close()
 
+    def test_accept_failure_pauses_listener(self, capsys):
+        """Test that a failing accept() does not keep the listener watched (no busy loop)."""
+        frontend = PskFrontend("127.0.0.1", 9975, "10.42.42.1", 80)
+        listener_sock = frontend.server_sock
+        frontend.server_sock = Mock()
+        frontend.server_sock.fileno.return_value = listener_sock.fileno()
+        frontend.server_sock.accept.side_effect = OSError(errno.EMFILE, "Too many open files")
+
+        frontend.data_ready_cb(frontend.server_sock)
+
+        assert "accept failed" in capsys.readouterr().out
+        assert listener_sock.fileno() not in frontend.reactor.selector.get_map()
+        # The poll ends when the retry timer is due, which watches the listener again
+        frontend.reactor.poll(1)
+        assert listener_sock.fileno() in frontend.reactor.selector.get_map()
+        assert frontend.accept_timer is None
+
+        frontend.server_sock = listener_sock
+        frontend.close()
+
     @pytest.mark.skip(reason="socket.accept is read-only and cannot be mocked easily")
     def test_data_ready_cb_handles_new_connection(self):
         """Test that new client connections are handled."""
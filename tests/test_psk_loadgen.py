@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the psk_loadgen module.
+
+Runs a small benchmark against a real PskFrontend and echo backend and
+checks the report table.
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+pytest.importorskip("sslpsk3")
+
+from psk_loadgen import BenchmarkRun, LoadConfig, format_runs, main, run_benchmark
+
+
+class TestBenchmark:
+    """Test benchmark runs on loopback."""
+
+    def test_small_run(self):
+        """Test that every handshake and the payload go through the proxy."""
+        config = LoadConfig(connections=20, concurrency=5, identities=4, streams=2, megabytes=1)
+
+        (run,) = run_benchmark(config, [4096])
+
+        assert run.buffer_size == 4096
+        assert run.handshakes == 20
+        assert run.failed == 0
+        assert run.handshake_p50_ms <= run.handshake_p99_ms
+        assert run.throughput_bytes == 2 * 1000 * 1000
+        assert run.throughput_mb_per_s > 0
+
+    def test_json_report(self, tmp_path, capsys):
+        """Test the command line with a JSON report for two buffer sizes."""
+        path = tmp_path / "bench.json"
+
+        code = main(
+            [
+                "--connections=4",
+                "--streams=1",
+                "--megabytes=1",
+                "--buffer-sizes=4096,16384",
+                "--json=%s" % path,
+            ]
+        )
+
+        assert code == 0
+        report = json.loads(path.read_text())
+        assert report["config"]["connections"] == 4
+        assert [run["buffer_size"] for run in report["runs"]] == [4096, 16384]
+        assert "handshakes/s" in capsys.readouterr().out
+
+
+class TestFormat:
+    """Test the result table."""
+
+    def test_format_runs(self):
+        """Test one row per buffer size."""
+        run = BenchmarkRun(16384, 10, 1, 250.0, 2.5, 9.75, 4000000, 80.25)
+
+        lines = format_runs([run]).splitlines()
+
+        assert len(lines) == 2
+        assert lines[1].split() == ["16384", "10", "1", "250.0", "2.5", "9.8", "80.2"]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the response_cache module.
+
+The cached renderer must produce exactly the same bytes as the original
+reply() implementation, for both plain and encrypted answers.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from base64 import b64decode, b64encode
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from crypto_utils import decrypt, encrypt
+from response_cache import ResponseCache, ResponseTemplate
+
+SEC_KEY = "0000000000000000"
+
+
+def jsonstr(j):
+    return json.dumps(j, separators=(",", ":"))
+
+
+def reference_reply(result, encrypted, sec_key, ts):
+    """Uncached reply rendering, as implemented by JSONHandler.reply."""
+    if encrypted:
+        answer_json = jsonstr({"result": result, "t": ts, "success": True})
+        payload = b64encode(encrypt(answer_json, sec_key.encode())).decode()
+        signature = "result=%s||t=%d||%s" % (payload, ts, sec_key)
+        signature = hashlib.md5(signature.encode()).hexdigest()[8:24]
+        answer = {"result": payload, "t": ts, "sign": signature}
+    else:
+        answer = {"t": ts, "e": False, "success": True}
+        if result:
+            answer["result"] = result
+    return jsonstr(answer)
+
+
+UPGRADE_ANSWER = {
+    "auto": 3,
+    "size": "123456",
+    "type": 0,
+    "pskUrl": "http://10.42.42.1/files/upgrade.bin",
+    "hmac": "A" * 64,
+    "version": "9.0.0",
+}
+
+RESULTS = [
+    None,
+    True,
+    {"devId": "x"},
+    UPGRADE_ANSWER,
+    {"schema": jsonstr([{"mode": "rw", "id": 1}] * 20), "secKey": SEC_KEY},
+]
+
+
+class TestResponseTemplate:
+    """Test template rendering against the reference implementation."""
+
+    @pytest.mark.parametrize("encrypted", [False, True])
+    @pytest.mark.parametrize("result", RESULTS)
+    def test_static_templates_match_reference(self, result, encrypted):
+        """Test that static templates render identically to reply()."""
+        template = ResponseTemplate(result, encrypted, SEC_KEY)
+        for ts in (1234567890, 1700000000, 9):
+            assert template.render(ts, {}) == reference_reply(result, encrypted, SEC_KEY, ts)
+
+    @pytest.mark.parametrize("encrypted", [False, True])
+    def test_dynamic_fields_match_reference(self, encrypted):
+        """Test that dynamic fields are spliced in with JSON encoding."""
+        result = {"validTime": 1800, "time": 0, "config": {}, "devId": ""}
+        template = ResponseTemplate(result, encrypted, SEC_KEY, dynamic=("devId", "time"))
+        assert set(template.fields) == {"devId", "time", "t"}
+
+        for dev_id, now in (("abc", 1), ('quo"te', 1700000000), ("é", 42)):
+            expected = dict(result, devId=dev_id, time=now)
+            rendered = template.render(now, {"devId": dev_id, "time": now})
+            assert rendered == reference_reply(expected, encrypted, SEC_KEY, now)
+
+    def test_encrypted_template_decrypts(self):
+        """Test that the spliced ciphertext decrypts to the full answer."""
+        template = ResponseTemplate(UPGRADE_ANSWER, True, SEC_KEY)
+        reply = json.loads(template.render(1234567890, {}))
+        inner = json.loads(decrypt(b64decode(reply["result"]), SEC_KEY.encode()))
+        assert inner == {"result": UPGRADE_ANSWER, "t": 1234567890, "success": True}
+
+
+class TestResponseCache:
+    """Test cache bookkeeping and invalidation."""
+
+    def test_hit_reuses_template(self):
+        """Test that a second render with the same name is a cache hit."""
+        cache = ResponseCache()
+        cache.render("log", True, False, SEC_KEY, 1)
+        cache.render("log", True, False, SEC_KEY, 2)
+        assert cache.misses == 1
+        assert cache.hits == 1
+        assert len(cache) == 1
+
+    def test_encrypted_flag_is_part_of_key(self):
+        """Test that plain and encrypted variants are cached separately."""
+        cache = ResponseCache()
+        plain = cache.render("log", True, False, SEC_KEY, 1)
+        crypted = cache.render("log", True, True, SEC_KEY, 1)
+        assert plain != crypted
+        assert len(cache) == 2
+
+    def test_dynamic_values_read_on_hit(self):
+        """Test that dynamic values come from the current result."""
+        cache = ResponseCache()
+        cache.render("timer", {"devId": "a", "count": 0}, False, SEC_KEY, 1, ("devId",))
+        reply = cache.render("timer", {"devId": "b", "count": 0}, False, SEC_KEY, 1, ("devId",))
+        assert json.loads(reply)["result"]["devId"] == "b"
+
+    def test_invalidate_drops_templates(self):
+        """Test that invalidate() forces templates to be rebuilt."""
+        cache = ResponseCache()
+        cache.render("upgrade", {"md5": "old"}, False, SEC_KEY, 1)
+        cache.invalidate()
+        reply = cache.render("upgrade", {"md5": "new"}, False, SEC_KEY, 1)
+        assert json.loads(reply)["result"]["md5"] == "new"
+        assert cache.misses == 2
+
+    def test_sec_key_change_invalidates(self):
+        """Test that changing the secret key rebuilds encrypted templates."""
+        cache = ResponseCache()
+        other_key = "1111111111111111"
+        cache.render("log", True, True, SEC_KEY, 1)
+        reply = cache.render("log", True, True, other_key, 1)
+        assert reply == reference_reply(True, True, other_key, 1)
+        assert cache.misses == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
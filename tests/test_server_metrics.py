@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the server_metrics module.
+
+Validates counters, histograms, collected values, the series limit and both
+output formats.
+"""
+
+import os
+import sys
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from server_metrics import MetricsRegistry, WorkerSnapshots
+
+
+class TestCounters:
+    """Test counters and gauges."""
+
+    def test_counter_render(self):
+        """Test the text exposition of a labelled counter."""
+        metrics = MetricsRegistry()
+        requests = metrics.counter("tuya_requests_total", "API requests", ("action",))
+        requests.inc(("s.gw.token.get",))
+        requests.inc(("s.gw.token.get",))
+        requests.inc(("s.gw.dev.pk.active",))
+
+        assert metrics.render() == (
+            "# HELP tuya_requests_total API requests\n"
+            "# TYPE tuya_requests_total counter\n"
+            'tuya_requests_total{action="s.gw.dev.pk.active"} 1\n'
+            'tuya_requests_total{action="s.gw.token.get"} 2\n'
+        )
+
+    def test_collected_gauge(self):
+        """Test that collect functions are only called when the metrics are read."""
+        calls = []
+
+        def collect():
+            calls.append(1)
+            return {(): 7}
+
+        metrics = MetricsRegistry()
+        metrics.gauge("tuya_sessions", "Sessions", collect=collect)
+
+        assert calls == []
+        assert "tuya_sessions 7\n" in metrics.render()
+        assert metrics.snapshot()["tuya_sessions"]["samples"] == [{"labels": {}, "value": 7}]
+
+    def test_series_limit(self):
+        """Test that label values beyond the limit are folded into "other"."""
+        metrics = MetricsRegistry()
+        requests = metrics.counter("tuya_requests_total", "API requests", ("action",))
+        requests.max_series = 2
+        for action in ("a", "b", "c", "d", "a"):
+            requests.inc((action,))
+
+        assert requests.values() == {("a",): 2, ("b",): 1, ("other",): 2}
+
+    def test_label_values_are_escaped(self):
+        """Test that device-supplied label values cannot break the text format."""
+        metrics = MetricsRegistry()
+        metrics.counter("tuya_requests_total", "API requests", ("action",)).inc(('x"\n',))
+
+        assert 'action="x\\"\\n"' in metrics.render()
+
+    def test_duplicate_name(self):
+        """Test that a metric name can only be registered once."""
+        metrics = MetricsRegistry()
+        metrics.counter("tuya_requests_total", "API requests")
+
+        with pytest.raises(ValueError):
+            metrics.gauge("tuya_requests_total", "API requests")
+
+
+class TestHistograms:
+    """Test latency histograms."""
+
+    def test_buckets_are_cumulative(self):
+        """Test bucket placement, sum and count in both formats."""
+        metrics = MetricsRegistry()
+        latency = metrics.histogram("latency_seconds", "Latency", ("phase",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            latency.observe(("handler",), value)
+
+        lines = metrics.render().splitlines()
+        assert lines[2:] == [
+            'latency_seconds_bucket{phase="handler",le="0.1"} 2',
+            'latency_seconds_bucket{phase="handler",le="1"} 3',
+            'latency_seconds_bucket{phase="handler",le="+Inf"} 4',
+            'latency_seconds_sum{phase="handler"} 3.65',
+            'latency_seconds_count{phase="handler"} 4',
+        ]
+        (sample,) = metrics.snapshot()["latency_seconds"]["samples"]
+        assert sample["count"] == 4
+        assert sample["buckets"] == {"0.1": 2, "1.0": 3, "+Inf": 4}
+
+    def test_quantile(self):
+        """Test quantile estimates interpolated within buckets."""
+        metrics = MetricsRegistry()
+        latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.05, 0.5, 0.5):
+            latency.observe((), value)
+
+        assert latency.quantile((), 0.5) == pytest.approx(0.1)
+        assert latency.quantile((), 0.75) == pytest.approx(0.55)
+        assert latency.quantile(("missing",), 0.5) == 0.0
+
+    def test_merge_snapshots(self):
+        """Test that snapshots of several registries add up."""
+        workers = []
+        for value in (0.05, 0.5):
+            metrics = MetricsRegistry()
+            metrics.counter("handshakes_total", "Handshakes", ("port",)).inc(("443",))
+            metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0)).observe((), value)
+            workers.append(metrics.snapshot())
+
+        total = MetricsRegistry()
+        for snapshot in workers:
+            total.merge(snapshot)
+
+        assert total.families["handshakes_total"].values() == {("443",): 2}
+        latency = total.families["latency_seconds"]
+        assert latency.buckets == (0.1, 1.0)
+        assert latency.values()[()].counts == [1, 1, 0]
+        assert latency.values()[()].count == 2
+        assert latency.quantile((), 0.5) == pytest.approx(0.1)
+
+    def test_worker_snapshots(self, tmp_path):
+        """Test that a scrape merges the published snapshots of the other workers."""
+        workers = []
+        for worker in range(3):
+            metrics = MetricsRegistry()
+            metrics.counter("requests_total", "Requests").inc((), worker + 1)
+            metrics.gauge("sessions", "Sessions", ("status",)).set(("none",), 5)
+            workers.append(metrics)
+            WorkerSnapshots(str(tmp_path), worker, shared=("sessions",)).publish(metrics)
+        # Values recorded after the last publish only count for the scraped worker
+        workers[0].families["requests_total"].inc()
+        workers[1].families["requests_total"].inc()
+
+        total = WorkerSnapshots(str(tmp_path), 0, shared=("sessions",)).merged(workers[0])
+
+        assert total.families["requests_total"].values() == {(): 7}
+        assert total.families["sessions"].values() == {("none",): 5}
+
+    def test_clear(self):
+        """Test that clear() forgets recorded values."""
+        metrics = MetricsRegistry()
+        latency = metrics.histogram("latency_seconds", "Latency")
+        latency.observe((), 0.1)
+
+        metrics.clear()
+
+        assert metrics.snapshot()["latency_seconds"]["samples"] == []
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the session_store module.
+
+Validates session tracking, LRU and TTL eviction, snapshot persistence and
+the SQLite store shared between worker processes.
+"""
+
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from session_store import (
+    MAX_STAGES_PER_SESSION,
+    UPGRADE_SCHEDULED,
+    SessionStore,
+    SqliteSessionStore,
+)
+
+
+class FakeClock:
+    """Manually advanced time source."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    """Fake clock for deterministic expiry."""
+    return FakeClock()
+
+
+class TestSessions:
+    """Test recording of device state."""
+
+    def test_touch_creates_and_updates_session(self, clock):
+        """Test that touch() records protocol, stages and API version."""
+        store = SessionStore(clock=clock)
+
+        session = store.touch("gw1", "s.gw.token.get", encrypted=True, api_version="4.4")
+        clock.now += 5
+        store.touch("gw1", "tuya.device.active", encrypted=True)
+
+        assert "gw1" in store
+        assert session.protocol == "2.2"
+        assert session.api_version == "4.4"
+        assert session.stages == {"s.gw.token.get": 1000.0, "tuya.device.active": 1005.0}
+        assert session.created == 1000.0
+        assert session.last_seen == 1005.0
+
+    def test_update_creates_session(self, clock):
+        """Test that update() passes a new session for unknown devices."""
+        store = SessionStore(clock=clock)
+
+        assert store.update("gw1", lambda session: session.gw_id) == "gw1"
+        assert "gw1" in store
+
+    def test_stages_are_bounded(self, clock):
+        """Test that arbitrary action names cannot grow a session without limit."""
+        store = SessionStore(clock=clock)
+        for i in range(MAX_STAGES_PER_SESSION + 10):
+            session = store.touch("gw1", "action.%d" % i)
+
+        assert len(session.stages) == MAX_STAGES_PER_SESSION
+
+
+class TestEviction:
+    """Test the memory bounds."""
+
+    def test_lru_eviction(self, clock):
+        """Test that the least recently used session is evicted when full."""
+        store = SessionStore(max_sessions=2, clock=clock)
+        store.touch("gw1")
+        store.touch("gw2")
+        store.touch("gw1")
+        store.touch("gw3")
+
+        assert "gw1" in store
+        assert "gw2" not in store
+        assert "gw3" in store
+        assert store.evicted == 1
+
+    def test_ttl_expiry(self, clock):
+        """Test that idle sessions expire and are recreated empty."""
+        store = SessionStore(ttl=60, clock=clock)
+        store.touch("gw1").schema_variant = 20
+        clock.now += 61
+
+        assert store.get("gw1") is None
+        assert store.touch("gw1").schema_variant is None
+        assert store.expired == 1
+
+    def test_evict_expired(self, clock):
+        """Test periodic removal of all expired sessions."""
+        store = SessionStore(ttl=60, clock=clock)
+        store.touch("gw1")
+        clock.now += 30
+        store.touch("gw2")
+        clock.now += 40
+
+        store.evict_expired()
+
+        assert len(store) == 1
+        assert "gw2" in store
+
+
+class TestSnapshot:
+    """Test on-disk persistence."""
+
+    def test_save_and_load_roundtrip(self, clock, tmp_path):
+        """Test that sessions survive a restart."""
+        path = str(tmp_path / "sessions.json")
+        store = SessionStore(snapshot_path=path, clock=clock)
+        session = store.touch("gw1", "tuya.device.active")
+        session.schema_variant = 20
+        session.upgrade_status = "scheduled"
+
+        assert store.save() is True
+        assert store.save() is False  # nothing changed
+
+        restored = SessionStore(snapshot_path=path, clock=clock)
+        assert restored.load() == 1
+        session = restored.get("gw1")
+        assert session.schema_variant == 20
+        assert session.upgrade_status == "scheduled"
+        assert session.stages == {"tuya.device.active": 1000.0}
+
+    def test_load_skips_expired_sessions(self, clock, tmp_path):
+        """Test that sessions that expired while the server was down are dropped."""
+        path = str(tmp_path / "sessions.json")
+        store = SessionStore(ttl=60, snapshot_path=path, clock=clock)
+        store.touch("gw1")
+        store.save()
+        clock.now += 120
+
+        assert SessionStore(ttl=60, snapshot_path=path, clock=clock).load() == 0
+
+    def test_corrupt_snapshot_is_ignored(self, tmp_path):
+        """Test that an unreadable snapshot does not prevent startup."""
+        path = tmp_path / "sessions.json"
+        path.write_text("{not json")
+
+        with patch("builtins.print"):
+            assert SessionStore(snapshot_path=str(path)).load() == 0
+
+    def test_snapshot_disabled(self):
+        """Test that save() and load() are no-ops without a snapshot path."""
+        store = SessionStore()
+        store.touch("gw1")
+
+        assert store.save() is False
+        assert store.load() == 0
+
+
+class TestSqliteSessionStore:
+    """Test the store shared between worker processes."""
+
+    def test_sessions_are_shared(self, clock, tmp_path):
+        """Test that committed changes are visible through another connection."""
+        path = str(tmp_path / "sessions.db")
+        worker1 = SqliteSessionStore(path, clock=clock)
+        worker2 = SqliteSessionStore(path, clock=clock)
+
+        session = worker1.touch("gw1", "tuya.device.active", encrypted=True)
+        session.schema_variant = 20
+        worker1.commit(session)
+
+        shared = worker2.get("gw1")
+        assert shared.schema_variant == 20
+        assert shared.protocol == "2.2"
+        assert "gw1" in worker2
+        worker1.close()
+        worker2.close()
+
+    def test_concurrent_touches_keep_every_stage(self, tmp_path):
+        """Test that workers touching the same device do not lose each other's stages."""
+        path = str(tmp_path / "sessions.db")
+        SqliteSessionStore(path).close()
+
+        def worker(prefix):
+            store = SqliteSessionStore(path)
+            for i in range(15):
+                store.touch("gw1", "%s%d" % (prefix, i))
+            store.close()
+
+        threads = [threading.Thread(target=worker, args=(prefix,)) for prefix in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        store = SqliteSessionStore(path)
+        assert len(store.get("gw1").stages) == 30
+        store.close()
+
+    def test_update_claims_once(self, tmp_path):
+        """Test that a read-modify-write through update() succeeds in one worker only."""
+        path = str(tmp_path / "sessions.db")
+        SqliteSessionStore(path).close()
+        claims = []
+
+        def claim(session):
+            if session.upgrade_status == UPGRADE_SCHEDULED:
+                return False
+            session.upgrade_status = UPGRADE_SCHEDULED
+            return True
+
+        def worker():
+            store = SqliteSessionStore(path)
+            claims.append(store.update("gw1", claim))
+            store.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(claims) == [False] * 7 + [True]
+
+    def test_lru_eviction(self, clock, tmp_path):
+        """Test that the least recently used session is evicted when full."""
+        store = SqliteSessionStore(str(tmp_path / "sessions.db"), max_sessions=2, clock=clock)
+        for gw_id in ("gw1", "gw2", "gw1", "gw3"):
+            clock.now += 1
+            store.touch(gw_id)
+
+        assert [session.gw_id for session in store] == ["gw1", "gw3"]
+        assert store.evicted == 1
+        store.close()
+
+    def test_ttl_expiry(self, clock, tmp_path):
+        """Test that idle sessions expire."""
+        store = SqliteSessionStore(str(tmp_path / "sessions.db"), ttl=60, clock=clock)
+        store.touch("gw1")
+        store.touch("gw2")
+        clock.now += 61
+        store.touch("gw2")
+
+        assert store.get("gw1") is None
+        store.evict_expired()
+        assert len(store) == 1
+        store.close()
+
+    def test_load_reports_existing_sessions(self, clock, tmp_path):
+        """Test that sessions survive a restart of the workers."""
+        path = str(tmp_path / "sessions.db")
+        store = SqliteSessionStore(path, clock=clock)
+        store.touch("gw1")
+        store.close()
+
+        restarted = SqliteSessionStore(path, clock=clock)
+        assert restarted.load() == 1
+        assert restarted.save() is False
+        restarted.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Start-up regression tests for the scripts launched during flashing.
+
+Checks that mq_pub_15.py and fake-registration-server.py keep paho and
+Cryptodome out of their cold start and stay within the import time budgets
+of startup_benchmark.
+"""
+
+import os
+import sys
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from startup_benchmark import TARGETS, StartupTarget, format_runs, measure, parse_importtime
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:       107 |        107 | _signal
+import time:       300 |        300 |     binascii
+import time:       552 |       1020 |   base64
+import time:      1200 |       2220 | mq_pub_15
+some other output
+"""
+
+
+def test_parse_importtime():
+    """Test parsing of -X importtime lines with their nesting depth."""
+    records = parse_importtime(IMPORTTIME)
+
+    assert [(r.name, r.depth) for r in records] == [
+        ("_signal", 0),
+        ("binascii", 2),
+        ("base64", 1),
+        ("mq_pub_15", 0),
+    ]
+    assert records[3].self_us == 1200 and records[3].cumulative_us == 2220
+
+
+def test_report_flags_deferred_imports():
+    """Test that a run importing a deferred package fails."""
+    target = StartupTarget("python", ("-c", "import json"), 1000.0, ("json",))
+
+    run = measure(target, runs=1)
+
+    assert run.deferred_loaded == ["json"] and not run.passed
+    assert "imported deferred packages: json" in format_runs([run])
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("target", TARGETS, ids=[target.name for target in TARGETS])
+def test_cold_start_budget(target):
+    """Test that a script defers its heavy imports and keeps to its budget."""
+    run = measure(target, runs=3)
+
+    assert run.deferred_loaded == []
+    assert run.import_ms <= target.budget_ms, format_runs([run])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the structured_log module.
+
+Validates level filtering, JSONL output, request ids, batching, dropping on
+overflow and file rotation.
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from structured_log import DEBUG, INFO, WARNING, StructuredLog, parse_level
+
+
+def read_jsonl(path):
+    """Return the records of a JSONL file."""
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+class TestLevels:
+    """Test verbosity handling."""
+
+    def test_parse_level(self):
+        """Test level names are case-insensitive."""
+        assert parse_level("debug") == DEBUG
+        assert parse_level("WARNING") == WARNING
+        with pytest.raises(ValueError):
+            parse_level("verbose")
+
+    def test_records_below_level_are_discarded(self, tmp_path):
+        """Test that filtered records never reach the queue."""
+        path = str(tmp_path / "web.jsonl")
+        log = StructuredLog(path=path, level=INFO, echo=False)
+
+        assert log.debug("headers", "Host: 10.42.42.1") is False
+        assert log.info("request", "POST /gw.json") is True
+        log.close()
+
+        assert [record["event"] for record in read_jsonl(path)] == ["request"]
+
+
+class TestOutput:
+    """Test console and JSONL output."""
+
+    def test_jsonl_record_fields(self, tmp_path):
+        """Test that records carry level, event, request id and extra fields."""
+        path = str(tmp_path / "web.jsonl")
+        log = StructuredLog(path=path, echo=False)
+        rid = log.new_request_id()
+
+        log.info("request", "POST /gw.json", rid, action="s.gw.token.get")
+        log.close()
+
+        (record,) = read_jsonl(path)
+        assert record["level"] == "info"
+        assert record["event"] == "request"
+        assert record["rid"] == rid
+        assert record["msg"] == "POST /gw.json"
+        assert record["action"] == "s.gw.token.get"
+
+    def test_request_ids_are_unique(self):
+        """Test that every request gets a new id."""
+        log = StructuredLog(echo=False)
+
+        assert log.new_request_id() != log.new_request_id()
+
+    def test_console_echo(self, capsys):
+        """Test that messages are echoed as plain text lines."""
+        log = StructuredLog()
+        log.warning("non_esp", "WARNING: it appears this device does not use an ESP82xx")
+        log.info("reply", "reply {}")
+        log.close()
+
+        assert capsys.readouterr().out == (
+            "WARNING: it appears this device does not use an ESP82xx\nreply {}\n"
+        )
+
+    def test_flush_waits_for_writer(self, tmp_path):
+        """Test that flush() returns once queued records are written."""
+        path = str(tmp_path / "web.jsonl")
+        log = StructuredLog(path=path, echo=False, batch_size=4)
+        for i in range(10):
+            log.info("reply", "reply %d" % i)
+
+        log.flush()
+
+        assert log.written == 10
+        assert len(read_jsonl(path)) == 10
+        log.close()
+
+
+class TestLimits:
+    """Test backpressure and rotation."""
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        """Test that log() never blocks when the writer falls behind."""
+        log = StructuredLog(echo=False, queue_size=2)
+        # Pretend the writer is running but stalled
+        log._thread = object()
+
+        results = [log.info("reply", "reply") for _ in range(5)]
+
+        assert results == [True, True, False, False, False]
+        assert log.dropped == 3
+
+    def test_rotation(self, tmp_path):
+        """Test that the JSONL file is rotated and old files are shifted."""
+        path = str(tmp_path / "web.jsonl")
+        log = StructuredLog(path=path, echo=False, max_bytes=200, backup_count=2, batch_size=1)
+        for i in range(20):
+            log.info("reply", "reply %02d" % i)
+        log.close()
+
+        assert os.path.exists(path + ".1")
+        assert os.path.exists(path + ".2")
+        assert not os.path.exists(path + ".3")
+        assert read_jsonl(path)[-1]["msg"] == "reply 19"
+        assert os.path.getsize(path) <= 200
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Test suite for the upgrade_scheduler module.
+
+Validates deduplication, cancellation and publishing of upgrade triggers
+without a running IOLoop or MQTT broker.
+"""
+
+import os
+import sys
+from unittest.mock import Mock, patch
+
+import pytest
+
+# Add scripts directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import upgrade_scheduler
+from mq_pub_15 import iot_dec
+from upgrade_scheduler import UpgradeScheduler
+
+GW_ID = "43511212112233445566"
+
+
+@pytest.fixture
+def io_loop():
+    """Fake IOLoop recording call_later() timers."""
+    loop = Mock()
+    with patch.object(upgrade_scheduler.tornado.ioloop.IOLoop, "current", return_value=loop):
+        yield loop
+
+
+@pytest.fixture
+def log():
+    """Fake StructuredLog."""
+    return Mock()
+
+
+@pytest.fixture
+def mqtt_client():
+    """Fake paho client returned by create_mqtt_client()."""
+    client = Mock()
+    with patch.object(upgrade_scheduler, "create_mqtt_client", return_value=client):
+        yield client
+
+
+class TestScheduling:
+    """Test scheduling and cancellation of triggers."""
+
+    def test_schedule_uses_call_later(self, io_loop):
+        """Test that a trigger is scheduled with the configured delay."""
+        scheduler = UpgradeScheduler(delay=7)
+
+        assert scheduler.schedule(GW_ID, "2.1") is True
+
+        assert io_loop.call_later.call_args[0][0] == 7
+        assert scheduler.pending() == [GW_ID]
+
+    def test_schedule_deduplicates_per_gwid(self, io_loop):
+        """Test that a second activation does not schedule another trigger."""
+        scheduler = UpgradeScheduler()
+
+        assert scheduler.schedule(GW_ID, "2.1") is True
+        assert scheduler.schedule(GW_ID, "2.1") is False
+        assert scheduler.schedule("other0000000000", "2.2") is True
+
+        assert io_loop.call_later.call_count == 2
+
+    def test_cancel_removes_timeout(self, io_loop):
+        """Test that cancel() removes the pending IOLoop timeout."""
+        scheduler = UpgradeScheduler()
+        scheduler.schedule(GW_ID, "2.1")
+
+        assert scheduler.cancel(GW_ID) is True
+        assert scheduler.cancel(GW_ID) is False
+
+        io_loop.remove_timeout.assert_called_once()
+        assert scheduler.pending() == []
+
+    def test_cancel_all(self, io_loop):
+        """Test that cancel_all() clears every pending trigger."""
+        scheduler = UpgradeScheduler()
+        scheduler.schedule(GW_ID, "2.1")
+        scheduler.schedule("other0000000000", "2.2")
+
+        scheduler.cancel_all()
+
+        assert scheduler.pending() == []
+        assert io_loop.remove_timeout.call_count == 2
+
+
+class TestFiring:
+    """Test publishing of triggers."""
+
+    def test_fire_publishes_on_persistent_client(self, io_loop, mqtt_client, log):
+        """Test that triggers share one MQTT connection."""
+        scheduler = UpgradeScheduler(broker="10.42.42.1", log=log)
+        scheduler.schedule(GW_ID, "2.1")
+        scheduler.schedule("other0000000000", "2.2")
+
+        for call in io_loop.call_later.call_args_list:
+            _, callback, *args = call[0]
+            callback(*args)
+
+        mqtt_client.connect_async.assert_called_once()
+        assert mqtt_client.connect_async.call_args[0][0] == "10.42.42.1"
+        mqtt_client.loop_start.assert_called_once()
+        assert mqtt_client.publish.call_count == 2
+        assert scheduler.fired == 2
+        assert scheduler.pending() == []
+
+    def test_fire_publishes_decodable_message(self, io_loop, mqtt_client, log):
+        """Test that the published payload is a valid protocol 2.1 trigger."""
+        scheduler = UpgradeScheduler(log=log)
+        scheduler.schedule(GW_ID, "2.1")
+
+        _, callback, *args = io_loop.call_later.call_args[0]
+        callback(*args)
+        topic, payload = mqtt_client.publish.call_args[0]
+        message = iot_dec(payload.decode(), scheduler.local_key)
+
+        assert topic == "smart/device/in/" + GW_ID
+        assert '"gwId":"%s"' % GW_ID in message
+
+    def test_fire_does_not_print(self, io_loop, mqtt_client, log, capsys):
+        """Test that encoding a trigger writes nothing to stdout."""
+        scheduler = UpgradeScheduler(log=log)
+
+        scheduler._fire(GW_ID, "2.2")
+
+        assert capsys.readouterr().out == ""
+        mqtt_client.publish.assert_called_once()
+
+    def test_fire_error_is_contained(self, io_loop, mqtt_client, log):
+        """Test that publish errors are logged and do not propagate into the IOLoop."""
+        mqtt_client.publish.side_effect = OSError("broker unreachable")
+        scheduler = UpgradeScheduler(log=log)
+
+        scheduler._fire(GW_ID, "2.1")
+
+        assert scheduler.fired == 0
+        event, message = log.warning.call_args[0]
+        assert event == "upgrade" and "broker unreachable" in message
+        assert log.warning.call_args[1]["gwId"] == GW_ID
+
+    def test_fire_notifies_on_fired(self, io_loop, mqtt_client, log):
+        """Test that on_fired learns about published and failed triggers."""
+        on_fired = Mock()
+        scheduler = UpgradeScheduler(log=log, on_fired=on_fired)
+
+        scheduler._fire(GW_ID, "2.1")
+        mqtt_client.publish.side_effect = OSError("broker unreachable")
+        scheduler._fire(GW_ID, "2.2")
+
+        assert on_fired.call_count == 2
+        on_fired.assert_called_with(GW_ID)
+
+    def test_close_disconnects(self, io_loop, mqtt_client, log):
+        """Test that close() tears down the persistent connection."""
+        scheduler = UpgradeScheduler(log=log)
+        scheduler._fire(GW_ID, "2.1")
+
+        scheduler.close()
+
+        mqtt_client.disconnect.assert_called_once()
+        mqtt_client.loop_stop.assert_called_once()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])